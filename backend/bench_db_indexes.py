@@ -0,0 +1,194 @@
+"""索引基准：在百万行合成数据上对比建索引前后 profiles 的查询耗时，并测量分批清理过期验证码。
+
+用法（连接参数与后端一致，读取 POSTGRES_* 环境变量或 .env）：
+
+    python bench_db_indexes.py --rows 1000000 --queries 200
+
+脚本在独立的 schema（默认 bench_indexes）中建表与造数，结束后整体删除，不触碰业务表。
+输出每类查询的 p50/p99（毫秒）与所用执行计划的顶层节点，随后执行与 worker 相同的分批 DELETE
+（验证码已不再存数据库，sms_codes 只用于衡量历史数据的清理速度）。
+"""
+import argparse
+import math
+import os
+import random
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+INDEXES = (
+    "CREATE INDEX idx_sms_codes_expires_at ON sms_codes (expires_at)",
+    "CREATE INDEX idx_profiles_user_created_at ON profiles (user_id, created_at DESC)",
+)
+
+QUERIES = {
+    "list_profiles": (
+        """
+        SELECT id, name, created_at FROM profiles
+        WHERE user_id = %s
+        ORDER BY created_at DESC
+        """,
+        lambda rng, rows: (f"00000000-0000-0000-0000-{rng.randrange(rows // 4):012d}",),
+    ),
+}
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100.0 * len(ordered)) - 1))]
+
+
+def setup(cur, rows):
+    # 每个手机号约 5 条验证码（一半已过期），每个用户约 4 个档案，接近线上的分布形态。
+    cur.execute(
+        """
+        CREATE TABLE sms_codes (
+            id bigserial PRIMARY KEY,
+            phone text NOT NULL,
+            code text NOT NULL,
+            expires_at timestamptz NOT NULL,
+            created_at timestamptz DEFAULT now()
+        )
+        """
+    )
+    cur.execute(
+        """
+        INSERT INTO sms_codes (phone, code, expires_at, created_at)
+        SELECT '1' || lpad((i %% %s)::text, 10, '0'),
+               lpad((random() * 999999)::int::text, 6, '0'),
+               now() - interval '2 days' + (i %% 2) * interval '3 days',
+               now() - (random() * interval '30 days')
+        FROM generate_series(1, %s) AS i
+        """,
+        (rows // 5, rows),
+    )
+    cur.execute(
+        """
+        CREATE TABLE profiles (
+            id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+            user_id uuid,
+            name text NOT NULL,
+            created_at timestamptz DEFAULT now()
+        )
+        """
+    )
+    cur.execute(
+        """
+        INSERT INTO profiles (user_id, name, created_at)
+        SELECT ('00000000-0000-0000-0000-' || lpad((i %% %s)::text, 12, '0'))::uuid,
+               'bench-' || i,
+               now() - (random() * interval '365 days')
+        FROM generate_series(1, %s) AS i
+        """,
+        (rows // 4, rows),
+    )
+    cur.execute("ANALYZE sms_codes")
+    cur.execute("ANALYZE profiles")
+
+
+def measure(cur, rows, queries, seed=7):
+    results = {}
+    for name, (sql, make_params) in QUERIES.items():
+        rng = random.Random(seed)
+        cur.execute("EXPLAIN (FORMAT JSON) " + sql, make_params(rng, rows))
+        plan = cur.fetchone()[0][0]["Plan"]
+        node = plan["Node Type"]
+        while "Plans" in plan and node in ("Limit", "Sort"):
+            plan = plan["Plans"][0]
+            node = f"{node} > {plan['Node Type']}"
+        timings = []
+        for _ in range(queries):
+            params = make_params(rng, rows)
+            started = time.perf_counter()
+            cur.execute(sql, params)
+            cur.fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        results[name] = (percentile(timings, 50), percentile(timings, 99), node)
+    return results
+
+
+def purge(conn, batch_size):
+    deleted = 0
+    batches = 0
+    started = time.perf_counter()
+    worst = 0.0
+    while True:
+        batch_started = time.perf_counter()
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                DELETE FROM sms_codes
+                WHERE id IN (SELECT id FROM sms_codes WHERE expires_at < now() LIMIT %s)
+                """,
+                (batch_size,),
+            )
+            count = cur.rowcount
+        conn.commit()
+        worst = max(worst, time.perf_counter() - batch_started)
+        deleted += count
+        batches += 1
+        if count < batch_size:
+            break
+    return deleted, batches, time.perf_counter() - started, worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000, help="sms_codes 与 profiles 各自的行数")
+    parser.add_argument("--queries", type=int, default=200, help="每类查询的执行次数")
+    parser.add_argument("--batch", type=int, default=5000, help="清理时每批删除的行数")
+    parser.add_argument("--schema", default="bench_indexes")
+    args = parser.parse_args()
+
+    load_dotenv(os.path.join(BASE_DIR, ".env"))
+    conn = psycopg2.connect(
+        host=os.getenv("POSTGRES_HOST", "localhost"),
+        port=int(os.getenv("POSTGRES_PORT", "5432")),
+        dbname=os.getenv("POSTGRES_DB", "deepfate"),
+        user=os.getenv("POSTGRES_USER", "postgres"),
+        password=os.getenv("POSTGRES_PASSWORD", ""),
+    )
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE")
+            cur.execute(f"CREATE SCHEMA {args.schema}")
+            cur.execute(f"SET search_path TO {args.schema}, public")
+            started = time.perf_counter()
+            setup(cur, args.rows)
+            conn.commit()
+            print(f"generated {args.rows} rows per table in {time.perf_counter() - started:.1f}s")
+
+            before = measure(cur, args.rows, args.queries)
+            started = time.perf_counter()
+            for statement in INDEXES:
+                cur.execute(statement)
+            cur.execute("ANALYZE sms_codes")
+            cur.execute("ANALYZE profiles")
+            conn.commit()
+            print(f"built indexes in {time.perf_counter() - started:.1f}s")
+            after = measure(cur, args.rows, args.queries)
+
+        print(f"{'query':<14} {'index':<6} {'p50_ms':>8} {'p99_ms':>8}  plan")
+        for name in QUERIES:
+            for label, result in (("no", before[name]), ("yes", after[name])):
+                p50, p99, node = result
+                print(f"{name:<14} {label:<6} {p50:>8.2f} {p99:>8.2f}  {node}")
+
+        deleted, batches, elapsed, worst = purge(conn, args.batch)
+        print(
+            f"purged {deleted} expired codes in {batches} batches of {args.batch}: "
+            f"{elapsed:.1f}s total, slowest batch {worst * 1000:.0f}ms"
+        )
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""密码哈希基准：为 SPARK_KDF_N/R/P 与 SPARK_KDF_WORKERS 选值。
+
+用法：
+
+    python bench_kdf.py --n 32768 --r 8 --p 1 --workers 1,2,4,8 --hashes 64
+
+先测单次 scrypt 的耗时与内存（128 * N * r 字节），再按每个线程数并发计算 --hashes 次，
+输出吞吐（次/秒）与单次等待的 p50/p99。吞吐不再随线程数增长的拐点通常就是合适的池大小；
+SPARK_KDF_QUEUE 可按“可接受的最长等待 ÷ 单次耗时 × 线程数”估算。
+"""
+import argparse
+import hashlib
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def scrypt_once(n, r, p):
+    started = time.perf_counter()
+    hashlib.scrypt(b"bench-password", salt=os.urandom(16), n=n, r=r, p=p, maxmem=256 * n * r * p + (1 << 20), dklen=32)
+    return time.perf_counter() - started
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100.0 * len(ordered)) - 1))]
+
+
+def run(n, r, p, workers, hashes):
+    submitted = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(scrypt_once, n, r, p) for _ in range(hashes)]
+        waits = []
+        for future in futures:
+            future.result()
+            # 从全部提交到各自完成的时间，相当于一批并发登录时每个请求感受到的延迟。
+            waits.append(time.perf_counter() - submitted)
+    elapsed = time.perf_counter() - submitted
+    return hashes / elapsed, percentile(waits, 50), percentile(waits, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=2 ** 15)
+    parser.add_argument("--r", type=int, default=8)
+    parser.add_argument("--p", type=int, default=1)
+    parser.add_argument("--workers", default="1,2,4,8", help="逗号分隔的线程数")
+    parser.add_argument("--hashes", type=int, default=64, help="每个线程数下计算的次数")
+    args = parser.parse_args()
+
+    single = [scrypt_once(args.n, args.r, args.p) for _ in range(5)]
+    print(
+        f"scrypt N={args.n} r={args.r} p={args.p}: {min(single) * 1000:.0f}ms per hash, "
+        f"{128 * args.n * args.r / (1 << 20):.0f} MiB per hash, {os.cpu_count()} CPUs"
+    )
+    print(f"{'workers':>7} {'hash/s':>8} {'p50_ms':>8} {'p99_ms':>8}")
+    for workers in [int(x) for x in args.workers.split(",") if x.strip()]:
+        rate, p50, p99 = run(args.n, args.r, args.p, workers, args.hashes)
+        print(f"{workers:>7} {rate:>8.1f} {p50 * 1000:>8.0f} {p99 * 1000:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""SSE 输出合并基准：本地 Spark 模拟器 + 真实后端进程，对比逐帧发送与合并发送。
+
+用法（需要能连上 PostgreSQL，后端启动时会执行 init_db）：
+
+    python bench_sse.py --tokens 400 --delay-ms 5 --windows 0,40
+
+脚本会在本机启动 Spark 协议模拟器（spark_simulator.py），再按每个合并时间窗各启动一次
+spark_server.py（SPARK_URL 指向模拟器），对 /spark/chat/stream 发起请求，输出：
+- 服务端 SSE 写次数与字节数（/debug/metrics 中 sse_events_total / sse_bytes_total 的增量，
+  每个 SSE 事件对应一次 socket 写）
+- 客户端收到的字节数与 recv() 调用次数
+- 首 token 延迟与总耗时
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from urllib.request import Request, urlopen
+
+from session_token import SessionSigner
+from spark_simulator import SimulatorConfig, SparkSimulator
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 后端子进程的调试令牌，用于读取 /debug/metrics
+DEBUG_TOKEN = "bench-debug"
+# 后端子进程的会话令牌签名密钥，/spark/chat/stream 需要带会话令牌
+SESSION_KEY = ("bench", b"bench-session-key")
+
+
+def _metric_total(base_url, name):
+    req = Request(f"{base_url}/debug/metrics", headers={"X-Debug-Profile": DEBUG_TOKEN})
+    with urlopen(req, timeout=5) as resp:
+        data = json.loads(resp.read().decode("utf-8"))
+    return sum(entry.get("value", 0) for entry in data.get(name, []))
+
+
+def _wait_ready(base_url, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urlopen(f"{base_url}/health", timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("backend did not start")
+
+
+def _stream_once(host, port, token):
+    body = json.dumps({"messages": [{"role": "user", "content": "基准测试"}]}).encode("utf-8")
+    sock = socket.create_connection((host, port))
+    sock.sendall(
+        b"POST /spark/chat/stream HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+        + f"Authorization: Bearer {token}\r\n".encode("ascii")
+        + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii")
+        + body
+    )
+    started = time.time()
+    first_data = None
+    received = 0
+    recv_calls = 0
+    buffer = b""
+    while True:
+        chunk = sock.recv(65536)
+        recv_calls += 1
+        if not chunk:
+            break
+        received += len(chunk)
+        if first_data is None:
+            buffer += chunk
+            if b"\ndata: " in buffer or buffer.startswith(b"data: "):
+                first_data = time.time() - started
+    sock.close()
+    return {
+        "ttft": first_data or 0.0,
+        "total": time.time() - started,
+        "bytes": received,
+        "recv_calls": recv_calls,
+    }
+
+
+def run_backend(window_ms, spark_url, port):
+    env = dict(os.environ)
+    env.update(
+        {
+            "SPARK_URL": spark_url,
+            "SPARK_APP_ID": env.get("SPARK_APP_ID") or "bench",
+            "SPARK_API_KEY": env.get("SPARK_API_KEY") or "bench",
+            "SPARK_API_SECRET": env.get("SPARK_API_SECRET") or "bench",
+            "SPARK_SSE_COALESCE_MS": str(window_ms),
+            "SPARK_PROFILE_TOKEN": DEBUG_TOKEN,
+            "SPARK_SESSION_KEYS": f"{SESSION_KEY[0]}:{SESSION_KEY[1].decode()}",
+            "PORT": str(port),
+        }
+    )
+    return subprocess.Popen(
+        [sys.executable, os.path.join(BASE_DIR, "spark_server.py")],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=400)
+    parser.add_argument("--delay-ms", type=float, default=5)
+    parser.add_argument("--ttft-ms", type=float, default=200)
+    parser.add_argument("--windows", default="0,40", help="逗号分隔的 SPARK_SSE_COALESCE_MS 取值")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    simulator = SparkSimulator(
+        config=SimulatorConfig(
+            ttft=args.ttft_ms / 1000.0,
+            token_delay=args.delay_ms / 1000.0,
+            chars_per_frame=1,
+            chat_tokens=args.tokens,
+            jitter=0.0,
+        )
+    ).start()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    token, _ = SessionSigner(dict([SESSION_KEY]), 3600).issue("bench", [])
+    print(f"{'window_ms':>9} {'sse_writes':>10} {'sse_bytes':>9} {'wire_bytes':>10} {'recv_calls':>10} {'ttft_ms':>8} {'total_ms':>8}")
+    for window in [int(x) for x in args.windows.split(",") if x.strip()]:
+        proc = run_backend(window, simulator.url, args.port)
+        try:
+            _wait_ready(base_url)
+            for _ in range(args.runs):
+                events_before = _metric_total(base_url, "sse_events_total")
+                bytes_before = _metric_total(base_url, "sse_bytes_total")
+                result = _stream_once("127.0.0.1", args.port, token)
+                events = _metric_total(base_url, "sse_events_total") - events_before
+                sse_bytes = _metric_total(base_url, "sse_bytes_total") - bytes_before
+                print(
+                    f"{window:>9} {events:>10} {sse_bytes:>9} {result['bytes']:>10} {result['recv_calls']:>10} "
+                    f"{result['ttft'] * 1000:>8.1f} {result['total'] * 1000:>8.1f}"
+                )
+        finally:
+            proc.terminate()
+            proc.wait(timeout=10)
+    simulator.shutdown()
+
+
+if __name__ == "__main__":
+    main()
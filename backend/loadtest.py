@@ -0,0 +1,246 @@
+"""后端压测驱动：对所有依赖 Spark 的接口并发施压，输出吞吐与延迟分位数。
+
+先启动模拟器与指向它的后端（见 spark_simulator.py；压测全部来自同一 IP，后端需设 SPARK_RATE_LIMIT=0），再运行：
+
+    python loadtest.py --base-url http://127.0.0.1:8000 --requests 200 --concurrency 16
+
+默认覆盖 chat、stream、title、draw、cast，可用 --endpoints 选择。为了每次都走到 Spark：
+标题请求的文本带序号以绕过标题缓存，抽卡请求每次使用新建的档案（建档不计入耗时）。
+所有请求带注册时拿到的会话令牌；新建档案后改用响应头 X-Session-Token 中包含该档案的令牌。
+stream 额外统计首个 data 事件的到达时间（TTFT）。
+"""
+import argparse
+import http.client
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+ENDPOINTS = ("chat", "stream", "title", "draw", "cast")
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Client:
+    def __init__(self, base_url, timeout):
+        parsed = urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.timeout = timeout
+
+    def _connection(self):
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    @staticmethod
+    def _headers(token):
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        return headers
+
+    def post_json(self, path, body, token=None):
+        """返回 (status, 响应体, 响应头 X-Session-Token)。"""
+        conn = self._connection()
+        try:
+            conn.request("POST", path, json.dumps(body), self._headers(token))
+            resp = conn.getresponse()
+            data = resp.read()
+            return resp.status, data, resp.getheader("X-Session-Token")
+        finally:
+            conn.close()
+
+    def post_stream(self, path, body, token=None):
+        """返回 (status, 首个 data 事件耗时, 是否收到 done 事件)。"""
+        started = time.perf_counter()
+        conn = self._connection()
+        try:
+            conn.request("POST", path, json.dumps(body), self._headers(token))
+            resp = conn.getresponse()
+            if resp.status != 200:
+                resp.read()
+                return resp.status, None, False
+            first_data = None
+            done = False
+            while True:
+                line = resp.readline()
+                if not line:
+                    break
+                if first_data is None and line.startswith(b"data: "):
+                    first_data = time.perf_counter() - started
+                if line.startswith(b"event: done"):
+                    done = True
+                if line.startswith(b"event: error"):
+                    break
+            return resp.status, first_data, done
+        finally:
+            conn.close()
+
+
+class LoadTest:
+    def __init__(self, client, user_id, token):
+        self.client = client
+        self.user_id = user_id
+        self.token = token
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.cast_profile, self.token = self.create_profile()
+
+    def next_seq(self):
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def create_profile(self):
+        """新建档案，返回 (档案 id, 包含该档案的会话令牌)。"""
+        profile_id = str(uuid.uuid4())
+        status, data, token = self.client.post_json(
+            "/profiles",
+            {
+                "id": profile_id,
+                "userId": self.user_id,
+                "name": "压测用户",
+                "gender": "女",
+                "solar": "1990-05-01 08:30",
+                "location": "北京市朝阳区",
+                "locationProvince": "北京市",
+                "locationCity": "北京市",
+                "locationDistrict": "朝阳区",
+                "latitude": 39.92,
+                "longitude": 116.44,
+                "timezoneId": "Asia/Shanghai",
+            },
+            token=self.token,
+        )
+        if status != 200:
+            raise RuntimeError(f"create profile failed: {status} {data[:200]!r}")
+        return profile_id, token or self.token
+
+    def run_one(self, endpoint):
+        """执行一次请求，返回 (ok, 耗时, ttft)。"""
+        seq = self.next_seq()
+        if endpoint == "draw":
+            # 并发建档各自拿到的新令牌只包含自己的新档案，抽卡用这次建档返回的令牌。
+            profile_id, draw_token = self.create_profile()
+        started = time.perf_counter()
+        ttft = None
+        if endpoint == "chat":
+            status, _, _ = self.client.post_json(
+                "/spark/chat", {"messages": [{"role": "user", "content": f"帮我看看今年的运势（{seq}）"}]}, self.token
+            )
+            ok = status == 200
+        elif endpoint == "stream":
+            status, ttft, done = self.client.post_stream(
+                "/spark/chat/stream", {"messages": [{"role": "user", "content": f"帮我看看今年的运势（{seq}）"}]}, self.token
+            )
+            ok = status == 200 and done
+        elif endpoint == "title":
+            status, _, _ = self.client.post_json(
+                "/spark/title", {"text": f"压测开场白第{seq}条：最近工作怎么样"}, self.token
+            )
+            ok = status == 200
+        elif endpoint == "draw":
+            status, _, _ = self.client.post_json("/draws/daily", {"profileId": profile_id}, draw_token)
+            ok = status == 200
+        else:
+            status, _, _ = self.client.post_json(
+                "/one-thing/cast",
+                {
+                    "profileId": self.cast_profile,
+                    "question": f"这次面试能否顺利（{seq}）",
+                    "tosses": [[random.choice("正反") for _ in range(3)] for _ in range(6)],
+                },
+                self.token,
+            )
+            ok = status == 200
+        return ok, time.perf_counter() - started, ttft
+
+
+def register_user(client):
+    """注册压测用户，返回 (用户 id, 会话令牌)。"""
+    phone = "199" + "".join(random.choice("0123456789") for _ in range(8))
+    status, data, _ = client.post_json(
+        "/auth/register", {"phone": phone, "nickname": "loadtest", "password": "loadtest123"}
+    )
+    if status != 200:
+        raise RuntimeError(f"register failed: {status} {data[:200]!r}")
+    body = json.loads(data)
+    return body["user"]["id"], body["token"]
+
+
+def run_endpoint(test, endpoint, requests, concurrency):
+    latencies = []
+    ttfts = []
+    errors = 0
+
+    def attempt(_):
+        try:
+            return test.run_one(endpoint)
+        except (OSError, http.client.HTTPException, RuntimeError):
+            return False, 0.0, None
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for ok, latency, ttft in executor.map(attempt, range(requests)):
+            if ok:
+                latencies.append(latency)
+                if ttft is not None:
+                    ttfts.append(ttft)
+            else:
+                errors += 1
+    elapsed = time.perf_counter() - started
+    return {
+        "endpoint": endpoint,
+        "requests": requests,
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "ttft_p50": percentile(ttfts, 50) if ttfts else None,
+        "ttft_p99": percentile(ttfts, 99) if ttfts else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=100, help="每个接口的请求数")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    client = Client(args.base_url, args.timeout)
+    test = LoadTest(client, *register_user(client))
+    results = []
+    for endpoint in [item.strip() for item in args.endpoints.split(",") if item.strip()]:
+        if endpoint not in ENDPOINTS:
+            raise SystemExit(f"unknown endpoint: {endpoint}")
+        results.append(run_endpoint(test, endpoint, args.requests, args.concurrency))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'endpoint':<8} {'reqs':>5} {'errors':>6} {'rps':>7} {'p50_ms':>8} {'p90_ms':>8} {'p99_ms':>8} {'ttft50':>7} {'ttft99':>7}")
+    for row in results:
+        ttft50 = f"{row['ttft_p50'] * 1000:7.0f}" if row["ttft_p50"] is not None else f"{'-':>7}"
+        ttft99 = f"{row['ttft_p99'] * 1000:7.0f}" if row["ttft_p99"] is not None else f"{'-':>7}"
+        print(
+            f"{row['endpoint']:<8} {row['requests']:>5} {row['errors']:>6} {row['rps']:>7.1f} "
+            f"{row['p50'] * 1000:>8.0f} {row['p90'] * 1000:>8.0f} {row['p99'] * 1000:>8.0f} {ttft50} {ttft99}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""Redis 客户端、短信验证码存储与限流令牌桶：只依赖标准库，供 spark_server 使用，也可单独导入测试。"""
+import hashlib
+import hmac
+import select
+import socket
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisClient:
+    """极简 RESP2 客户端，只覆盖验证码与限流用到的命令（EVALSHA/EVAL 等）；每个线程一条连接。"""
+
+    def __init__(self, url, timeout=2.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._scripts = {}
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.sock = sock
+        self._local.reader = sock.makefile("rb")
+        if self.password:
+            self._roundtrip("AUTH", self.password)
+        if self.db:
+            self._roundtrip("SELECT", self.db)
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    @staticmethod
+    def _encode(args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def _roundtrip(self, *args):
+        self._local.sock.sendall(self._encode(args))
+        return self._read_reply()
+
+    @staticmethod
+    def _stale(sock):
+        """空闲连接上不应有可读数据；可读说明服务端已关闭（或回收）该连接，发送前就换一条。"""
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise RedisError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            data = self._local.reader.read(size + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            size = int(rest)
+            return None if size < 0 else [self._read_reply() for _ in range(size)]
+        raise RedisError(f"unexpected reply: {line!r}")
+
+    def execute(self, *args):
+        """只在命令发出之前的失败（建连、sendall 出错）时重连重试一次。
+
+        命令发出后等待应答时出错（读超时、连接被断开）不重试：服务端可能已经执行了命令，
+        重发会让校验验证码、取令牌这类脚本执行两次。此时关闭连接并把错误抛给调用方。
+        """
+        payload = self._encode(args)
+        for attempt in range(2):
+            sock = getattr(self._local, "sock", None)
+            if sock is not None and self._stale(sock):
+                self._close()
+            try:
+                if getattr(self._local, "sock", None) is None:
+                    self._connect()
+                self._local.sock.sendall(payload)
+                break
+            except OSError:
+                self._close()
+                if attempt:
+                    raise
+        try:
+            return self._read_reply()
+        except OSError:
+            self._close()
+            raise
+
+    def run_script(self, script, keys, args):
+        """执行 Lua 脚本：优先 EVALSHA，服务端没有缓存时退回 EVAL。"""
+        sha = self._scripts.get(script)
+        if sha is None:
+            sha = self._scripts[script] = hashlib.sha1(script.encode("utf-8")).hexdigest()
+        try:
+            return self.execute("EVALSHA", sha, len(keys), *keys, *args)
+        except RedisError as exc:
+            if not str(exc).startswith("NOSCRIPT"):
+                raise
+            return self.execute("EVAL", script, len(keys), *keys, *args)
+
+
+class MemoryCodeStore:
+    """单机验证码存储：每个手机号只保留最新一条验证码及其错误次数，过期即失效。"""
+
+    def __init__(self):
+        self._codes = {}
+        self._lock = threading.Lock()
+
+    def issue(self, phone, code, ttl):
+        now = time.time()
+        with self._lock:
+            if len(self._codes) > 10000:
+                self._codes = {k: v for k, v in self._codes.items() if v[1] > now}
+            self._codes[phone] = [code, now + ttl, 0]
+
+    def verify(self, phone, code, max_attempts):
+        """校验并消费验证码，返回 ok / invalid / locked；错误次数达到上限后验证码作废。"""
+        with self._lock:
+            entry = self._codes.get(phone)
+            if entry is None or entry[1] <= time.time():
+                self._codes.pop(phone, None)
+                return "invalid"
+            if hmac.compare_digest(entry[0].encode("utf-8"), code.encode("utf-8")):
+                del self._codes[phone]
+                return "ok"
+            entry[2] += 1
+            if entry[2] >= max_attempts:
+                del self._codes[phone]
+                return "locked"
+            return "invalid"
+
+
+class RedisCodeStore:
+    """多副本共享的验证码存储：验证码与错误次数存 Redis，校验与消费在一个 Lua 脚本里原子完成。"""
+
+    ISSUE_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('DEL', KEYS[2])
+return 1
+"""
+    VERIFY_SCRIPT = """
+local stored = redis.call('GET', KEYS[1])
+if not stored then return 0 end
+if stored == ARGV[1] then
+  redis.call('DEL', KEYS[1], KEYS[2])
+  return 1
+end
+local attempts = redis.call('INCR', KEYS[2])
+if attempts == 1 then
+  local ttl = redis.call('TTL', KEYS[1])
+  if ttl > 0 then redis.call('EXPIRE', KEYS[2], ttl) end
+end
+if attempts >= tonumber(ARGV[2]) then
+  redis.call('DEL', KEYS[1], KEYS[2])
+  return -1
+end
+return 0
+"""
+
+    def __init__(self, client, prefix="sms"):
+        self.client = client
+        self.prefix = prefix
+
+    def _keys(self, phone):
+        return [f"{self.prefix}:code:{phone}", f"{self.prefix}:attempts:{phone}"]
+
+    def issue(self, phone, code, ttl):
+        self.client.run_script(self.ISSUE_SCRIPT, self._keys(phone), [code, int(ttl)])
+
+    def verify(self, phone, code, max_attempts):
+        result = self.client.run_script(self.VERIFY_SCRIPT, self._keys(phone), [code, max_attempts])
+        return {1: "ok", -1: "locked"}.get(result, "invalid")
+
+
+class LocalTokenBuckets:
+    """进程内令牌桶，按 LRU 保留最多 max_keys 个桶；单实例部署时使用。"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate):
+        """取一个令牌，返回 (是否放行, 需等待的秒数)。"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+
+class RedisTokenBuckets:
+    """多副本共享的令牌桶：桶状态存 Redis 哈希，取令牌在 Lua 脚本里原子完成，时间取 Redis 服务端时钟。"""
+
+    TAKE_SCRIPT = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+if allowed == 1 then return {1, '0'} end
+return {0, tostring((1 - tokens) / rate)}
+"""
+
+    def __init__(self, client, prefix="ratelimit"):
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, key, burst, rate):
+        allowed, wait = self.client.run_script(self.TAKE_SCRIPT, [f"{self.prefix}:{key}"], [burst, rate])
+        return allowed == 1, float(wait)
@@ -0,0 +1,60 @@
+"""会话令牌的签发与校验：只依赖标准库，供 spark_server 使用，也可单独导入测试。"""
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+
+class SessionError(Exception):
+    pass
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64url_decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class SessionSigner:
+    """无状态会话令牌：v1.<kid>.<payload>.<HMAC-SHA256>，payload 携带用户 id 与可访问的档案 id。
+
+    keys 的第一个用于签发，其余只用于校验，轮换密钥时把新密钥放到最前，旧令牌在过期前仍然有效。
+    """
+
+    def __init__(self, keys, ttl):
+        self.keys = keys
+        self.active_kid = next(iter(keys))
+        self.ttl = ttl
+
+    def _sign(self, kid, message):
+        return hmac.new(self.keys[kid], message.encode("ascii"), hashlib.sha256).digest()
+
+    def issue(self, user_id, profile_ids, now=None):
+        issued_at = int(now or time.time())
+        claims = {"uid": str(user_id), "pids": sorted(str(pid) for pid in profile_ids), "iat": issued_at}
+        claims["exp"] = issued_at + self.ttl
+        body = _b64url(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+        message = f"v1.{self.active_kid}.{body}"
+        return f"{message}.{_b64url(self._sign(self.active_kid, message))}", claims["exp"]
+
+    def verify(self, token, now=None):
+        """校验签名与有效期，返回 claims；失败抛 SessionError。"""
+        parts = token.split(".")
+        if len(parts) != 4 or parts[0] != "v1" or parts[1] not in self.keys:
+            raise SessionError("invalid token")
+        message = ".".join(parts[:3])
+        try:
+            signature = _b64url_decode(parts[3])
+            claims = json.loads(_b64url_decode(parts[2]))
+        except (ValueError, TypeError) as exc:
+            raise SessionError("invalid token") from exc
+        if not hmac.compare_digest(signature, self._sign(parts[1], message)):
+            raise SessionError("invalid token")
+        if not isinstance(claims, dict) or not claims.get("uid"):
+            raise SessionError("invalid token")
+        if claims.get("exp", 0) < (now or time.time()):
+            raise SessionError("token expired")
+        return claims
@@ -0,0 +1,319 @@
+"""Spark 上游的流量控制与流式输出处理：只依赖标准库（及 telemetry），供 spark_server 使用，也可单独导入测试。
+
+时间一律取自本模块的 time，测试可替换为可控的时钟。
+"""
+import heapq
+import itertools
+import json
+import math
+import threading
+import time
+
+from telemetry import metric_inc, metric_observe, metric_set, trace_span
+
+
+class SparkBusy(Exception):
+    status_code = 503
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SparkOverloaded(SparkBusy):
+    status_code = 429
+
+
+class SparkUnavailable(SparkBusy):
+    status_code = 503
+
+
+class SparkSlot:
+    def __init__(self, scheduler, use_case):
+        self.use_case = use_case
+        self._scheduler = scheduler
+        self._acquired_at = time.time()
+        self._released = False
+
+    def release(self):
+        self._scheduler._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class SparkScheduler:
+    """Spark 上游的全局并发闸门：超出并发上限的请求按优先级排队，队列满或等待超时即拒绝。
+
+    priorities 为 use_case -> 优先级，数字越小越先放行，未列出的用途按 1 处理。
+    """
+
+    def __init__(self, capacity, queue_size, max_wait, priorities=None):
+        self.capacity = max(1, capacity)
+        self.queue_size = max(0, queue_size)
+        self.max_wait = max_wait
+        self.priorities = priorities or {}
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._avg_hold = 5.0
+
+    def acquire(self, use_case):
+        with trace_span("spark.queue", use_case=use_case):
+            return self._acquire(use_case)
+
+    def _acquire(self, use_case):
+        priority = self.priorities.get(use_case, 1)
+        started = time.time()
+        with self._cond:
+            if self._active >= self.capacity or self._waiting:
+                if len(self._waiting) >= self.queue_size:
+                    metric_inc("spark_queue_shed_total", use_case=use_case, reason="full")
+                    raise SparkOverloaded("spark upstream busy", self._retry_after())
+                ticket = (priority, next(self._seq))
+                heapq.heappush(self._waiting, ticket)
+                metric_set("spark_queue_depth", len(self._waiting))
+                deadline = started + self.max_wait
+                while self._waiting[0] != ticket or self._active >= self.capacity:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._waiting.remove(ticket)
+                        heapq.heapify(self._waiting)
+                        metric_set("spark_queue_depth", len(self._waiting))
+                        metric_inc("spark_queue_shed_total", use_case=use_case, reason="timeout")
+                        self._cond.notify_all()
+                        raise SparkOverloaded("spark upstream busy", self._retry_after())
+                    self._cond.wait(remaining)
+                heapq.heappop(self._waiting)
+                metric_set("spark_queue_depth", len(self._waiting))
+                self._cond.notify_all()
+            self._active += 1
+            metric_set("spark_inflight", self._active)
+        metric_observe("spark_queue_wait_seconds", time.time() - started, use_case=use_case)
+        return SparkSlot(self, use_case)
+
+    def _release(self, slot):
+        with self._cond:
+            if slot._released:
+                return
+            slot._released = True
+            held = time.time() - slot._acquired_at
+            self._avg_hold = self._avg_hold * 0.9 + held * 0.1
+            self._active -= 1
+            metric_set("spark_inflight", self._active)
+            self._cond.notify_all()
+
+    def _retry_after(self):
+        backlog = len(self._waiting) + 1
+        return max(1, int(math.ceil(self._avg_hold * backlog / self.capacity)))
+
+
+class CircuitBreaker:
+    """Spark 熔断器：closed 正常放行；连续失败达到阈值后 open，直接快速失败；
+    冷却结束进入 half_open，只放行一个试探请求，成功则关闭、失败则重新打开。
+
+    log 为结构化日志（AsyncLogger），记录状态切换；缺省不记。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, failure_threshold, reset_timeout, log=None):
+        self.name = name
+        self.log = log
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._last_error = ""
+        metric_set("circuit_breaker_state", 0, breaker=name)
+
+    def _transition(self, state):
+        self._state = state
+        metric_set("circuit_breaker_state", self._STATE_VALUES[state], breaker=self.name)
+        metric_inc("circuit_breaker_transitions_total", breaker=self.name, to=state)
+        if self.log is not None:
+            self.log.log("warning" if state == "open" else "info", "breaker.transition", breaker=self.name, state=state)
+
+    def _reject(self, retry_after):
+        metric_inc("circuit_breaker_rejected_total", breaker=self.name)
+        raise SparkUnavailable(f"{self.name} circuit open", max(1, int(math.ceil(retry_after))))
+
+    def check(self):
+        """仅做快速失败判断，不占用 half_open 的试探名额。"""
+        with self._lock:
+            if self._state == self.OPEN:
+                remaining = self.reset_timeout - (time.time() - self._opened_at)
+                if remaining > 0:
+                    self._reject(remaining)
+
+    def before_call(self):
+        """放行则返回是否为 half_open 的试探请求；否则抛出 SparkUnavailable。"""
+        with self._lock:
+            if self._state == self.OPEN:
+                remaining = self.reset_timeout - (time.time() - self._opened_at)
+                if remaining > 0:
+                    self._reject(remaining)
+                self._transition(self.HALF_OPEN)
+            if self._state == self.HALF_OPEN:
+                if self._trial_in_flight:
+                    self._reject(1)
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            if self._state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def record_failure(self, exc):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            self._last_error = str(exc)
+            metric_inc("circuit_breaker_failures_total", breaker=self.name)
+            if self._state == self.HALF_OPEN or (
+                self._state == self.CLOSED and self._failures >= self.failure_threshold
+            ):
+                self._opened_at = time.time()
+                self._transition(self.OPEN)
+
+    def record_abandoned(self):
+        """调用方提前放弃（取消、对冲落败）时归还试探名额，不计成败。"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def snapshot(self):
+        with self._lock:
+            remaining = 0.0
+            if self._state == self.OPEN:
+                remaining = max(0.0, self.reset_timeout - (time.time() - self._opened_at))
+            return {
+                "name": self.name,
+                "state": self._state,
+                "consecutiveFailures": self._failures,
+                "failureThreshold": self.failure_threshold,
+                "resetTimeout": self.reset_timeout,
+                "openRemaining": round(remaining, 3),
+                "trialInFlight": self._trial_in_flight,
+                "lastError": self._last_error,
+            }
+
+
+class JsonObjectScanner:
+    """增量扫描模型输出：识别首个顶层 JSON 对象何时完整闭合，并提供已完成的顶层字段。"""
+
+    def __init__(self):
+        self.text = ""
+        self.result = None
+        self.failed = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._last_member_end = 0
+        self._partial_at = 0
+        self._partial = {}
+
+    def feed(self, chunk):
+        """追加一段输出；对象闭合且可解析时返回解析结果，否则返回 None。"""
+        if self.result is not None or self.failed or not chunk:
+            return self.result
+        if not self.text:
+            start = chunk.find("{")
+            if start < 0:
+                return None
+            chunk = chunk[start:]
+        offset = len(self.text)
+        self.text += chunk
+        for index in range(offset, len(self.text)):
+            ch = self.text[index]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.text = self.text[:index + 1]
+                    try:
+                        self.result = json.loads(self.text)
+                    except json.JSONDecodeError:
+                        self.failed = True
+                        return None
+                    return self.result
+            elif ch == "," and self._depth == 1:
+                self._last_member_end = index
+        return None
+
+    def partial(self):
+        """返回目前已完整输出的顶层字段（按最后一个顶层逗号截断后补齐右括号）。"""
+        if self.result is not None:
+            return self.result if isinstance(self.result, dict) else {}
+        if self._last_member_end and self._last_member_end != self._partial_at:
+            self._partial_at = self._last_member_end
+            try:
+                self._partial = json.loads(self.text[:self._last_member_end] + "}")
+            except json.JSONDecodeError:
+                pass
+        return self._partial
+
+
+class SSECoalescer:
+    """合并 Spark 的细碎帧以减少 SSE 写次数：首个片段立即发送，
+    之后在时间窗到期、累计字节达到阈值或遇到句末标点时一次性刷新。"""
+
+    SENTENCE_ENDS = ("。", "！", "？", "!", "?", "；", ";", "…", "\n")
+
+    def __init__(self, window_seconds, max_bytes):
+        self.window = max(0.0, window_seconds)
+        self.max_bytes = max_bytes
+        self._parts = []
+        self._size = 0
+        self._since = None
+        self._first_sent = False
+
+    def push(self, chunk, now):
+        """加入一个片段，需要刷新时返回合并后的文本，否则返回 None。"""
+        if self.window <= 0 or not self._first_sent:
+            self._first_sent = True
+            return chunk
+        self._parts.append(chunk)
+        self._size += len(chunk.encode("utf-8"))
+        if self._since is None:
+            self._since = now
+        if self._size >= self.max_bytes or chunk.rstrip(" ").endswith(self.SENTENCE_ENDS):
+            return self.flush()
+        return self.poll(now)
+
+    def poll(self, now):
+        if self._parts and now - self._since >= self.window:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        self._since = None
+        return text
@@ -1,25 +1,73 @@
+import atexit
 import base64
+import functools
+import gzip
 import hashlib
 import hmac
 import json
+import math
 import os
+import queue
 import random
+import re
+import select
 import socket
 import ssl
+import sys
+import threading
 import time
-from datetime import datetime, timezone
+import unicodedata
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from time import mktime
 from urllib.parse import urlencode, urlparse
 from urllib.parse import quote
 from urllib.request import Request, urlopen
 from zoneinfo import ZoneInfo
 from wsgiref.handlers import format_date_time
-from flask import Flask, Response, jsonify, request, stream_with_context
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 import websocket
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.sql
 from dotenv import load_dotenv
 
+from redis_store import (
+    LocalTokenBuckets,
+    MemoryCodeStore,
+    RedisClient,
+    RedisCodeStore,
+    RedisError,
+    RedisTokenBuckets,
+)
+from session_token import SessionError, SessionSigner
+from spark_flow import CircuitBreaker, JsonObjectScanner, SparkBusy, SparkScheduler, SSECoalescer
+from telemetry import (
+    NOOP_SPAN,
+    AsyncLogger,
+    Tracer,
+    _current_span,
+    current_span,
+    metric_inc,
+    metric_observe,
+    metric_set,
+    metrics_prometheus,
+    metrics_snapshot,
+    run_with_span,
+    start_span,
+    trace_span,
+    traced,
+)
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖，缺失时 /locations 仅提供 gzip
+    brotli = None
+
 BASE_DIR = os.path.dirname(__file__)
 load_dotenv(os.path.join(BASE_DIR, ".env"))
 
@@ -87,6 +135,11 @@ TIANSHI_SYSTEM_PROMPTS = {
 
 SPARK_TITLE_PROMPT = "请基于用户的第一条消息生成一个不超过12个字的聊天标题，直接输出标题文本，不要加引号。"
 
+SPARK_SUMMARY_PROMPT = (
+    "你负责压缩命理咨询的对话历史。请把已有摘要与新增对话合并成不超过300字的中文摘要，"
+    "保留用户的基本情况、关心的问题、大师已给出的判断与建议，直接输出摘要正文。"
+)
+
 APP_ID = os.getenv("SPARK_APP_ID", "")
 API_KEY = os.getenv("SPARK_API_KEY", "")
 API_SECRET = os.getenv("SPARK_API_SECRET", "")
@@ -94,12 +147,140 @@ SPARK_URL = os.getenv("SPARK_URL", "wss://spark-api.xf-yun.com/v1/x1")
 SPARK_DOMAIN = os.getenv("SPARK_DOMAIN", "spark-x")
 SPARK_SYSTEM_PROMPT = os.getenv("SPARK_SYSTEM_PROMPT", SPARK_SYSTEM_PROMPT)
 SPARK_DEBUG_RESPONSE = os.getenv("SPARK_DEBUG_RESPONSE", "0") == "1"
+# 结构化日志：级别（debug/info/warning/error，SPARK_DEBUG_RESPONSE=1 时默认 debug）、队列容量、
+# debug 日志采样比例、单个字段最大字符数
+SPARK_LOG_LEVEL = os.getenv("SPARK_LOG_LEVEL", "debug" if SPARK_DEBUG_RESPONSE else "info").lower()
+SPARK_LOG_QUEUE_SIZE = int(os.getenv("SPARK_LOG_QUEUE_SIZE", "10000"))
+SPARK_LOG_DEBUG_SAMPLE = float(os.getenv("SPARK_LOG_DEBUG_SAMPLE", "1"))
+SPARK_LOG_MAX_CHARS = int(os.getenv("SPARK_LOG_MAX_CHARS", "500"))
+# 签名 URL 复用时长（秒）；讯飞要求 date 与服务端时间偏差不超过 300 秒
+SPARK_SIGNATURE_TTL = min(int(os.getenv("SPARK_SIGNATURE_TTL", "60")), 240)
+# 预握手 WebSocket 连接池：0 表示关闭
+SPARK_POOL_SIZE = int(os.getenv("SPARK_POOL_SIZE", "2"))
+SPARK_POOL_MAX_AGE = float(os.getenv("SPARK_POOL_MAX_AGE", "8"))
+# 距上次取连接超过该时长（秒）后停止补充连接，避免无流量时持续握手
+SPARK_POOL_IDLE_TIMEOUT = float(os.getenv("SPARK_POOL_IDLE_TIMEOUT", "60"))
+# 上游调度：并发上限、排队长度与最长排队等待（秒）
+SPARK_MAX_CONCURRENCY = int(os.getenv("SPARK_MAX_CONCURRENCY", "16"))
+SPARK_QUEUE_SIZE = int(os.getenv("SPARK_QUEUE_SIZE", "64"))
+SPARK_QUEUE_MAX_WAIT = float(os.getenv("SPARK_QUEUE_MAX_WAIT", "10"))
+# 熔断：连续失败次数阈值与打开后的冷却秒数；对冲请求延迟（秒，0 表示关闭）
+SPARK_BREAKER_FAILURES = int(os.getenv("SPARK_BREAKER_FAILURES", "5"))
+SPARK_BREAKER_RESET = float(os.getenv("SPARK_BREAKER_RESET", "30"))
+SPARK_HEDGE_DELAY = float(os.getenv("SPARK_HEDGE_DELAY", "0"))
+# 内存中缓存的活跃会话数
+SPARK_CONVERSATION_CACHE = int(os.getenv("SPARK_CONVERSATION_CACHE", "512"))
+# 历史压缩：超出 token 预算时，最近 N 轮原样保留，更早的轮次替换为滚动摘要
+SPARK_HISTORY_TOKEN_BUDGET = int(os.getenv("SPARK_HISTORY_TOKEN_BUDGET", "6000"))
+SPARK_HISTORY_KEEP_TURNS = int(os.getenv("SPARK_HISTORY_KEEP_TURNS", "6"))
+# system 提示词缓存：提示词中的时间按该粒度（秒）取整，同一时间桶内复用
+SPARK_PROMPT_TIME_BUCKET = int(os.getenv("SPARK_PROMPT_TIME_BUCKET", "60"))
+SPARK_PROMPT_CACHE_SIZE = int(os.getenv("SPARK_PROMPT_CACHE_SIZE", "1024"))
+# 聊天标题缓存：按归一化后的首条消息缓存，内存 LRU 容量；为 1 时另存 title_cache 表，跨重启/实例共享
+SPARK_TITLE_CACHE_SIZE = int(os.getenv("SPARK_TITLE_CACHE_SIZE", "2048"))
+SPARK_TITLE_CACHE_PERSIST = os.getenv("SPARK_TITLE_CACHE_PERSIST", "1") == "1"
+# 超过该长度（归一化后字符数）的首条消息几乎不会重复，不进缓存
+SPARK_TITLE_CACHE_MAX_CHARS = int(os.getenv("SPARK_TITLE_CACHE_MAX_CHARS", "200"))
+# 抽卡预生成（仅 worker 进程）：扫描间隔（秒，0 为关闭）、提前于当地零点的分钟数、活跃档案的回看天数；
+# 当地时间早于 CATCHUP_HOUR 点时也补齐当天缺失的抽卡。生成并发由 SPARK_JOB_DRAW_CONCURRENCY 控制
+SPARK_DRAW_PRECOMPUTE_INTERVAL = float(os.getenv("SPARK_DRAW_PRECOMPUTE_INTERVAL", "0"))
+SPARK_DRAW_PRECOMPUTE_LEAD_MINUTES = int(os.getenv("SPARK_DRAW_PRECOMPUTE_LEAD_MINUTES", "120"))
+SPARK_DRAW_PRECOMPUTE_ACTIVE_DAYS = int(os.getenv("SPARK_DRAW_PRECOMPUTE_ACTIVE_DAYS", "7"))
+SPARK_DRAW_PRECOMPUTE_CATCHUP_HOUR = int(os.getenv("SPARK_DRAW_PRECOMPUTE_CATCHUP_HOUR", "6"))
+# 任务队列 worker：线程数、空闲轮询间隔（秒）、失败重试退避的基数与上限（秒）、已结束任务保留天数
+SPARK_JOB_WORKER_THREADS = int(os.getenv("SPARK_JOB_WORKER_THREADS", "4"))
+SPARK_JOB_POLL_INTERVAL = float(os.getenv("SPARK_JOB_POLL_INTERVAL", "1"))
+SPARK_JOB_BACKOFF_BASE = float(os.getenv("SPARK_JOB_BACKOFF_BASE", "5"))
+SPARK_JOB_BACKOFF_MAX = float(os.getenv("SPARK_JOB_BACKOFF_MAX", "600"))
+SPARK_JOB_RETENTION_DAYS = int(os.getenv("SPARK_JOB_RETENTION_DAYS", "7"))
+# 过期验证码的保留时长（小时）与每批删除行数，由任务 worker 定期清理
+SPARK_SMS_RETENTION_HOURS = float(os.getenv("SPARK_SMS_RETENTION_HOURS", "24"))
+SPARK_SMS_PURGE_BATCH = int(os.getenv("SPARK_SMS_PURGE_BATCH", "5000"))
+# SSE 输出合并：时间窗（毫秒，0 表示逐帧发送）与字节阈值
+SPARK_SSE_COALESCE_MS = int(os.getenv("SPARK_SSE_COALESCE_MS", "40"))
+SPARK_SSE_COALESCE_BYTES = int(os.getenv("SPARK_SSE_COALESCE_BYTES", "512"))
+# 流式对话检查客户端断开与取消请求的间隔（秒）
+SPARK_STREAM_POLL_INTERVAL = float(os.getenv("SPARK_STREAM_POLL_INTERVAL", "1"))
+# 流式续传：每个流保留的事件数、结束后保留时长（秒）、无客户端连接时继续生成的宽限期（秒）
+SPARK_STREAM_REPLAY_EVENTS = int(os.getenv("SPARK_STREAM_REPLAY_EVENTS", "1024"))
+SPARK_STREAM_REPLAY_TTL = float(os.getenv("SPARK_STREAM_REPLAY_TTL", "60"))
+SPARK_STREAM_RESUME_GRACE = float(os.getenv("SPARK_STREAM_RESUME_GRACE", "15"))
+# 请求追踪：span 写入的 JSON Lines 文件（留空关闭）与采样比例；带 traceparent 且已采样的请求总会被记录
+SPARK_TRACE_FILE = os.getenv("SPARK_TRACE_FILE", "")
+SPARK_TRACE_SAMPLE = float(os.getenv("SPARK_TRACE_SAMPLE", "0.01"))
+# 按需采样剖析：请求头 X-Debug-Profile 与该令牌一致时对本次请求做栈采样（留空关闭）
+SPARK_PROFILE_TOKEN = os.getenv("SPARK_PROFILE_TOKEN", "")
+SPARK_PROFILE_INTERVAL_MS = float(os.getenv("SPARK_PROFILE_INTERVAL_MS", "5"))
+SPARK_PROFILE_DIR = os.getenv("SPARK_PROFILE_DIR", "profiles")
+# 数据库插桩：慢查询阈值（毫秒）；执行计划采样比例（0 关闭）、只采样耗时不低于该值（毫秒）的语句、
+# 同一语句的最短采样间隔（秒）与 EXPLAIN 的超时（秒）
+SPARK_DB_SLOW_MS = float(os.getenv("SPARK_DB_SLOW_MS", "200"))
+SPARK_DB_EXPLAIN_SAMPLE = float(os.getenv("SPARK_DB_EXPLAIN_SAMPLE", "0"))
+SPARK_DB_EXPLAIN_MIN_MS = float(os.getenv("SPARK_DB_EXPLAIN_MIN_MS", "50"))
+SPARK_DB_EXPLAIN_INTERVAL = float(os.getenv("SPARK_DB_EXPLAIN_INTERVAL", "3600"))
+SPARK_DB_EXPLAIN_TIMEOUT = float(os.getenv("SPARK_DB_EXPLAIN_TIMEOUT", "10"))
+# 共享 Redis（redis://[:password@]host:port/db）；未配置时验证码等短期数据只存本进程内存
+REDIS_URL = os.getenv("REDIS_URL", "")
+# 验证码有效期（秒）与允许的错误次数，超过后该验证码作废
+SMS_CODE_TTL = int(os.getenv("SMS_CODE_TTL", "300"))
+SMS_CODE_MAX_ATTEMPTS = int(os.getenv("SMS_CODE_MAX_ATTEMPTS", "5"))
+# 接口限流开关（规则见 RATE_LIMIT_RULES）；SPARK_TRUST_PROXY 为后端前面可信反向代理的层数，
+# 大于 0 时从 X-Forwarded-For 右数第该层取客户端 IP（更左边的条目由客户端自填，不可信）；直接对外暴露时保持 0
+SPARK_RATE_LIMIT = os.getenv("SPARK_RATE_LIMIT", "1") == "1"
+SPARK_TRUST_PROXY = int(os.getenv("SPARK_TRUST_PROXY", "0"))
+# 密码哈希（scrypt）：成本参数 N/r/p、哈希线程数与最多排队数（超出返回 503）；可用 bench_kdf.py 评估
+SPARK_KDF_N = int(os.getenv("SPARK_KDF_N", str(2 ** 15)))
+SPARK_KDF_R = int(os.getenv("SPARK_KDF_R", "8"))
+SPARK_KDF_P = int(os.getenv("SPARK_KDF_P", "1"))
+SPARK_KDF_WORKERS = int(os.getenv("SPARK_KDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+SPARK_KDF_QUEUE = int(os.getenv("SPARK_KDF_QUEUE", "16"))
+# 会话令牌签名密钥 kid:secret，逗号分隔，第一个用于签发；有效期（秒）；是否强制校验请求中的 userId/profileId
+SPARK_SESSION_KEYS = os.getenv("SPARK_SESSION_KEYS", "")
+SPARK_SESSION_TTL = int(os.getenv("SPARK_SESSION_TTL", str(30 * 24 * 3600)))
 AMAP_API_KEY = os.getenv("AMAP_API_KEY", "dcac0625f0725b9683338027fe890aa4")
 AMAP_SECURITY_KEY = os.getenv("AMAP_SECURITY_KEY", "")
 AMAP_PLACE_TEXT_URL = "https://restapi.amap.com/v5/place/text"
 NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
 
 
+def _generation_profile(
+    name, url=None, domain=None, max_tokens=4096, temperature=0.5, top_k=5, web_search=False, thinking=""
+):
+    # 每个档位都可用 SPARK_GEN_<NAME>_<FIELD> 覆盖，例如 SPARK_GEN_TITLE_MAX_TOKENS=256
+    # thinking 对应 x1 的 parameter.chat.thinking.type（enabled/disabled/auto），留空则不下发，用模型默认行为
+    prefix = f"SPARK_GEN_{name.upper()}_"
+    return {
+        "url": os.getenv(prefix + "URL", url or SPARK_URL),
+        "domain": os.getenv(prefix + "DOMAIN", domain or SPARK_DOMAIN),
+        "max_tokens": int(os.getenv(prefix + "MAX_TOKENS", str(max_tokens))),
+        "temperature": float(os.getenv(prefix + "TEMPERATURE", str(temperature))),
+        "top_k": int(os.getenv(prefix + "TOP_K", str(top_k))),
+        "web_search": os.getenv(prefix + "WEB_SEARCH", "1" if web_search else "0") == "1",
+        "thinking": os.getenv(prefix + "THINKING", thinking),
+    }
+
+
+# 按用途区分的生成参数：短小的结构化任务不开联网搜索、关闭深度思考。
+# 默认的 x1 是推理模型，思考过程的 token 可能计入 max_tokens，预算过小会截断甚至输出为空，
+# 因此短任务的预算按“关闭思考后仍留足余量”设置，而不是按最终输出长度卡死。
+SPARK_GENERATION_PROFILES = {
+    "chat": _generation_profile("chat", max_tokens=4096, temperature=0.5, top_k=5, web_search=True),
+    "title": _generation_profile("title", max_tokens=256, temperature=0.3, top_k=1, thinking="disabled"),
+    "draw": _generation_profile("draw", max_tokens=2048, temperature=0.8, top_k=5, thinking="disabled"),
+    "liuyao": _generation_profile("liuyao", max_tokens=2048, temperature=0.5, top_k=4, thinking="disabled"),
+    "summary": _generation_profile("summary", max_tokens=1024, temperature=0.3, top_k=3, thinking="disabled"),
+}
+SPARK_USE_CASE_GENERATION = {
+    "chat": "chat",
+    "stream": "chat",
+    "title": "title",
+    "draw": "draw",
+    "draw_precompute": "draw",
+    "cast": "liuyao",
+    "summary": "summary",
+}
+
+
 app = Flask(__name__)
 LOCATION_FILE = os.path.join(BASE_DIR, "locations.json")
 PROFILE_FILE = os.path.join(BASE_DIR, "profiles.json")
@@ -122,8 +303,276 @@ OSS_CONFIG = {
 }
 
 
+LOG = AsyncLogger(SPARK_LOG_LEVEL, SPARK_LOG_QUEUE_SIZE, SPARK_LOG_DEBUG_SAMPLE, SPARK_LOG_MAX_CHARS)
+atexit.register(LOG.flush)
+
+
+def summarize_messages(messages):
+    """对话消息的日志摘要：只记录角色与长度，外加最后一条用户消息的开头。"""
+    last_user = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    return {
+        "count": len(messages),
+        "chars": sum(len(m.get("content") or "") for m in messages),
+        "roles": "".join((m.get("role") or "?")[0] for m in messages),
+        "lastUser": last_user[:80],
+    }
+
+
+TRACER = Tracer(SPARK_TRACE_FILE, SPARK_TRACE_SAMPLE, SPARK_LOG_QUEUE_SIZE)
+atexit.register(TRACER.flush)
+
+
+class SamplingProfiler:
+    """按固定间隔抓取请求线程的调用栈，结束时写出 folded stacks（flamegraph.pl / speedscope 可直接打开）。"""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._thread_id = threading.get_ident()
+        self._counts = {}
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._sampler.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self._counts[key] = self._counts.get(key, 0) + 1
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join(timeout=1)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as handle:
+            for stack, count in sorted(self._counts.items()):
+                handle.write(f"{stack} {count}\n")
+        LOG.info("profile.written", samples=sum(self._counts.values()), path=self.path)
+
+
+def db_timed(func):
+    """统计数据库辅助函数的耗时：db_query_seconds{helper=函数名}，采样的请求中同时记一个 span。"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with trace_span(f"db {func.__qualname__}"):
+                return func(*args, **kwargs)
+        except Exception:
+            metric_inc("db_errors_total", helper=func.__qualname__)
+            raise
+        finally:
+            metric_observe("db_query_seconds", time.perf_counter() - started, helper=func.__qualname__)
+
+    return wrapper
+
+
+_SQL_WHITESPACE = re.compile(r"\s+")
+_SQL_TABLE = re.compile(r"\b(?:from|into|update|join)\s+([a-z_][a-z0-9_]*)", re.I)
+_EXPLAINABLE = ("select", "with", "update", "delete")
+# 含写操作或行锁的语句只做不执行的 EXPLAIN，避免 ANALYZE 真正改数据、加锁或触发触发器
+_SQL_WRITES = re.compile(r"\b(?:insert|update|delete|merge)\b|\bfor\s+(?:update|share|no\s+key|key)\b", re.I)
+# 计划里 Filter / Index Cond 等条件带着实际参数（手机号、密码哈希等），落库前替换成 ?
+_PLAN_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_PLAN_NUMBER_LITERAL = re.compile(r"(?<![\w.$])-?\d+(?:\.\d+)?(?![\w.])")
+# execute_values 拼出的多行 VALUES 去掉常量后每行相同，折叠成一行
+_SQL_REPEATED_ROWS = re.compile(r"(\([^()]*\))(?:\s*,\s*\1)+")
+
+
+def statement_label(sql):
+    """把 SQL 模板归成低基数的标签，如 "select sms_codes"，用作指标维度。"""
+    words = sql.split(None, 1)
+    op = words[0].lower() if words else "?"
+    table = _SQL_TABLE.search(sql)
+    return f"{op} {table.group(1).lower()}" if table else op
+
+
+def scrub_sql(text):
+    """已内联参数的语句（execute_values 拼好的 bytes、sql.Composed）去掉常量并折叠重复的 VALUES 行，
+    得到与参数无关的模板，日志、指纹与落库都只用它。"""
+    text = _PLAN_NUMBER_LITERAL.sub("?", _PLAN_STRING_LITERAL.sub("'?'", text))
+    return _SQL_REPEATED_ROWS.sub(r"\1", text)
+
+
+def scrub_plan(node):
+    """把执行计划中条件表达式里的字符串与数字常量替换为 ?，只保留结构。"""
+    if isinstance(node, dict):
+        return {key: scrub_plan(value) for key, value in node.items()}
+    if isinstance(node, list):
+        return [scrub_plan(value) for value in node]
+    if isinstance(node, str):
+        return _PLAN_NUMBER_LITERAL.sub("?", _PLAN_STRING_LITERAL.sub("'?'", node))
+    return node
+
+
+class QueryPlanSampler:
+    """慢语句的执行计划采样：请求线程只入队，后台线程用独立连接取计划并回滚，
+    把去掉常量的计划写入 db_query_plans。
+
+    只读语句用 EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) 取实际行数与缓冲命中；写语句只用 EXPLAIN (FORMAT JSON)，
+    不会再执行一遍。同一条 SQL 模板在 interval 秒内只采一次；队列满时直接放弃本次采样。
+    """
+
+    def __init__(self, sample_rate, min_ms, interval, queue_size=64):
+        self.sample_rate = sample_rate
+        self.min_ms = min_ms
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._last = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def maybe_submit(self, cursor, query, params, duration_ms, template):
+        """query 与 params 为实际执行的语句，template 为去掉参数后的模板（见 _InstrumentedCursorMixin）。"""
+        if self.sample_rate <= 0 or duration_ms < self.min_ms or random.random() >= self.sample_rate:
+            return
+        if not template.lower().startswith(_EXPLAINABLE) or "db_query_plans" in template:
+            return
+        fingerprint = hashlib.sha1(template.encode("utf-8")).hexdigest()[:16]
+        now = time.time()
+        with self._lock:
+            if now - self._last.get(fingerprint, 0) < self.interval:
+                return
+            self._last[fingerprint] = now
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-explain", daemon=True)
+                self._thread.start()
+        try:
+            statement = cursor.mogrify(query, params).decode("utf-8")
+            self._queue.put_nowait((fingerprint, template, statement, duration_ms))
+        except (queue.Full, psycopg2.Error, ValueError, TypeError):
+            with self._lock:
+                self._last.pop(fingerprint, None)
+
+    def _run(self):
+        while True:
+            fingerprint, template, statement, duration_ms = self._queue.get()
+            try:
+                self._explain(fingerprint, template, statement, duration_ms)
+                metric_inc("db_explain_total", result="ok")
+            except Exception as exc:  # noqa: BLE001
+                # 采样线程只有一个，任何异常（连不上库、计划解析失败等）都不能让它退出。
+                metric_inc("db_explain_total", result="error")
+                LOG.warning("db.explain_failed", statement=statement_label(template), error=str(exc))
+
+    def _explain(self, fingerprint, template, statement, duration_ms):
+        # 用未插桩的连接，避免 EXPLAIN 本身再次进入采样。
+        conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = %s", (int(SPARK_DB_EXPLAIN_TIMEOUT * 1000),))
+                options = "FORMAT JSON" if _SQL_WRITES.search(template) else "ANALYZE, BUFFERS, FORMAT JSON"
+                cur.execute(f"EXPLAIN ({options}) " + statement)
+                plan = scrub_plan(cur.fetchone()[0])
+            # 只读语句的 ANALYZE 也可能调用有副作用的函数，一律回滚。
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO db_query_plans (fingerprint, statement, duration_ms, plan)
+                    VALUES (%s, %s, %s, %s)
+                    """,
+                    (fingerprint, template, duration_ms, json.dumps(plan)),
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+
+QUERY_PLANS = QueryPlanSampler(SPARK_DB_EXPLAIN_SAMPLE, SPARK_DB_EXPLAIN_MIN_MS, SPARK_DB_EXPLAIN_INTERVAL)
+
+
+class _InstrumentedCursorMixin:
+    """记录每条语句的耗时与行数（按 statement_label 聚合），超过阈值记慢查询日志并交给执行计划采样。"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(query, vars, time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(query, None, time.perf_counter() - started, explain=False)
+
+    def _record(self, query, params, elapsed, explain=True):
+        """query 可以是 str、bytes（如 execute_values 拼好的语句）或 sql.Composed。
+
+        后两种已经内联了参数，用 scrub_sql 去掉常量后再作为模板；executemany 的参数有多组，不做计划采样。
+        """
+        if isinstance(query, psycopg2.sql.Composable):
+            try:
+                query = query.as_string(self)
+            except psycopg2.Error:
+                return
+            inlined = True
+        elif isinstance(query, bytes):
+            query = query.decode("utf-8", "replace")
+            inlined = True
+        elif isinstance(query, str):
+            inlined = False
+        else:
+            return
+        template = _SQL_WHITESPACE.sub(" ", query).strip()
+        if inlined:
+            template = scrub_sql(template)
+        label = statement_label(template)
+        metric_observe("db_statement_seconds", elapsed, statement=label)
+        if self.rowcount > 0:
+            metric_inc("db_statement_rows_total", self.rowcount, statement=label)
+        duration_ms = elapsed * 1000
+        if duration_ms >= SPARK_DB_SLOW_MS:
+            metric_inc("db_slow_queries_total", statement=label)
+            LOG.warning(
+                "db.slow_query",
+                statement=label,
+                ms=round(duration_ms, 1),
+                rows=self.rowcount,
+                sql=template,
+            )
+        if explain:
+            QUERY_PLANS.maybe_submit(self, query, params, duration_ms, template)
+
+
+class InstrumentedCursor(_InstrumentedCursorMixin, psycopg2.extensions.cursor):
+    pass
+
+
+class InstrumentedRealDictCursor(_InstrumentedCursorMixin, psycopg2.extras.RealDictCursor):
+    pass
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """把默认游标与 RealDictCursor 换成插桩版本，调用处无需改动。"""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get("cursor_factory")
+        if factory is None:
+            kwargs["cursor_factory"] = InstrumentedCursor
+        elif factory is psycopg2.extras.RealDictCursor:
+            kwargs["cursor_factory"] = InstrumentedRealDictCursor
+        return super().cursor(*args, **kwargs)
+
+
 def get_db_conn():
-    return psycopg2.connect(**DB_CONFIG)
+    return psycopg2.connect(connection_factory=InstrumentedConnection, **DB_CONFIG)
+
+
+REDIS = RedisClient(REDIS_URL) if REDIS_URL else None
 
 
 def init_db():
@@ -153,6 +602,9 @@ def init_db():
                 );
                 """
             )
+            # 验证码已改存 SMS_CODES（内存或 Redis），该表只保留到 worker 清理完历史数据为止。
+            cur.execute("DROP INDEX IF EXISTS idx_sms_codes_lookup;")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_sms_codes_expires_at ON sms_codes (expires_at);")
             cur.execute(
                 """
                 CREATE TABLE IF NOT EXISTS profiles (
@@ -179,6 +631,12 @@ def init_db():
             cur.execute("ALTER TABLE profiles ADD COLUMN IF NOT EXISTS utc_offset_minutes integer;")
             cur.execute("ALTER TABLE profiles ADD COLUMN IF NOT EXISTS place_source text;")
             cur.execute("ALTER TABLE profiles ADD COLUMN IF NOT EXISTS location_adcode text;")
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_profiles_user_created_at
+                ON profiles (user_id, created_at DESC);
+                """
+            )
             cur.execute(
                 """
                 CREATE TABLE IF NOT EXISTS draws (
@@ -194,6 +652,8 @@ def init_db():
                 );
                 """
             )
+            # 预生成扫描“近 N 天有抽卡”的档案时按 created_at 取范围。
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_draws_created_at ON draws (created_at);")
             cur.execute(
                 """
                 CREATE TABLE IF NOT EXISTS one_thing_divinations (
@@ -234,28 +694,212 @@ def init_db():
                 ON one_thing_divinations (profile_id, started_at DESC);
                 """
             )
+            # 起卦请求的幂等键（见 cast_request_key）：重试或任务重跑时返回已存的记录而不是再写一条。
+            cur.execute("ALTER TABLE one_thing_divinations ADD COLUMN IF NOT EXISTS request_key text;")
+            cur.execute(
+                """
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_one_thing_request_key
+                ON one_thing_divinations (request_key)
+                WHERE request_key IS NOT NULL;
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chat_messages (
+                    id bigserial PRIMARY KEY,
+                    conversation_id uuid NOT NULL,
+                    seq integer NOT NULL,
+                    role text NOT NULL,
+                    content text NOT NULL,
+                    created_at timestamptz DEFAULT now(),
+                    UNIQUE (conversation_id, seq)
+                );
+                """
+            )
+            # 会话归属（user:<用户 id> / profile:<档案 id> / ip:<地址>），读取与续写时校验。
+            cur.execute("ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS owner text;")
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+                    job_type text NOT NULL,
+                    payload jsonb NOT NULL,
+                    status text NOT NULL DEFAULT 'queued',
+                    attempts integer NOT NULL DEFAULT 0,
+                    max_attempts integer NOT NULL DEFAULT 5,
+                    run_at timestamptz NOT NULL DEFAULT now(),
+                    locked_until timestamptz,
+                    locked_by text,
+                    dedupe_key text,
+                    result jsonb,
+                    last_error text,
+                    created_at timestamptz DEFAULT now(),
+                    updated_at timestamptz DEFAULT now()
+                );
+                """
+            )
+            # 任务归属（见 request_owner）：GET /jobs/<id> 只对归属方返回结果。
+            cur.execute("ALTER TABLE jobs ADD COLUMN IF NOT EXISTS owner text;")
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_jobs_claim
+                ON jobs (job_type, run_at)
+                WHERE status IN ('queued', 'running');
+                """
+            )
+            cur.execute(
+                """
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedupe
+                ON jobs (dedupe_key)
+                WHERE dedupe_key IS NOT NULL AND status IN ('queued', 'running');
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS title_cache (
+                    key_hash text PRIMARY KEY,
+                    title text NOT NULL,
+                    hits integer NOT NULL DEFAULT 0,
+                    created_at timestamptz DEFAULT now(),
+                    last_used_at timestamptz DEFAULT now()
+                );
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS db_query_plans (
+                    id bigserial PRIMARY KEY,
+                    fingerprint text NOT NULL,
+                    statement text NOT NULL,
+                    duration_ms double precision NOT NULL,
+                    plan jsonb NOT NULL,
+                    captured_at timestamptz DEFAULT now()
+                );
+                """
+            )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_db_query_plans_fingerprint
+                ON db_query_plans (fingerprint, captured_at DESC);
+                """
+            )
 
 
-def _hash_password(password, salt=None):
-    salt = salt or os.urandom(8).hex()
+class PasswordHasherBusy(Exception):
+    """哈希线程池排队已满；调用方返回 503，由客户端稍后重试。"""
+
+
+def _legacy_hash_password(password, salt):
+    # 早期格式 salt$sha256(salt + password)，只用于校验存量账户，登录成功后会被重新哈希。
     digest = hashlib.sha256((salt + password).encode("utf-8")).hexdigest()
     return f"{salt}${digest}"
 
 
-def _verify_password(password, stored):
-    if "$" not in stored:
-        return False
-    salt, _ = stored.split("$", 1)
-    return _hash_password(password, salt) == stored
+class PasswordHasher:
+    """scrypt 密码哈希，格式 scrypt$n$r$p$salt$hash。
+
+    scrypt 计算期间释放 GIL，放在独立的有界线程池里执行：请求线程只等待自己的结果，
+    排队超过 queue_limit 时立即拒绝，不会把其他接口的请求线程拖进长队。
+    """
+
+    def __init__(self, n, r, p, workers, queue_limit):
+        self.n, self.r, self.p = n, r, p
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(max(1, workers) + max(0, queue_limit))
+
+    def _scrypt(self, password, salt, n, r, p):
+        return hashlib.scrypt(
+            password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p + (1 << 20), dklen=32
+        )
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            metric_inc("password_hash_rejected_total")
+            raise PasswordHasherBusy("password hashing busy")
+        started = time.perf_counter()
+
+        def task():
+            try:
+                return func(*args)
+            finally:
+                self._slots.release()
+                metric_observe("password_hash_seconds", time.perf_counter() - started)
+
+        return self._executor.submit(task)
+
+    def _hash(self, password):
+        salt = os.urandom(16)
+        digest = self._scrypt(password, salt, self.n, self.r, self.p)
+        return f"scrypt${self.n}${self.r}${self.p}${salt.hex()}${digest.hex()}"
+
+    def _verify(self, password, stored):
+        parts = stored.split("$")
+        if len(parts) == 6 and parts[0] == "scrypt":
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            digest = self._scrypt(password, bytes.fromhex(parts[4]), n, r, p)
+            ok = hmac.compare_digest(digest.hex(), parts[5])
+            return ok, ok and (n, r, p) != (self.n, self.r, self.p)
+        if len(parts) == 2:
+            ok = hmac.compare_digest(_legacy_hash_password(password, parts[0]), stored)
+            return ok, ok
+        return False, False
+
+    def hash(self, password):
+        return self._run(self._hash, password).result()
+
+    def verify(self, password, stored):
+        """返回 (是否匹配, 是否需要按当前参数重新哈希)。"""
+        return self._run(self._verify, password, stored).result()
+
+    def rehash_later(self, user_id, password, old_hash):
+        """登录成功后在后台升级旧哈希；只在库里仍是旧值时覆盖，排队已满就留到下次登录。"""
+
+        def upgrade():
+            new_hash = self._hash(password)
+            with get_db_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE users SET password_hash = %s, updated_at = now() WHERE id = %s AND password_hash = %s",
+                        (new_hash, user_id, old_hash),
+                    )
+            metric_inc("password_rehash_total")
+
+        try:
+            self._run(upgrade)
+        except PasswordHasherBusy:
+            pass
+
+
+PASSWORD_HASHER = PasswordHasher(SPARK_KDF_N, SPARK_KDF_R, SPARK_KDF_P, SPARK_KDF_WORKERS, SPARK_KDF_QUEUE)
+
+
+def password_busy_response(exc):
+    return jsonify({"error": str(exc)}), 503, {"Retry-After": "1"}
 
 
 init_db()
 
-def create_signed_url():
+_signed_url_lock = threading.Lock()
+_signed_url_cache = {}
+
+
+def create_signed_url(base_url=None):
+    """返回签名后的 Spark URL；签名在 SPARK_SIGNATURE_TTL 内复用，避免每次请求重算 HMAC。"""
     if not APP_ID or not API_KEY or not API_SECRET:
         return None
-
-    parsed = urlparse(SPARK_URL)
+    base_url = base_url or SPARK_URL
+    now = time.time()
+    with _signed_url_lock:
+        cached = _signed_url_cache.get(base_url)
+        if cached and now < cached[1]:
+            return cached[0]
+        url = _sign_spark_url(base_url)
+        _signed_url_cache[base_url] = (url, now + SPARK_SIGNATURE_TTL)
+        return url
+
+
+def _sign_spark_url(base_url):
+    parsed = urlparse(base_url)
     host = parsed.netloc
     path = parsed.path
 
@@ -287,7 +931,282 @@ def create_signed_url():
             "host": host,
         }
     )
-    return f"{SPARK_URL}?{query}"
+    return f"{base_url}?{query}"
+
+
+def _connect_spark_ws(timeout, base_url=None):
+    ws_url = create_signed_url(base_url)
+    if not ws_url:
+        raise RuntimeError("missing spark credentials")
+    return websocket.create_connection(ws_url, timeout=timeout, sslopt={"cert_reqs": ssl.CERT_NONE})
+
+
+class SparkConnectionPool:
+    """预先完成 DNS/TCP/TLS/WebSocket 握手的 Spark 连接池。
+
+    讯飞每条连接只承载一次会话，因此连接取出即独占、用完关闭，由后台线程补足。
+    空闲超过 max_age 的连接被淘汰，保证池中连接的签名与链路都仍然有效。
+    距上次 acquire 超过 idle_timeout 后不再补充，直到下一次 acquire 重新唤醒。
+    """
+
+    def __init__(self, size, max_age, idle_timeout):
+        self.size = size
+        self.max_age = max_age
+        self.idle_timeout = idle_timeout
+        self._last_acquire = 0.0
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.size <= 0 or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="spark-pool", daemon=True)
+            self._thread.start()
+
+    def acquire(self):
+        """取出一条可用连接；池为空时返回 None，由调用方现连。"""
+        self.start()
+        now = time.time()
+        ws = None
+        stale = []
+        with self._lock:
+            self._last_acquire = now
+            while self._idle:
+                candidate, created_at = self._idle.popleft()
+                if now - created_at < self.max_age and candidate.connected:
+                    ws = candidate
+                    break
+                stale.append(candidate)
+            metric_set("spark_pool_idle", len(self._idle))
+        for item in stale:
+            self._close(item, "expired")
+        metric_inc("spark_pool_acquire_total", result="hit" if ws is not None else "miss")
+        self._wakeup.set()
+        return ws
+
+    def _evict_expired(self):
+        now = time.time()
+        expired = []
+        with self._lock:
+            while self._idle and now - self._idle[0][1] >= self.max_age:
+                expired.append(self._idle.popleft()[0])
+        for ws in expired:
+            self._close(ws, "expired")
+
+    def _close(self, ws, reason):
+        metric_inc("spark_pool_evicted_total", reason=reason)
+        try:
+            ws.close()
+        except Exception:
+            pass
+
+    def _wanted(self):
+        with self._lock:
+            if time.time() - self._last_acquire > self.idle_timeout:
+                return 0
+            return self.size - len(self._idle)
+
+    def _run(self):
+        backoff = 1.0
+        while True:
+            self._evict_expired()
+            wait = None
+            try:
+                while self._wanted() > 0:
+                    started = time.time()
+                    ws = _connect_spark_ws(timeout=15)
+                    metric_observe("spark_connect_seconds", time.time() - started, pooled="1")
+                    with self._lock:
+                        self._idle.append((ws, time.time()))
+                        metric_set("spark_pool_idle", len(self._idle))
+                backoff = 1.0
+                with self._lock:
+                    if self._idle:
+                        # 还有连接要按 max_age 淘汰；池已空且无流量时一直睡到下次 acquire。
+                        wait = self.max_age / 2
+            except Exception as exc:  # noqa: BLE001
+                LOG.warning("spark_pool.refill_failed", error=str(exc), retryIn=backoff)
+                wait = backoff
+                backoff = min(backoff * 2, 30.0)
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+
+SPARK_POOL = SparkConnectionPool(SPARK_POOL_SIZE, SPARK_POOL_MAX_AGE, SPARK_POOL_IDLE_TIMEOUT)
+
+
+def _open_spark_session(payload_text, recv_timeout, base_url=None):
+    """发送请求并返回 (ws, pooled)；池中连接若已被服务端关闭则退回现连。连接池只预热默认 SPARK_URL。"""
+    base_url = base_url or SPARK_URL
+    ws = SPARK_POOL.acquire() if base_url == SPARK_URL else None
+    if ws is not None:
+        try:
+            ws.settimeout(recv_timeout)
+            ws.send(payload_text)
+            return ws, True
+        except (websocket.WebSocketException, OSError):
+            ws.close()
+    started = time.time()
+    ws = _connect_spark_ws(recv_timeout, base_url)
+    metric_observe("spark_connect_seconds", time.time() - started, pooled="0")
+    try:
+        ws.settimeout(recv_timeout)
+        ws.send(payload_text)
+    except Exception:
+        ws.close()
+        raise
+    return ws, False
+
+
+# 数值越小优先级越高：交互式对话优先于标题生成与抽卡。
+SPARK_USE_CASE_PRIORITY = {
+    "chat": 0,
+    "stream": 0,
+    "cast": 1,
+    "title": 1,
+    "draw": 2,
+    "summary": 2,
+    "draw_precompute": 3,
+}
+
+
+class SparkAPIError(RuntimeError):
+    """Spark 返回了非 0 的 header.code（上游可用，只是请求本身被拒）。"""
+
+
+SPARK_SCHEDULER = SparkScheduler(
+    SPARK_MAX_CONCURRENCY, SPARK_QUEUE_SIZE, SPARK_QUEUE_MAX_WAIT, SPARK_USE_CASE_PRIORITY
+)
+
+
+SPARK_BREAKER = CircuitBreaker("spark", SPARK_BREAKER_FAILURES, SPARK_BREAKER_RESET, log=LOG)
+
+
+def spark_busy_response(exc):
+    return jsonify({"error": str(exc)}), exc.status_code, {"Retry-After": str(exc.retry_after)}
+
+
+@app.get("/debug/spark/breaker")
+def debug_spark_breaker():
+    """熔断器状态；与其他 /debug 接口一样需带 X-Debug-Profile 令牌，否则返回 404。"""
+    if not debug_token_ok():
+        return jsonify({"error": "not found"}), 404
+    return jsonify(SPARK_BREAKER.snapshot())
+
+
+def debug_token_ok():
+    """请求头 X-Debug-Profile 与 SPARK_PROFILE_TOKEN 一致；未配置令牌时恒为 False。"""
+    return bool(SPARK_PROFILE_TOKEN) and hmac.compare_digest(
+        request.headers.get("X-Debug-Profile", ""), SPARK_PROFILE_TOKEN
+    )
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    # 调试接口本身也用同一令牌鉴权，不对它们剖析，免得每次读指标都写一份调用栈文件。
+    profile = debug_token_ok() and not request.path.startswith("/debug/")
+    span = TRACER.start_root(
+        f"{request.method} {request.path}",
+        traceparent=request.headers.get("traceparent"),
+        force=profile,
+        **{"http.method": request.method, "http.target": request.path},
+    )
+    if span is not NOOP_SPAN:
+        g.trace_span = span
+        g.trace_token = _current_span.set(span)
+    if profile:
+        path = os.path.join(SPARK_PROFILE_DIR, f"{int(time.time())}-{uuid.uuid4().hex[:8]}.folded")
+        g.profiler = SamplingProfiler(path, SPARK_PROFILE_INTERVAL_MS / 1000.0).start()
+
+
+@app.after_request
+def _record_request_latency(response):
+    """按路由模板记录请求耗时；流式响应只计到响应头发出为止。"""
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metric_observe(
+            "http_request_duration_seconds",
+            time.perf_counter() - started,
+            route=route,
+            method=request.method,
+            status=response.status_code,
+        )
+    span = getattr(g, "trace_span", None)
+    if span is not None:
+        span.set("http.route", request.url_rule.rule if request.url_rule is not None else "unmatched")
+        span.set("http.status_code", response.status_code)
+        response.headers["X-Trace-Id"] = span.trace_id
+    profiler = getattr(g, "profiler", None)
+    if profiler is not None:
+        response.headers["X-Profile-File"] = os.path.basename(profiler.path)
+    return response
+
+
+@app.teardown_request
+def _finish_request_trace(exc):
+    """根 span 与剖析在请求结束时收尾；流式响应的后台生成线程会继续写入同一条 trace 的子 span。"""
+    span = getattr(g, "trace_span", None)
+    if span is not None:
+        if exc is not None:
+            span.fail(f"{type(exc).__name__}: {exc}")
+        try:
+            _current_span.reset(g.trace_token)
+        finally:
+            span.end()
+    profiler = getattr(g, "profiler", None)
+    if profiler is not None:
+        profiler.stop()
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(metrics_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@app.get("/debug/db/plans")
+def debug_db_plans():
+    """每条被采样的 SQL 模板最近一次的执行计划，按采样时语句耗时倒序；需带 X-Debug-Profile 令牌。"""
+    if not debug_token_ok():
+        return jsonify({"error": "not found"}), 404
+    try:
+        limit = int(request.args.get("limit", "20"))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    limit = max(1, min(limit, 100))
+    with get_db_conn() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT * FROM (
+                    SELECT DISTINCT ON (fingerprint) fingerprint, statement, duration_ms, plan, captured_at
+                    FROM db_query_plans
+                    ORDER BY fingerprint, captured_at DESC
+                ) latest
+                ORDER BY duration_ms DESC
+                LIMIT %s
+                """,
+                (limit,),
+            )
+            rows = cur.fetchall()
+    for row in rows:
+        row["captured_at"] = row["captured_at"].isoformat()
+        # 早先采样的计划可能仍带常量，读出时同样清洗。
+        row["plan"] = scrub_plan(row["plan"])
+    return jsonify({"plans": rows})
+
+
+@app.get("/debug/metrics")
+def debug_metrics():
+    if not debug_token_ok():
+        return jsonify({"error": "not found"}), 404
+    return jsonify(metrics_snapshot())
 
 
 @app.get("/health")
@@ -304,13 +1223,72 @@ def handshake():
     return jsonify({"app_id": APP_ID, "ws_url": ws_url})
 
 
+_locations_lock = threading.Lock()
+_locations_cache = {"mtime": None, "etag": "", "bodies": {}}
+
+
+def load_locations_bodies():
+    """按文件 mtime 缓存 locations.json，同时保留 gzip/br 预压缩版本。"""
+    mtime = os.stat(LOCATION_FILE).st_mtime_ns
+    with _locations_lock:
+        if _locations_cache["mtime"] == mtime:
+            return _locations_cache["etag"], _locations_cache["bodies"]
+        with open(LOCATION_FILE, "rb") as file:
+            raw = file.read()
+        bodies = {
+            "identity": raw,
+            "gzip": gzip.compress(raw, compresslevel=9, mtime=0),
+        }
+        if brotli is not None:
+            bodies["br"] = brotli.compress(raw, quality=11)
+        etag = hashlib.sha256(raw).hexdigest()[:32]
+        _locations_cache.update({"mtime": mtime, "etag": etag, "bodies": bodies})
+        return etag, bodies
+
+
+def _locations_etag(etag, encoding):
+    # 不同 Content-Encoding 属于不同表示，强 ETag 需要区分。
+    if encoding == "identity":
+        return f'"{etag}"'
+    return f'"{etag}-{encoding}"'
+
+
+def _if_none_match(header_value, etag):
+    if not header_value:
+        return False
+    for item in header_value.split(","):
+        tag = item.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if tag == etag or tag.startswith(f"{etag}-"):
+            return True
+    return False
+
+
 @app.get("/locations")
 def locations():
     try:
-        with open(LOCATION_FILE, "r", encoding="utf-8") as file:
-            return Response(file.read(), mimetype="application/json")
+        etag, bodies = load_locations_bodies()
     except FileNotFoundError:
         return jsonify({"error": "locations data not found"}), 404
+    encoding = "identity"
+    for candidate in ("br", "gzip"):
+        if candidate in bodies and request.accept_encodings.quality(candidate) > 0:
+            encoding = candidate
+            break
+    headers = {
+        "ETag": _locations_etag(etag, encoding),
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if _if_none_match(request.headers.get("If-None-Match"), etag):
+        return Response(status=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(bodies[encoding], mimetype="application/json", headers=headers)
 
 
 def _clean_text(value):
@@ -505,21 +1483,37 @@ def nominatim_search_places(keyword, limit=20):
     return items
 
 
+def _timed_geocode(provider, func, *args, **kwargs):
+    """调用一个地理编码服务并记录耗时与结果：geocode_requests_total{provider, result=hit|empty|error}。"""
+    started = time.perf_counter()
+    result = "error"
+    try:
+        with trace_span(f"geocode.{provider}") as span:
+            items = func(*args, **kwargs)
+            result = "hit" if items else "empty"
+            span.set("result", result)
+        return items
+    finally:
+        metric_observe("geocode_seconds", time.perf_counter() - started, provider=provider)
+        metric_inc("geocode_requests_total", provider=provider, result=result)
+
+
 def search_places(keyword, city="", limit=20):
     try:
-        items = amap_search_places(keyword, city=city, limit=limit)
+        items = _timed_geocode("amap", amap_search_places, keyword, city=city, limit=limit)
         if items:
             return items
     except Exception as exc:
         print(f"[geo] amap search failed: {exc}")
     try:
-        return nominatim_search_places(keyword, limit=limit)
+        return _timed_geocode("nominatim", nominatim_search_places, keyword, limit=limit)
     except Exception as exc:
         print(f"[geo] fallback search failed: {exc}")
         return []
 
 
-def enrich_location_payload(payload):
+def enrich_location_payload(payload, geocode=True):
+    """补全档案地点字段；geocode=False 时只做本地推断，不调用地理编码服务（由后台任务补齐）。"""
     province = _clean_text(payload.get("locationProvince"))
     city = _clean_text(payload.get("locationCity"))
     district = _clean_text(payload.get("locationDistrict"))
@@ -540,7 +1534,7 @@ def enrich_location_payload(payload):
     location_text = _clean_text(payload.get("location"))
     solar_text = _clean_text(payload.get("solar"))
 
-    if (not province or longitude is None or latitude is None) and location_text:
+    if geocode and needs_geocoding(province, longitude, latitude, location_text):
         candidates = search_places(location_text, limit=1)
         if candidates:
             first = candidates[0]
@@ -577,6 +1571,63 @@ def enrich_location_payload(payload):
     }
 
 
+def needs_geocoding(province, longitude, latitude, location_text):
+    return bool(location_text) and (not province or longitude is None or latitude is None)
+
+
+def update_profile_location(cur, profile_id, enriched):
+    """只填补档案中缺失的地点字段，用户已填写的值不被覆盖。"""
+    cur.execute(
+        """
+        UPDATE profiles
+        SET location = COALESCE(NULLIF(location, ''), %s),
+            location_province = COALESCE(NULLIF(location_province, ''), %s),
+            location_city = COALESCE(NULLIF(location_city, ''), %s),
+            location_district = COALESCE(NULLIF(location_district, ''), %s),
+            location_detail = COALESCE(NULLIF(location_detail, ''), %s),
+            latitude = COALESCE(latitude, %s),
+            longitude = COALESCE(longitude, %s),
+            timezone_id = COALESCE(NULLIF(timezone_id, ''), %s),
+            utc_offset_minutes = COALESCE(utc_offset_minutes, %s),
+            place_source = COALESCE(NULLIF(place_source, ''), %s),
+            location_adcode = COALESCE(NULLIF(location_adcode, ''), %s),
+            updated_at = now()
+        WHERE id = %s
+        """,
+        (
+            enriched["location"],
+            enriched["location_province"],
+            enriched["location_city"],
+            enriched["location_district"],
+            enriched["location_detail"],
+            enriched["latitude"],
+            enriched["longitude"],
+            enriched["timezone_id"],
+            enriched["utc_offset_minutes"],
+            enriched["place_source"],
+            enriched["location_adcode"],
+            str(profile_id),
+        ),
+    )
+
+
+def profile_location_payload(row):
+    return {
+        "location": row.get("location", ""),
+        "solar": row.get("solar", ""),
+        "locationProvince": row.get("location_province", ""),
+        "locationCity": row.get("location_city", ""),
+        "locationDistrict": row.get("location_district", ""),
+        "locationDetail": row.get("location_detail", ""),
+        "latitude": row.get("latitude"),
+        "longitude": row.get("longitude"),
+        "timezoneId": row.get("timezone_id", ""),
+        "utcOffsetMinutes": row.get("utc_offset_minutes"),
+        "placeSource": row.get("place_source", ""),
+        "locationAdcode": row.get("location_adcode", ""),
+    }
+
+
 def backfill_profile_locations():
     if not AMAP_API_KEY:
         print("[profiles] skip location backfill: AMAP_API_KEY missing")
@@ -601,56 +1652,10 @@ def backfill_profile_locations():
                 rows = cur.fetchall()
                 updated = 0
                 for row in rows:
-                    enriched = enrich_location_payload(
-                        {
-                            "location": row.get("location", ""),
-                            "solar": row.get("solar", ""),
-                            "locationProvince": row.get("location_province", ""),
-                            "locationCity": row.get("location_city", ""),
-                            "locationDistrict": row.get("location_district", ""),
-                            "locationDetail": row.get("location_detail", ""),
-                            "latitude": row.get("latitude"),
-                            "longitude": row.get("longitude"),
-                            "timezoneId": row.get("timezone_id", ""),
-                            "utcOffsetMinutes": row.get("utc_offset_minutes"),
-                            "placeSource": row.get("place_source", ""),
-                            "locationAdcode": row.get("location_adcode", ""),
-                        }
-                    )
+                    enriched = enrich_location_payload(profile_location_payload(row))
                     if not enriched.get("location") and enriched.get("longitude") is None:
                         continue
-                    cur.execute(
-                        """
-                        UPDATE profiles
-                        SET location = COALESCE(NULLIF(location, ''), %s),
-                            location_province = COALESCE(NULLIF(location_province, ''), %s),
-                            location_city = COALESCE(NULLIF(location_city, ''), %s),
-                            location_district = COALESCE(NULLIF(location_district, ''), %s),
-                            location_detail = COALESCE(NULLIF(location_detail, ''), %s),
-                            latitude = COALESCE(latitude, %s),
-                            longitude = COALESCE(longitude, %s),
-                            timezone_id = COALESCE(NULLIF(timezone_id, ''), %s),
-                            utc_offset_minutes = COALESCE(utc_offset_minutes, %s),
-                            place_source = COALESCE(NULLIF(place_source, ''), %s),
-                            location_adcode = COALESCE(NULLIF(location_adcode, ''), %s),
-                            updated_at = now()
-                        WHERE id = %s
-                        """,
-                        (
-                            enriched["location"],
-                            enriched["location_province"],
-                            enriched["location_city"],
-                            enriched["location_district"],
-                            enriched["location_detail"],
-                            enriched["latitude"],
-                            enriched["longitude"],
-                            enriched["timezone_id"],
-                            enriched["utc_offset_minutes"],
-                            enriched["place_source"],
-                            enriched["location_adcode"],
-                            str(row["id"]),
-                        ),
-                    )
+                    update_profile_location(cur, row["id"], enriched)
                     updated += 1
         print(f"[profiles] location backfill finished, updated={updated}")
     except Exception as exc:
@@ -675,31 +1680,37 @@ def geo_search():
     return jsonify({"items": [], "error": "no location results"}), 200
 
 
-def build_spark_payload(messages):
+def build_spark_payload(messages, generation="chat"):
+    if isinstance(generation, dict):
+        gen = generation
+    else:
+        gen = SPARK_GENERATION_PROFILES.get(generation) or SPARK_GENERATION_PROFILES["chat"]
+    chat_params = {
+        "domain": gen["domain"],
+        "max_tokens": gen["max_tokens"],
+        "presence_penalty": 1,
+        "temperature": gen["temperature"],
+        "frequency_penalty": 0.02,
+        "top_k": gen["top_k"],
+    }
+    if gen.get("thinking"):
+        chat_params["thinking"] = {"type": gen["thinking"]}
+    if gen["web_search"]:
+        chat_params["tools"] = [
+            {
+                "type": "web_search",
+                "web_search": {
+                    "enable": True,
+                    "search_mode": "normal",
+                },
+            }
+        ]
     return {
         "header": {
             "uid": "user_id",
             "app_id": APP_ID,
         },
-        "parameter": {
-            "chat": {
-                "domain": SPARK_DOMAIN,
-                "max_tokens": 4096,
-                "presence_penalty": 1,
-                "temperature": 0.5,
-                "frequency_penalty": 0.02,
-                "top_k": 5,
-                "tools": [
-                    {
-                        "type": "web_search",
-                        "web_search": {
-                            "enable": True,
-                            "search_mode": "normal",
-                        },
-                    }
-                ],
-            }
-        },
+        "parameter": {"chat": chat_params},
         "payload": {"message": {"text": messages}},
     }
 
@@ -1152,6 +2163,7 @@ def _to_one_thing_payload(row, timezone_id):
     }
 
 
+@db_timed
 def fetch_one_thing_divination_by_date(profile_id, divination_date, timezone_id="Asia/Shanghai"):
     with get_db_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
@@ -1172,6 +2184,7 @@ def fetch_one_thing_divination_by_date(profile_id, divination_date, timezone_id=
     return _to_one_thing_payload(row, timezone_id)
 
 
+@db_timed
 def fetch_one_thing_divination_latest(profile_id, timezone_id="Asia/Shanghai"):
     with get_db_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
@@ -1192,6 +2205,7 @@ def fetch_one_thing_divination_latest(profile_id, timezone_id="Asia/Shanghai"):
     return _to_one_thing_payload(row, timezone_id)
 
 
+@db_timed
 def fetch_one_thing_divination_by_id(profile_id, row_id, timezone_id="Asia/Shanghai"):
     with get_db_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
@@ -1211,6 +2225,7 @@ def fetch_one_thing_divination_by_id(profile_id, row_id, timezone_id="Asia/Shang
     return _to_one_thing_payload(row, timezone_id)
 
 
+@db_timed
 def delete_one_thing_divination(profile_id, row_id):
     with get_db_conn() as conn:
         with conn.cursor() as cur:
@@ -1224,6 +2239,7 @@ def delete_one_thing_divination(profile_id, row_id):
             return cur.rowcount > 0
 
 
+@db_timed
 def list_one_thing_history(profile_id, timezone_id="Asia/Shanghai", limit=30):
     n = max(1, min(int(limit), 100))
     with get_db_conn() as conn:
@@ -1258,6 +2274,7 @@ def list_one_thing_history(profile_id, timezone_id="Asia/Shanghai", limit=30):
     return result
 
 
+@db_timed
 def fetch_draw(profile_id, draw_date):
     with get_db_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
@@ -1281,6 +2298,7 @@ def fetch_draw(profile_id, draw_date):
     }
 
 
+@db_timed
 def fetch_profile(profile_id):
     if not profile_id:
         return {}
@@ -1330,7 +2348,70 @@ def resolve_tianshi_prompt(tianshi_id, now_str):
     return ""
 
 
-def build_chat_messages(messages, profile, tianshi_id=None):
+def render_system_content(profile, tianshi_id, now_str):
+    system_parts = []
+    role_prompt = resolve_tianshi_prompt(tianshi_id, now_str)
+    if role_prompt:
+        system_parts.append(role_prompt)
+    profile_prompt = build_profile_prompt(profile)
+    if profile_prompt:
+        system_parts.append(profile_prompt.strip())
+    return "\n\n".join(system_parts)
+
+
+class SystemPromptCache:
+    """按 (人设, 档案 id, 时间桶) 缓存组装好的 system 提示词，命中时免去档案查询与模板渲染。
+
+    时间桶同时是缓存的有效期：任何实例上的档案修改最迟在一个时间桶后对所有实例生效。
+    本实例上的修改会立即逐出本地条目，但不依赖这一点保证一致性。
+    """
+
+    def __init__(self, capacity, bucket_seconds):
+        self.capacity = max(1, capacity)
+        self.bucket_seconds = max(1, bucket_seconds)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def invalidate_profile(self, profile_id):
+        profile_id = str(profile_id or "")
+        with self._lock:
+            for key in [k for k in self._entries if k[1] == profile_id]:
+                del self._entries[key]
+
+    def resolve(self, profile_id, tianshi_id, timing):
+        """返回 (system_content, profile_found)，并把各阶段耗时写入 timing。"""
+        profile_id = str(profile_id or "")
+        tianshi_key = str(tianshi_id or "").strip().lower()
+        bucket = int(time.time() // self.bucket_seconds) * self.bucket_seconds
+        with self._lock:
+            key = (tianshi_key, profile_id, bucket)
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+        timing["promptCache"] = "hit" if cached is not None else "miss"
+        metric_inc("prompt_cache_total", result=timing["promptCache"])
+        if cached is not None:
+            return cached
+
+        started = time.perf_counter()
+        profile = fetch_profile(profile_id) if profile_id else {}
+        fetched = time.perf_counter()
+        now_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(bucket))
+        value = (render_system_content(profile, tianshi_id, now_str), bool(profile))
+        timing["profileFetch"] = fetched - started
+        timing["render"] = time.perf_counter() - fetched
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return value
+
+
+SYSTEM_PROMPTS = SystemPromptCache(SPARK_PROMPT_CACHE_SIZE, SPARK_PROMPT_TIME_BUCKET)
+
+
+def build_chat_messages(messages, profile, tianshi_id=None, system_content=None):
+    """system_content 不为 None 时直接使用（来自 SYSTEM_PROMPTS 缓存），否则按 profile 现场渲染。"""
     raw_messages = list(messages) if isinstance(messages, list) else []
     def is_error_message(item):
         if item.get("role") != "assistant":
@@ -1353,45 +2434,363 @@ def build_chat_messages(messages, profile, tianshi_id=None):
                 continue
         compacted.append(message)
     chat_messages = compacted
-    profile_prompt = build_profile_prompt(profile)
-    system_parts = []
-    now_str = time.strftime("%Y-%m-%d %H:%M:%S")
-    role_prompt = resolve_tianshi_prompt(tianshi_id, now_str)
-    if role_prompt:
-        system_parts.append(role_prompt)
-    if profile_prompt:
-        system_parts.append(profile_prompt.strip())
-    if system_parts:
-        system_message = {"role": "system", "content": "\n\n".join(system_parts)}
+    if system_content is None:
+        system_content = render_system_content(profile, tianshi_id, time.strftime("%Y-%m-%d %H:%M:%S"))
+    if system_content:
+        system_message = {"role": "system", "content": system_content}
         return [system_message] + chat_messages
     return chat_messages
 
 
-@app.post("/profiles")
-def upsert_profile():
-    payload = request.get_json(silent=True) or {}
-    profile_id = str(payload.get("id", "")).strip()
-    if not profile_id:
-        return jsonify({"error": "id required"}), 400
-    user_id = payload.get("userId")
-    if not user_id:
-        return jsonify({"error": "userId required"}), 400
-    enriched_location = enrich_location_payload(payload)
-    with get_db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO profiles (
-                    id, user_id, name, gender, location, solar, lunar, true_solar,
-                    location_province, location_city, location_district, location_detail,
-                    latitude, longitude, timezone_id, utc_offset_minutes, place_source, location_adcode
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (id) DO UPDATE SET
-                    user_id = EXCLUDED.user_id,
-                    name = EXCLUDED.name,
-                    gender = EXCLUDED.gender,
-                    location = EXCLUDED.location,
+def estimate_tokens(text):
+    """粗估 token 数：中日韩字符按 1 字 1 token，其余按 4 字符 1 token。"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if "\u3000" <= ch <= "\u9fff" or "\uff00" <= ch <= "\uffef")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_messages_tokens(messages):
+    # 每条消息额外计入少量角色/分隔开销
+    return sum(estimate_tokens(m.get("content") or "") + 4 for m in messages)
+
+
+class HistorySummarizer:
+    """滚动摘要缓存：每个会话记录已覆盖的历史前缀及其摘要，后台增量更新并跨轮复用。"""
+
+    def __init__(self, capacity=1024, workers=2):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="history-summary")
+
+    @staticmethod
+    def _digest(messages):
+        digest = hashlib.sha1()
+        for message in messages:
+            digest.update(f"{message.get('role')}\0{message.get('content')}\0".encode("utf-8"))
+        return digest.hexdigest()
+
+    def lookup(self, key, older):
+        """返回 (summary, covered)：可复用的摘要及其覆盖的 older 前缀条数。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None or entry["covered"] > len(older):
+            return "", 0
+        if entry["digest"] != self._digest(older[:entry["covered"]]):
+            return "", 0
+        return entry["summary"], entry["covered"]
+
+    def refresh(self, key, older, summary, covered):
+        if covered >= len(older):
+            return
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self._executor.submit(self._summarize, key, list(older), summary, covered)
+
+    def _summarize(self, key, older, summary, covered):
+        try:
+            transcript = "\n".join(
+                f"{'用户' if m.get('role') == 'user' else '大师'}：{m.get('content') or ''}"
+                for m in older[covered:]
+            )
+            user_text = f"已有摘要：{summary}\n\n新增对话：\n{transcript}" if summary else f"对话：\n{transcript}"
+            text = spark_chat(
+                [
+                    {"role": "system", "content": SPARK_SUMMARY_PROMPT},
+                    {"role": "user", "content": user_text},
+                ],
+                use_case="summary",
+            ).strip()
+            if not text or "未配置 Spark 凭证" in text:
+                return
+            with self._lock:
+                self._entries[key] = {"covered": len(older), "digest": self._digest(older), "summary": text}
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+            metric_inc("history_summary_total", result="ok")
+        except Exception as exc:  # noqa: BLE001
+            metric_inc("history_summary_total", result="error")
+            LOG.warning("history_summary.failed", error=str(exc))
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+
+HISTORY_SUMMARIES = HistorySummarizer()
+
+
+def conversation_key(conversation_id, profile_id, tianshi_id, messages):
+    if conversation_id:
+        return conversation_id
+    # 旧客户端没有会话 id：以档案、人设与首条用户消息近似标识同一会话
+    first_user = next((m.get("content") or "" for m in messages if m.get("role") == "user"), "")
+    raw = f"{profile_id}|{tianshi_id}|{first_user}"
+    return "legacy:" + hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def compact_chat_messages(chat_messages, key, budget=None, keep_turns=None):
+    """按 token 预算压缩历史，返回 (messages, usage)。
+
+    system（人设 + 档案）与最近 keep_turns 轮原样保留；更早的轮次用缓存的滚动摘要替代，
+    摘要未就绪的部分在预算内尽量保留最近的消息，其余丢弃，同时在后台生成新摘要。
+    """
+    budget = SPARK_HISTORY_TOKEN_BUDGET if budget is None else budget
+    keep_turns = SPARK_HISTORY_KEEP_TURNS if keep_turns is None else keep_turns
+    before = estimate_messages_tokens(chat_messages)
+    usage = {"promptTokensBefore": before, "promptTokens": before, "summarized": 0, "dropped": 0}
+    if before <= budget:
+        return chat_messages, usage
+
+    system = chat_messages[0] if chat_messages and chat_messages[0].get("role") == "system" else None
+    body = chat_messages[1:] if system else list(chat_messages)
+    user_indexes = [i for i, m in enumerate(body) if m.get("role") == "user"]
+    if len(user_indexes) <= keep_turns:
+        return chat_messages, usage
+    split_at = user_indexes[-keep_turns] if keep_turns > 0 else len(body)
+    older, recent = body[:split_at], body[split_at:]
+
+    summary, covered = HISTORY_SUMMARIES.lookup(key, older)
+    HISTORY_SUMMARIES.refresh(key, older, summary, covered)
+
+    system_content = system.get("content") if system else ""
+    if summary:
+        system_content = f"{system_content}\n\n此前对话摘要：\n{summary}".strip()
+    head = [{"role": "system", "content": system_content}] if system_content else []
+    remaining = budget - estimate_messages_tokens(head) - estimate_messages_tokens(recent)
+    kept = []
+    for message in reversed(older[covered:]):
+        cost = estimate_messages_tokens([message])
+        if cost > remaining:
+            break
+        kept.append(message)
+        remaining -= cost
+    kept.reverse()
+    while kept and kept[0].get("role") != "user":
+        kept.pop(0)
+
+    compacted = head + kept + recent
+    usage.update(
+        {
+            "promptTokens": estimate_messages_tokens(compacted),
+            "summarized": covered,
+            "dropped": len(older) - covered - len(kept),
+        }
+    )
+    return compacted, usage
+
+
+@traced("chat.assemble_prompt")
+def assemble_chat_prompt(messages, profile_id, tianshi_id, conversation_id):
+    """组装发给 Spark 的消息，返回 (chat_messages, usage, timing, profile_found)。"""
+    timing = {}
+    started = time.perf_counter()
+    system_content, profile_found = SYSTEM_PROMPTS.resolve(profile_id, tianshi_id, timing)
+    built = time.perf_counter()
+    chat_messages = build_chat_messages(messages, None, tianshi_id, system_content=system_content)
+    key = conversation_key(conversation_id, profile_id, tianshi_id, chat_messages)
+    history_started = time.perf_counter()
+    chat_messages, usage = compact_chat_messages(chat_messages, key)
+    finished = time.perf_counter()
+    timing["system"] = built - started
+    timing["history"] = finished - history_started
+    timing["total"] = finished - started
+    for stage in ("profileFetch", "render", "system", "history", "total"):
+        if stage in timing:
+            metric_observe("prompt_assembly_seconds", timing[stage], stage=stage)
+    return chat_messages, usage, timing, profile_found
+
+
+def usage_headers(usage, timing=None):
+    headers = {
+        "X-Prompt-Tokens-Before": str(usage["promptTokensBefore"]),
+        "X-Prompt-Tokens": str(usage["promptTokens"]),
+    }
+    if timing:
+        parts = [
+            f"prompt-{stage};dur={timing[stage] * 1000:.2f}"
+            for stage in ("profileFetch", "render", "system", "history", "total")
+            if stage in timing
+        ]
+        parts.append(f'prompt-cache;desc="{timing.get("promptCache", "miss")}"')
+        headers["Server-Timing"] = ", ".join(parts)
+    return headers
+
+
+def request_owner():
+    """请求方身份 user:<用户 id>；需要归属的端点都已由 _attach_session_identity 要求会话令牌。"""
+    return f"user:{g.identity['userId']}"
+
+
+def owner_matches(owner):
+    """owner 为空（加上归属之前写入的数据）时不校验；档案归属的资源也允许持有该档案的令牌访问。
+
+    早期未带令牌时写入的 ip:<地址> 归属不再能匹配任何请求。
+    """
+    if not owner or owner == request_owner():
+        return True
+    kind, _, value = owner.partition(":")
+    return kind == "profile" and value in g.identity["profileIds"]
+
+
+class ConversationStore:
+    """服务端会话历史：chat_messages 只追加，活跃会话在内存中按 LRU 缓存（连同会话归属）。"""
+
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def _remember(self, conversation_id, owner, messages):
+        with self._lock:
+            self._cache[conversation_id] = (owner, messages)
+            self._cache.move_to_end(conversation_id)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def _forget(self, conversation_id):
+        with self._lock:
+            self._cache.pop(conversation_id, None)
+
+    @db_timed
+    def load(self, conversation_id):
+        """返回 (owner, messages)；会话尚无消息时 owner 为 None。"""
+        with self._lock:
+            cached = self._cache.get(conversation_id)
+            if cached is not None:
+                self._cache.move_to_end(conversation_id)
+                metric_inc("conversation_cache_total", result="hit")
+                return cached[0], list(cached[1])
+        metric_inc("conversation_cache_total", result="miss")
+        with get_db_conn() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute(
+                    """
+                    SELECT role, content, owner
+                    FROM chat_messages
+                    WHERE conversation_id = %s
+                    ORDER BY seq
+                    """,
+                    (conversation_id,),
+                )
+                rows = cur.fetchall()
+        owner = next((row["owner"] for row in rows if row["owner"]), None)
+        messages = [{"role": row["role"], "content": row["content"]} for row in rows]
+        self._remember(conversation_id, owner, messages)
+        return owner, list(messages)
+
+    def history(self, conversation_id):
+        return self.load(conversation_id)[1]
+
+    @db_timed
+    def append(self, conversation_id, new_messages, owner=None):
+        # 以缓存长度作为起始 seq；若其他实例已写入导致唯一键冲突，则重新加载后重试一次。
+        # 已有归属的会话沿用原归属，owner 只在会话首次落库时生效。
+        for attempt in range(2):
+            stored_owner, history = self.load(conversation_id)
+            owner = stored_owner or owner
+            rows = [
+                (conversation_id, len(history) + index + 1, message["role"], message["content"], owner)
+                for index, message in enumerate(new_messages)
+            ]
+            try:
+                with get_db_conn() as conn:
+                    with conn.cursor() as cur:
+                        psycopg2.extras.execute_values(
+                            cur,
+                            "INSERT INTO chat_messages (conversation_id, seq, role, content, owner) VALUES %s",
+                            rows,
+                        )
+            except psycopg2.errors.UniqueViolation:
+                self._forget(conversation_id)
+                if attempt:
+                    raise
+                continue
+            self._remember(conversation_id, owner, history + list(new_messages))
+            return
+
+
+CONVERSATIONS = ConversationStore(SPARK_CONVERSATION_CACHE)
+
+
+def resolve_chat_input(payload):
+    """解析对话请求，返回 (conversation_id, messages, new_message)。
+
+    旧客户端传完整 messages，原样使用；新客户端只传 message（可带 conversationId），
+    历史由服务端从 chat_messages 拼装。续写他人的会话抛 PermissionError。
+    """
+    if payload.get("message") is None:
+        messages = payload.get("messages", [])
+        if not isinstance(messages, list) or not messages:
+            raise ValueError("messages required")
+        return None, messages, None
+    message = payload.get("message")
+    content = _clean_text(message.get("content") if isinstance(message, dict) else message)
+    if not content:
+        raise ValueError("message required")
+    new_message = {"role": "user", "content": content}
+    conversation_id = _clean_text(payload.get("conversationId"))
+    if not conversation_id:
+        return str(uuid.uuid4()), [new_message], new_message
+    try:
+        conversation_id = str(uuid.UUID(conversation_id))
+    except ValueError:
+        raise ValueError("invalid conversationId") from None
+    owner, history = CONVERSATIONS.load(conversation_id)
+    if not owner_matches(owner):
+        raise PermissionError("forbidden")
+    return conversation_id, history + [new_message], new_message
+
+
+@app.get("/conversations/<conversation_id>/messages")
+def get_conversation_messages(conversation_id):
+    try:
+        conversation_id = str(uuid.UUID(conversation_id))
+    except ValueError:
+        return jsonify({"error": "invalid conversationId"}), 400
+    try:
+        owner, messages = CONVERSATIONS.load(conversation_id)
+    except Exception as exc:  # noqa: BLE001
+        LOG.error("conversation.error", conversationId=conversation_id, error=str(exc))
+        return jsonify({"error": str(exc)}), 500
+    if not owner_matches(owner):
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify({"conversationId": conversation_id, "messages": messages})
+
+
+@app.post("/profiles")
+def upsert_profile():
+    payload = request.get_json(silent=True) or {}
+    profile_id = str(payload.get("id", "")).strip()
+    if not profile_id:
+        return jsonify({"error": "id required"}), 400
+    user_id = payload.get("userId")
+    if not user_id:
+        return jsonify({"error": "userId required"}), 400
+    # Prefer: respond-async 时先落库，地理编码交给后台任务补齐。
+    defer_geocoding = prefers_async()
+    enriched_location = enrich_location_payload(payload, geocode=not defer_geocoding)
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO profiles (
+                    id, user_id, name, gender, location, solar, lunar, true_solar,
+                    location_province, location_city, location_district, location_detail,
+                    latitude, longitude, timezone_id, utc_offset_minutes, place_source, location_adcode
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (id) DO UPDATE SET
+                    user_id = EXCLUDED.user_id,
+                    name = EXCLUDED.name,
+                    gender = EXCLUDED.gender,
+                    location = EXCLUDED.location,
                     solar = EXCLUDED.solar,
                     lunar = EXCLUDED.lunar,
                     true_solar = EXCLUDED.true_solar,
@@ -1406,6 +2805,8 @@ def upsert_profile():
                     place_source = EXCLUDED.place_source,
                     location_adcode = EXCLUDED.location_adcode,
                     updated_at = now()
+                WHERE profiles.user_id = EXCLUDED.user_id
+                RETURNING (xmax = 0) AS inserted
                 """,
                 (
                     profile_id,
@@ -1428,7 +2829,30 @@ def upsert_profile():
                     enriched_location.get("location_adcode", ""),
                 ),
             )
-    print(f"[profiles] upsert id={profile_id}")
+            row = cur.fetchone()
+    if row is None:
+        # id 已存在且属于其他用户：条件更新没有命中任何行，不允许借 upsert 改写或接管他人档案。
+        return jsonify({"error": "forbidden"}), 403
+    inserted = bool(row[0])
+    SYSTEM_PROMPTS.invalidate_profile(profile_id)
+    LOG.info("profiles.upsert", profileId=profile_id, inserted=inserted)
+    identity = g.identity
+    if inserted and identity is not None and identity["userId"] == str(user_id):
+        # 新建档案后换发包含它的令牌（响应头 X-Session-Token），客户端替换本地令牌即可。
+        g.refreshed_session = issue_session(user_id, [*identity["profileIds"], profile_id])
+    if defer_geocoding and needs_geocoding(
+        enriched_location.get("location_province"),
+        enriched_location.get("longitude"),
+        enriched_location.get("latitude"),
+        enriched_location.get("location"),
+    ):
+        job_id = enqueue_job(
+            "enrich_location",
+            {"profileId": profile_id},
+            dedupe_key=f"enrich:{profile_id}",
+            owner=f"profile:{profile_id}",
+        )
+        return accepted_job_response(job_id, {"ok": True})
     return jsonify({"ok": True})
 
 
@@ -1495,16 +2919,120 @@ def delete_profile(profile_id):
                 "DELETE FROM profiles WHERE id = %s AND user_id = %s",
                 (profile_id, user_id),
             )
+    SYSTEM_PROMPTS.invalidate_profile(profile_id)
     return jsonify({"ok": True})
 
 
+def _resolve_profile_zone(profile):
+    timezone_id = _clean_text((profile or {}).get("timezoneId")) or "Asia/Shanghai"
+    try:
+        return ZoneInfo(timezone_id)
+    except Exception:
+        return ZoneInfo("Asia/Shanghai")
+
+
+def _resolve_profile_today(profile):
+    zone = _resolve_profile_zone(profile)
+    return datetime.now(zone).date()
+
+
+@db_timed
+def fetch_today_draw(profile_id):
+    """一次查询取出档案时区及其前后一天的抽卡记录，按档案当地日期挑出今日结果。
+
+    返回 (today, draw)；没有今日记录时 draw 为 None，档案不存在时按 Asia/Shanghai 计算日期。
+    """
+    utc_today = datetime.now(timezone.utc).date()
+    with get_db_conn() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT p.timezone_id, d.draw_date, d.card_name, d.keywords, d.interpretation, d.advice
+                FROM (SELECT %s::uuid AS id) AS req
+                LEFT JOIN profiles p ON p.id = req.id
+                LEFT JOIN draws d ON d.profile_id = req.id AND d.draw_date BETWEEN %s AND %s
+                """,
+                (str(profile_id), utc_today - timedelta(days=1), utc_today + timedelta(days=1)),
+            )
+            rows = cur.fetchall()
+    timezone_id = rows[0].get("timezone_id") if rows else None
+    today = _resolve_profile_today({"timezoneId": timezone_id})
+    for row in rows:
+        if row.get("draw_date") == today:
+            return today, {
+                "date": str(today),
+                "cardName": row.get("card_name", ""),
+                "keywords": row.get("keywords") or [],
+                "interpretation": row.get("interpretation", ""),
+                "advice": row.get("advice", ""),
+            }
+    return today, None
+
+
+def generate_draw(profile_id, profile, draw_date, now_str, use_case="draw", hedge=True, on_partial=None):
+    """调用 Spark 生成 draw_date 的抽卡并写入 draws；该日已有记录（如被预生成抢先写入）时返回已有记录。
+
+    模型输出无法解析或缺字段时抛 ValueError。on_partial 见 spark_chat；对冲的两路输出无法合并为一路进度，
+    传入 on_partial 时不对冲。
+    """
+    prompt = build_draw_prompt(profile, now_str)
+    messages = [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": "开始抽卡。"},
+    ]
+    if hedge and on_partial is None:
+        raw = spark_chat_hedged(messages, use_case=use_case, stop_on_json=True)
+    else:
+        raw = spark_chat(messages, use_case=use_case, stop_on_json=True, on_partial=on_partial)
+    parsed = parse_draw_response(raw)
+    if not isinstance(parsed, dict):
+        raise ValueError("invalid draw response")
+    card_name = (parsed.get("cardName") or "").strip()
+    keywords = parsed.get("keywords") or []
+    interpretation = (parsed.get("interpretation") or "").strip()
+    advice = (parsed.get("advice") or "").strip()
+    if not card_name or not interpretation or not advice:
+        raise ValueError("draw response missing fields")
+    if not isinstance(keywords, list):
+        keywords = [str(keywords)]
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO draws (profile_id, draw_date, card_name, keywords, interpretation, advice)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (profile_id, draw_date) DO NOTHING
+                RETURNING id
+                """,
+                (
+                    str(profile_id),
+                    draw_date,
+                    card_name,
+                    psycopg2.extras.Json(keywords),
+                    interpretation,
+                    advice,
+                ),
+            )
+            inserted = cur.fetchone() is not None
+    if not inserted:
+        existing = fetch_draw(profile_id, draw_date)
+        if existing:
+            return existing
+    return {
+        "date": str(draw_date),
+        "cardName": card_name,
+        "keywords": keywords,
+        "interpretation": interpretation,
+        "advice": advice,
+    }
+
+
 @app.get("/draws/today")
 def get_today_draw():
     profile_id = request.args.get("profile_id") or request.args.get("profileId")
     if not profile_id:
         return jsonify({"error": "profile_id required"}), 400
-    today = datetime.now().date()
-    existing = fetch_draw(profile_id, today)
+    _, existing = fetch_today_draw(profile_id)
     if not existing:
         return jsonify({"error": "not found"}), 404
     return jsonify(existing)
@@ -1516,71 +3044,198 @@ def create_today_draw():
     profile_id = payload.get("profileId") or payload.get("profile_id")
     if not profile_id:
         return jsonify({"error": "profileId required"}), 400
-    today = datetime.now().date()
-    existing = fetch_draw(profile_id, today)
+    today, existing = fetch_today_draw(profile_id)
+    metric_inc("draw_read_total", result="hit" if existing else "miss")
     if existing:
         return jsonify(existing)
+    if prefers_async():
+        job_id = enqueue_job(
+            "draw",
+            {"profileId": str(profile_id), "drawDate": str(today)},
+            dedupe_key=f"draw:{profile_id}:{today}",
+            owner=f"profile:{profile_id}",
+        )
+        return accepted_job_response(job_id)
 
     profile = fetch_profile(profile_id) if profile_id else {}
-    now_str = time.strftime("%Y-%m-%d %H:%M:%S")
-    prompt = build_draw_prompt(profile, now_str)
-    messages = [
-        {"role": "system", "content": prompt},
-        {"role": "user", "content": "开始抽卡。"},
-    ]
+    now_str = datetime.now(_resolve_profile_zone(profile)).strftime("%Y-%m-%d %H:%M:%S")
     try:
-        raw = spark_chat(messages)
-        parsed = parse_draw_response(raw)
-        if not isinstance(parsed, dict):
-            return jsonify({"error": "invalid draw response"}), 500
-        card_name = (parsed.get("cardName") or "").strip()
-        keywords = parsed.get("keywords") or []
-        interpretation = (parsed.get("interpretation") or "").strip()
-        advice = (parsed.get("advice") or "").strip()
-        if not card_name or not interpretation or not advice:
-            return jsonify({"error": "draw response missing fields"}), 500
-        if not isinstance(keywords, list):
-            keywords = [str(keywords)]
+        return jsonify(generate_draw(profile_id, profile, today, now_str))
+    except SparkBusy as exc:
+        return spark_busy_response(exc)
+    except Exception as exc:  # noqa: BLE001
+        return jsonify({"error": str(exc)}), 500
+
+
+@app.post("/draws/daily/stream")
+def stream_today_draw():
+    """与 /draws/daily 相同，但以 SSE 推送生成进度，客户端可以先展示卡名与关键词。
+
+    模型输出中每多一个完整的顶层字段就发一条 event: partial（目前已完成的字段），
+    最后以 event: done 发送完整抽卡，失败时为 event: error；今日已有记录时直接发 done。
+    客户端中途断开不影响生成，结果照常写库，之后的 /draws/today 可以读到。
+    """
+    payload = request.get_json(silent=True) or {}
+    profile_id = payload.get("profileId") or payload.get("profile_id")
+    if not profile_id:
+        return jsonify({"error": "profileId required"}), 400
+    today, existing = fetch_today_draw(profile_id)
+    metric_inc("draw_read_total", result="hit" if existing else "miss")
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if existing:
+        return Response(
+            sse_data(json.dumps(existing, ensure_ascii=False), event="done"),
+            mimetype="text/event-stream",
+            headers=headers,
+        )
+    try:
+        SPARK_BREAKER.check()
+    except SparkBusy as exc:
+        return spark_busy_response(exc)
+    profile = fetch_profile(profile_id) if profile_id else {}
+    now_str = datetime.now(_resolve_profile_zone(profile)).strftime("%Y-%m-%d %H:%M:%S")
+    events = queue.Queue()
+
+    def run():
+        try:
+            draw = generate_draw(
+                profile_id,
+                profile,
+                today,
+                now_str,
+                on_partial=lambda fields: events.put(("partial", dict(fields))),
+            )
+            events.put(("done", draw))
+        except SparkBusy as exc:
+            events.put(("error", {"error": str(exc), "retryAfter": exc.retry_after}))
+        except Exception as exc:  # noqa: BLE001
+            LOG.error("draw_stream.error", profileId=profile_id, error=str(exc))
+            events.put(("error", {"error": str(exc)}))
+
+    threading.Thread(
+        target=run_with_span,
+        args=(current_span(), run),
+        name=f"draw-stream-{str(profile_id)[:8]}",
+        daemon=True,
+    ).start()
+
+    def generate():
+        while True:
+            try:
+                kind, body = events.get(timeout=5)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            metric_inc("draw_stream_events_total", kind=kind)
+            yield sse_data(json.dumps(body, ensure_ascii=False), event=kind)
+            if kind != "partial":
+                return
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+
+
+class DrawPrecomputer:
+    """在各时区当地零点前为近期活跃档案预生成次日抽卡，早高峰的 /draws/daily 只需读库。
+
+    活跃档案指回看期内有抽卡或一事一测记录的档案，按 timezone_id 分组计算各自的目标日期。
+    只在 worker 进程中扫描，缺失的抽卡以 draw:{档案}:{日期} 为去重键写入任务队列，
+    多个 worker 同时扫描也只会生成一次；生成占用最低优先级的调度名额，总并发受 SPARK_JOB_DRAW_CONCURRENCY 限制。
+    """
+
+    def __init__(self, interval, lead_minutes, active_days, catchup_hour):
+        self.interval = interval
+        self.lead = timedelta(minutes=lead_minutes)
+        self.active_days = active_days
+        self.catchup_hour = catchup_hour
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="draw-precompute", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                enqueued, deduped = self.run_once()
+                if enqueued or deduped:
+                    LOG.info("draw_precompute.scan", enqueued=enqueued, deduped=deduped)
+            except Exception as exc:  # noqa: BLE001
+                LOG.error("draw_precompute.error", error=str(exc))
+            time.sleep(self.interval)
+
+    def target_dates(self, timezone_id, now=None):
+        """该时区需要预生成的日期：临近当地零点时为次日，凌晨补齐窗口内还包括当天。"""
+        local = (now or datetime.now(timezone.utc)).astimezone(_resolve_profile_zone({"timezoneId": timezone_id}))
+        next_midnight = local.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        dates = []
+        if local.hour < self.catchup_hour:
+            dates.append(local.date())
+        if next_midnight - local <= self.lead:
+            dates.append(next_midnight.date())
+        return dates
+
+    def _active_profiles(self):
         with get_db_conn() as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """
-                    INSERT INTO draws (profile_id, draw_date, card_name, keywords, interpretation, advice)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (profile_id, draw_date) DO NOTHING
+                    SELECT p.id::text, COALESCE(NULLIF(p.timezone_id, ''), 'Asia/Shanghai')
+                    FROM profiles p
+                    WHERE EXISTS (
+                        SELECT 1 FROM draws d
+                        WHERE d.profile_id = p.id AND d.created_at >= now() - %s * interval '1 day'
+                    ) OR EXISTS (
+                        SELECT 1 FROM one_thing_divinations o
+                        WHERE o.profile_id = p.id AND o.created_at >= now() - %s * interval '1 day'
+                    )
                     """,
-                    (
-                        str(profile_id),
-                        today,
-                        card_name,
-                        psycopg2.extras.Json(keywords),
-                        interpretation,
-                        advice,
-                    ),
+                    (self.active_days, self.active_days),
                 )
-        result = {
-            "date": str(today),
-            "cardName": card_name,
-            "keywords": keywords,
-            "interpretation": interpretation,
-            "advice": advice,
-        }
-        return jsonify(result)
-    except Exception as exc:  # noqa: BLE001
-        return jsonify({"error": str(exc)}), 500
-
+                return cur.fetchall()
 
-def _resolve_profile_zone(profile):
-    timezone_id = _clean_text((profile or {}).get("timezoneId")) or "Asia/Shanghai"
-    try:
-        return ZoneInfo(timezone_id)
-    except Exception:
-        return ZoneInfo("Asia/Shanghai")
+    def _missing(self, profile_ids, draw_date):
+        with get_db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT profile_id::text FROM draws WHERE draw_date = %s AND profile_id = ANY(%s::uuid[])",
+                    (draw_date, profile_ids),
+                )
+                done = {row[0] for row in cur.fetchall()}
+        return [profile_id for profile_id in profile_ids if profile_id not in done]
+
+    def run_once(self, now=None):
+        """扫描一轮，返回 (新入队数, 已在队列中被去重的数量)。"""
+        by_zone = {}
+        for profile_id, timezone_id in self._active_profiles():
+            by_zone.setdefault(timezone_id, []).append(profile_id)
+        enqueued = deduped = 0
+        for timezone_id, profile_ids in by_zone.items():
+            for draw_date in self.target_dates(timezone_id, now):
+                for profile_id in self._missing(profile_ids, draw_date):
+                    # 与 /draws/daily 的异步请求共用去重键，已排队或执行中的同一抽卡不会重复入队。
+                    _, created = submit_job(
+                        "draw",
+                        {"profileId": profile_id, "drawDate": str(draw_date), "precompute": True},
+                        dedupe_key=f"draw:{profile_id}:{draw_date}",
+                        owner=f"profile:{profile_id}",
+                    )
+                    if created:
+                        enqueued += 1
+                    else:
+                        deduped += 1
+        metric_inc("draw_precompute_total", enqueued, result="enqueued")
+        metric_inc("draw_precompute_total", deduped, result="deduped")
+        return enqueued, deduped
 
 
-def _resolve_profile_today(profile):
-    zone = _resolve_profile_zone(profile)
-    return datetime.now(zone).date()
+DRAW_PRECOMPUTER = DrawPrecomputer(
+    SPARK_DRAW_PRECOMPUTE_INTERVAL,
+    SPARK_DRAW_PRECOMPUTE_LEAD_MINUTES,
+    SPARK_DRAW_PRECOMPUTE_ACTIVE_DAYS,
+    SPARK_DRAW_PRECOMPUTE_CATCHUP_HOUR,
+)
 
 
 @app.get("/one-thing/today")
@@ -1657,32 +3312,46 @@ def delete_one_thing_record(record_id):
     return jsonify({"ok": True})
 
 
-@app.post("/one-thing/cast")
-def cast_one_thing():
-    payload = request.get_json(silent=True) or {}
-    profile_id = payload.get("profileId") or payload.get("profile_id")
-    question = _clean_text(payload.get("question"))
-    tosses = _normalize_tosses(payload.get("tosses"))
-    if not profile_id:
-        return jsonify({"error": "profileId required"}), 400
-    if not question:
-        return jsonify({"error": "question required"}), 400
-    if tosses is None:
-        return jsonify({"error": "tosses invalid, expected 6 entries x 3 coins"}), 400
+def cast_request_key(profile_id, question, started_at, client_request_id=None):
+    """起卦请求的幂等键：优先用客户端的 Idempotency-Key / requestId，否则由档案、问题与起卦时间派生。"""
+    if client_request_id:
+        raw = f"{profile_id}|request|{client_request_id}"
+    else:
+        raw = f"{profile_id}|{question}|{started_at.isoformat()}"
+    return "cast:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
 
-    profile = fetch_profile(profile_id)
-    if not profile:
-        return jsonify({"error": "profile not found"}), 404
 
+def _fetch_cast_by_request_key(profile_id, profile, request_key):
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM one_thing_divinations WHERE request_key = %s", (request_key,))
+            row = cur.fetchone()
+    if row is None:
+        return None
+    return fetch_one_thing_divination_by_id(profile_id, row[0], profile.get("timezoneId", "Asia/Shanghai"))
+
+
+def perform_one_thing_cast(
+    profile_id, profile, question, tosses, started_at, recv_timeout=2, max_duration=4, request_key=None
+):
+    """排出卦象、请 Spark 解读（超时或解析失败时用规则兜底）并落库，返回存储后的记录。
+
+    在线请求用很短的超时保证响应速度；后台任务可放宽超时以拿到模型解读。
+    request_key 相同的请求只落库一次：已有记录时直接返回，不再调用 Spark。
+    """
+    if request_key:
+        existing = _fetch_cast_by_request_key(profile_id, profile, request_key)
+        if existing:
+            metric_inc("one_thing_cast_deduped_total")
+            return existing
     zone = _resolve_profile_zone(profile)
-    started_at = _parse_iso_datetime(payload.get("startedAt"))
     started_local = started_at.astimezone(zone)
     divination_date = started_local.date()
 
     try:
         from lunar_python import Solar
-    except ImportError:
-        return jsonify({"error": "lunar_python unavailable"}), 500
+    except ImportError as exc:
+        raise RuntimeError("lunar_python unavailable") from exc
 
     solar = Solar.fromYmdHms(
         started_local.year,
@@ -1725,8 +3394,10 @@ def cast_one_thing():
                 {"role": "system", "content": prompt},
                 {"role": "user", "content": "请输出六爻解读 JSON。"},
             ],
-            recv_timeout=2,
-            max_duration=4,
+            recv_timeout=recv_timeout,
+            max_duration=max_duration,
+            use_case="cast",
+            stop_on_json=True,
         )
         llm_parsed = parse_liuyao_response(llm_raw)
     except Exception as exc:  # noqa: BLE001
@@ -1761,9 +3432,10 @@ def cast_one_thing():
                     profile_id, divination_date, question, started_at,
                     ganzhi_year, ganzhi_month, ganzhi_day, ganzhi_hour, lunar_label,
                     tosses, lines, primary_hexagram, changed_hexagram, moving_lines,
-                    conclusion, summary, five_elements, advice, six_relatives
+                    conclusion, summary, five_elements, advice, six_relatives, request_key
                 )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (request_key) WHERE request_key IS NOT NULL DO NOTHING
                 RETURNING id
                 """,
                 (
@@ -1786,17 +3458,70 @@ def cast_one_thing():
                     five_elements,
                     advice,
                     psycopg2.extras.Json(six_relatives),
+                    request_key,
                 ),
             )
             inserted = cur.fetchone()
+    if inserted is None and request_key:
+        # 并发的同一请求先一步落库：以先写入的那条为准。
+        metric_inc("one_thing_cast_deduped_total")
+        stored = _fetch_cast_by_request_key(profile_id, profile, request_key)
+        if stored:
+            return stored
     new_id = inserted[0] if inserted else None
 
     stored = fetch_one_thing_divination_by_id(profile_id, new_id, profile.get("timezoneId", "Asia/Shanghai"))
     if not stored:
-        return jsonify({"error": "failed to persist divination"}), 500
+        raise RuntimeError("failed to persist divination")
+    return stored
+
+
+@app.post("/one-thing/cast")
+def cast_one_thing():
+    payload = request.get_json(silent=True) or {}
+    profile_id = payload.get("profileId") or payload.get("profile_id")
+    question = _clean_text(payload.get("question"))
+    tosses = _normalize_tosses(payload.get("tosses"))
+    if not profile_id:
+        return jsonify({"error": "profileId required"}), 400
+    if not question:
+        return jsonify({"error": "question required"}), 400
+    if tosses is None:
+        return jsonify({"error": "tosses invalid, expected 6 entries x 3 coins"}), 400
+
+    profile = fetch_profile(profile_id)
+    if not profile:
+        return jsonify({"error": "profile not found"}), 404
+
+    started_at = _parse_iso_datetime(payload.get("startedAt"))
+    request_key = cast_request_key(
+        profile_id,
+        question,
+        started_at,
+        request.headers.get("Idempotency-Key") or _clean_text(payload.get("requestId")),
+    )
+    if prefers_async():
+        job_id = enqueue_job(
+            "cast",
+            {
+                "profileId": str(profile_id),
+                "question": question,
+                "tosses": tosses,
+                "startedAt": started_at.isoformat(),
+                "requestKey": request_key,
+            },
+            dedupe_key=request_key,
+            owner=f"profile:{profile_id}",
+        )
+        return accepted_job_response(job_id)
+    try:
+        stored = perform_one_thing_cast(profile_id, profile, question, tosses, started_at, request_key=request_key)
+    except RuntimeError as exc:
+        return jsonify({"error": str(exc)}), 500
     return jsonify(stored)
 
 
+@traced("chart.compute")
 def build_chart_text(solar_year, solar_month, solar_day, solar_hour, solar_minute, longitude, gender=""):
     """使用 lunar_python 生成八字排盘文本。真太阳时：按经度修正时辰。"""
     try:
@@ -2141,6 +3866,213 @@ def chart():
     return jsonify(out)
 
 
+SMS_CODES = RedisCodeStore(REDIS) if REDIS is not None else MemoryCodeStore()
+
+
+def consume_sms_code(phone, code):
+    """校验验证码；成功返回 None，失败返回可直接返回给客户端的错误响应。"""
+    result = SMS_CODES.verify(phone, code, SMS_CODE_MAX_ATTEMPTS)
+    metric_inc("sms_code_verify_total", result=result)
+    if result == "locked":
+        return jsonify({"error": "too many attempts"}), 429
+    if result != "ok":
+        return jsonify({"error": "invalid code"}), 400
+    return None
+
+
+def _session_keys():
+    keys = {}
+    for item in SPARK_SESSION_KEYS.split(","):
+        kid, _, secret = item.strip().partition(":")
+        if kid and secret:
+            keys[kid] = secret.encode("utf-8")
+    if not keys:
+        # 未配置时使用进程级随机密钥：重启或多副本之间令牌互不认可，仅适合开发环境。
+        LOG.warning("session.ephemeral_key", reason="SPARK_SESSION_KEYS not set")
+        keys["dev"] = os.urandom(32)
+    return keys
+
+
+SESSIONS = SessionSigner(_session_keys(), SPARK_SESSION_TTL)
+
+
+def issue_session(user_id, profile_ids=None):
+    """签发会话令牌；profile_ids 缺省时查出该用户当前的全部档案。"""
+    if profile_ids is None:
+        with get_db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT id::text FROM profiles WHERE user_id = %s", (user_id,))
+                profile_ids = [row[0] for row in cur.fetchall()]
+    token, expires_at = SESSIONS.issue(user_id, profile_ids)
+    return {"token": token, "tokenExpiresAt": expires_at}
+
+
+def auth_user_response(user, **extra):
+    body = {"ok": True, **extra, "user": {
+        "id": str(user["id"]),
+        "phone": user["phone"],
+        "nickname": user["nickname"],
+    }}
+    body.update(issue_session(str(user["id"])))
+    return jsonify(body)
+
+
+def _claimed_ids():
+    """请求中声明的 (用户 id, 档案 id)，来自路径、查询参数或 JSON 请求体；POST /profiles 的 id 也算档案声明。"""
+    payload = request.get_json(silent=True) if request.is_json else None
+    payload = payload if isinstance(payload, dict) else {}
+    user_id = request.args.get("user_id") or request.args.get("userId") or payload.get("userId")
+    profile_id = (
+        (request.view_args or {}).get("profile_id")
+        or request.args.get("profile_id")
+        or request.args.get("profileId")
+        or payload.get("profileId")
+        or payload.get("profile_id")
+    )
+    if not profile_id and request.endpoint == "upsert_profile":
+        profile_id = payload.get("id")
+    return user_id, profile_id
+
+
+# 不带会话令牌也能访问的端点：换取令牌的 /auth/*、不涉及用户数据的公共接口，以及自带口令校验的调试接口。
+# 其余端点都会读写某个用户或档案的数据，必须带有效令牌；新增端点默认需要令牌，公开时须显式加入此表。
+ANONYMOUS_ENDPOINTS = frozenset({
+    "health",
+    "handshake",
+    "locations",
+    "geo_search",
+    "chart",
+    "prometheus_metrics",
+    "debug_spark_breaker",
+    "debug_db_plans",
+    "debug_metrics",
+    "send_sms_code",
+    "verify_sms_code",
+    "login_with_password",
+    "register_account",
+    "reset_password",
+})
+# 换取令牌的入口不校验令牌，客户端带着过期令牌也能重新登录。
+_TOKEN_EXCHANGE_ENDPOINTS = frozenset({
+    "send_sms_code", "verify_sms_code", "login_with_password", "register_account", "reset_password",
+})
+
+
+@app.before_request
+def _attach_session_identity():
+    """校验 Authorization: Bearer 令牌并把身份挂到 g.identity；只做 HMAC 计算，不查库。
+
+    无效或过期的令牌一律返回 401；不在 ANONYMOUS_ENDPOINTS 中的端点未带令牌时返回 401。
+    声明的 userId / profileId 必须属于令牌中的身份，否则返回 403。
+    """
+    g.identity = None
+    if request.endpoint is None or request.endpoint in _TOKEN_EXCHANGE_ENDPOINTS:
+        return None
+    header = request.headers.get("Authorization", "")
+    if header.startswith("Bearer "):
+        try:
+            claims = SESSIONS.verify(header[7:].strip())
+        except SessionError as exc:
+            metric_inc("session_token_total", result="rejected")
+            return jsonify({"error": str(exc)}), 401
+        metric_inc("session_token_total", result="ok")
+        g.identity = {"userId": claims["uid"], "profileIds": frozenset(claims.get("pids") or ())}
+    if g.identity is None:
+        if request.endpoint in ANONYMOUS_ENDPOINTS:
+            return None
+        metric_inc("session_token_total", result="missing")
+        return jsonify({"error": "authorization required"}), 401
+    user_id, profile_id = _claimed_ids()
+    if user_id and str(user_id) != g.identity["userId"]:
+        return jsonify({"error": "forbidden"}), 403
+    # POST /profiles 可以用令牌中还没有的 id 新建档案；该 id 已属于他人时由 upsert 的条件更新拒绝。
+    if profile_id and str(profile_id) not in g.identity["profileIds"] and request.endpoint != "upsert_profile":
+        return jsonify({"error": "forbidden"}), 403
+    return None
+
+
+@app.after_request
+def _attach_refreshed_session(response):
+    refreshed = getattr(g, "refreshed_session", None)
+    if refreshed is not None:
+        response.headers["X-Session-Token"] = refreshed["token"]
+    return response
+
+
+def _rate_rule(name, burst, per_minute):
+    # 每条规则可用 SPARK_RATE_<NAME>=<桶容量>,<每分钟补充数> 覆盖，例如 SPARK_RATE_SMS_SEND_PHONE=3,1
+    raw = os.getenv(f"SPARK_RATE_{name.upper()}")
+    if raw:
+        burst, per_minute = (float(part) for part in raw.split(","))
+    return {"name": name, "burst": float(burst), "rate": max(float(per_minute), 0.001) / 60.0}
+
+
+# 路由 -> [(限流维度, 规则)]；维度取值缺失（如请求体没有 phone）时跳过该条规则。
+RATE_LIMIT_RULES = {
+    "/auth/sms/send": [("phone", _rate_rule("sms_send_phone", 3, 1)), ("ip", _rate_rule("sms_send_ip", 20, 10))],
+    "/auth/sms/verify": [("phone", _rate_rule("sms_verify_phone", 10, 5)), ("ip", _rate_rule("sms_verify_ip", 30, 30))],
+    "/auth/login": [("phone", _rate_rule("login_phone", 5, 5)), ("ip", _rate_rule("login_ip", 30, 30))],
+    "/auth/password/reset": [("phone", _rate_rule("reset_phone", 5, 2)), ("ip", _rate_rule("reset_ip", 20, 10))],
+    "/auth/register": [("phone", _rate_rule("register_phone", 3, 1)), ("ip", _rate_rule("register_ip", 10, 5))],
+    "/spark/chat": [("user", _rate_rule("chat_user", 10, 20)), ("ip", _rate_rule("chat_ip", 30, 60))],
+    "/spark/chat/stream": [("user", _rate_rule("chat_user", 10, 20)), ("ip", _rate_rule("chat_ip", 30, 60))],
+    "/spark/title": [("user", _rate_rule("title_user", 10, 20)), ("ip", _rate_rule("title_ip", 30, 60))],
+    "/draws/daily": [("profile", _rate_rule("draw_profile", 5, 10)), ("ip", _rate_rule("draw_ip", 30, 60))],
+    "/draws/daily/stream": [("profile", _rate_rule("draw_profile", 5, 10)), ("ip", _rate_rule("draw_ip", 30, 60))],
+    "/one-thing/cast": [("profile", _rate_rule("cast_profile", 5, 10)), ("ip", _rate_rule("cast_ip", 30, 60))],
+}
+
+
+RATE_LIMITER = RedisTokenBuckets(REDIS) if REDIS is not None else LocalTokenBuckets()
+
+
+def client_ip():
+    if SPARK_TRUST_PROXY > 0:
+        hops = [part.strip() for part in request.headers.get("X-Forwarded-For", "").split(",") if part.strip()]
+        if len(hops) >= SPARK_TRUST_PROXY:
+            return hops[-SPARK_TRUST_PROXY]
+    return request.remote_addr or ""
+
+
+def _rate_limit_key(dimension):
+    if dimension == "ip":
+        return client_ip()
+    payload = request.get_json(silent=True) or {}
+    if dimension == "phone":
+        return (payload.get("phone") or "").strip()
+    if dimension == "profile":
+        return payload.get("profileId") or payload.get("profile_id") or ""
+    if g.identity is not None:
+        return g.identity["userId"]
+    return ""
+
+
+@app.before_request
+def _enforce_rate_limits():
+    """在任何数据库或上游调用之前按路由检查令牌桶；共享存储出错时放行，不让限流本身成为故障点。"""
+    if not SPARK_RATE_LIMIT or request.method != "POST" or request.url_rule is None:
+        return None
+    rules = RATE_LIMIT_RULES.get(request.url_rule.rule)
+    if not rules:
+        return None
+    for dimension, rule in rules:
+        key = _rate_limit_key(dimension)
+        if not key:
+            continue
+        try:
+            allowed, wait = RATE_LIMITER.take(f"{rule['name']}:{key}", rule["burst"], rule["rate"])
+        except (OSError, RedisError) as exc:
+            metric_inc("rate_limit_total", rule=rule["name"], result="error")
+            LOG.warning("rate_limit.error", rule=rule["name"], error=str(exc))
+            continue
+        if not allowed:
+            metric_inc("rate_limit_total", rule=rule["name"], result="limited")
+            retry_after = max(1, math.ceil(wait))
+            return jsonify({"error": "rate limited", "retryAfter": retry_after}), 429, {"Retry-After": str(retry_after)}
+        metric_inc("rate_limit_total", rule=rule["name"], result="allowed")
+    return None
+
+
 @app.post("/auth/sms/send")
 def send_sms_code():
     payload = request.get_json(silent=True) or {}
@@ -2148,16 +4080,8 @@ def send_sms_code():
     if not phone:
         return jsonify({"error": "phone required"}), 400
     code = f"{random.randint(0, 999999):06d}"
-    expires_in = 300
-    with get_db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO sms_codes (phone, code, expires_at)
-                VALUES (%s, %s, now() + interval '5 minutes')
-                """,
-                (phone, code),
-            )
+    expires_in = SMS_CODE_TTL
+    SMS_CODES.issue(phone, code, expires_in)
     debug_code = code if os.getenv("SMS_DEBUG", "1") == "1" else None
     return jsonify({"ok": True, "expires_in": expires_in, "code": debug_code})
 
@@ -2169,20 +4093,11 @@ def verify_sms_code():
     code = (payload.get("code") or "").strip()
     if not phone or not code:
         return jsonify({"error": "phone and code required"}), 400
+    rejected = consume_sms_code(phone, code)
+    if rejected is not None:
+        return rejected
     with get_db_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT id FROM sms_codes
-                WHERE phone = %s AND code = %s AND expires_at > now()
-                ORDER BY created_at DESC
-                LIMIT 1
-                """,
-                (phone, code),
-            )
-            sms = cur.fetchone()
-            if not sms:
-                return jsonify({"error": "invalid code"}), 400
             cur.execute(
                 """
                 SELECT id, phone, nickname
@@ -2193,11 +4108,7 @@ def verify_sms_code():
             )
             user = cur.fetchone()
     if user:
-        return jsonify({"ok": True, "user_exists": True, "user": {
-            "id": str(user["id"]),
-            "phone": user["phone"],
-            "nickname": user["nickname"],
-        }})
+        return auth_user_response(user, user_exists=True)
     return jsonify({"ok": True, "user_exists": False})
 
 
@@ -2221,13 +4132,15 @@ def login_with_password():
             user = cur.fetchone()
     if not user:
         return jsonify({"error": "user not found"}), 404
-    if not _verify_password(password, user["password_hash"]):
+    try:
+        ok, needs_rehash = PASSWORD_HASHER.verify(password, user["password_hash"])
+    except PasswordHasherBusy as exc:
+        return password_busy_response(exc)
+    if not ok:
         return jsonify({"error": "invalid password"}), 400
-    return jsonify({"ok": True, "user": {
-        "id": str(user["id"]),
-        "phone": user["phone"],
-        "nickname": user["nickname"],
-    }})
+    if needs_rehash:
+        PASSWORD_HASHER.rehash_later(str(user["id"]), password, user["password_hash"])
+    return auth_user_response(user)
 
 
 @app.post("/auth/register")
@@ -2240,7 +4153,10 @@ def register_account():
         return jsonify({"error": "phone, nickname, password required"}), 400
     if len(password) < 6:
         return jsonify({"error": "password too short"}), 400
-    password_hash = _hash_password(password)
+    try:
+        password_hash = PASSWORD_HASHER.hash(password)
+    except PasswordHasherBusy as exc:
+        return password_busy_response(exc)
     with get_db_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
             cur.execute("SELECT id FROM users WHERE phone = %s", (phone,))
@@ -2256,11 +4172,7 @@ def register_account():
                 (phone, nickname, password_hash),
             )
             user = cur.fetchone()
-    return jsonify({"ok": True, "user": {
-        "id": str(user["id"]),
-        "phone": user["phone"],
-        "nickname": user["nickname"],
-    }})
+    return auth_user_response(user)
 
 
 @app.post("/auth/password/reset")
@@ -2273,21 +4185,16 @@ def reset_password():
         return jsonify({"error": "phone, code, password required"}), 400
     if len(password) < 6:
         return jsonify({"error": "password too short"}), 400
+    rejected = consume_sms_code(phone, code)
+    if rejected is not None:
+        return rejected
+    try:
+        password_hash = PASSWORD_HASHER.hash(password)
+    except PasswordHasherBusy as exc:
+        return password_busy_response(exc)
 
     with get_db_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT id FROM sms_codes
-                WHERE phone = %s AND code = %s AND expires_at > now()
-                ORDER BY created_at DESC
-                LIMIT 1
-                """,
-                (phone, code),
-            )
-            sms = cur.fetchone()
-            if not sms:
-                return jsonify({"error": "invalid code"}), 400
             cur.execute(
                 "SELECT id FROM users WHERE phone = %s",
                 (phone,),
@@ -2295,7 +4202,6 @@ def reset_password():
             user = cur.fetchone()
             if not user:
                 return jsonify({"error": "user not found"}), 404
-            password_hash = _hash_password(password)
             cur.execute(
                 """
                 UPDATE users
@@ -2307,159 +4213,770 @@ def reset_password():
     return jsonify({"ok": True})
 
 
-def spark_chat(messages, recv_timeout=15, max_duration=120):
-    ws_url = create_signed_url()
-    if not ws_url:
-        return "服务端未配置 Spark 凭证，请联系管理员。"
-
-    payload = build_spark_payload(messages)
-    ws = websocket.create_connection(ws_url, timeout=recv_timeout, sslopt={"cert_reqs": ssl.CERT_NONE})
-    ws.settimeout(recv_timeout)
+def iter_spark_frames(
+    messages,
+    recv_timeout,
+    max_duration,
+    timeout_message="spark timeout",
+    cancel_event=None,
+    generation="chat",
+    poll_interval=None,
+    use_case="chat",
+):
+    """向 Spark 发送一次请求，逐帧产出 (status, content)；按用途记录首 token 延迟（区分是否命中连接池）、
+    总耗时与错误数。
+
+    连接失败与超时计入熔断器；cancel_event 被置位时提前结束并关闭连接。
+    设置 poll_interval 时，每隔该时长即使没有新帧也产出一次 (None, "")，供调用方刷新缓冲或检查取消。
+    """
+    gen = SPARK_GENERATION_PROFILES.get(generation) or SPARK_GENERATION_PROFILES["chat"]
+    payload_text = json.dumps(build_spark_payload(messages, gen))
+    is_trial = SPARK_BREAKER.before_call()
+    start_ts = time.time()
+    ws = None
+    first_token = True
+    first_frame = True
+    outcome = "cancelled"
+    span = start_span("spark.request", use_case=use_case, generation=generation)
     try:
-        ws.send(json.dumps(payload))
-        response_text = ""
-        start_ts = time.time()
+        connect_span = start_span("spark.connect", parent=span)
+        try:
+            ws, pooled = _open_spark_session(payload_text, recv_timeout, gen["url"])
+            connect_span.set("pooled", pooled)
+        except BaseException as exc:
+            connect_span.fail(f"{type(exc).__name__}: {exc}")
+            raise
+        finally:
+            connect_span.end()
+        if poll_interval:
+            ws.settimeout(min(poll_interval, recv_timeout))
+        last_frame_at = time.time()
         while True:
+            if cancel_event is not None and cancel_event.is_set():
+                return
             if max_duration and time.time() - start_ts > max_duration:
-                raise TimeoutError("spark timeout")
-            raw = ws.recv()
+                raise TimeoutError(timeout_message)
+            try:
+                raw = ws.recv()
+            except (socket.timeout, websocket.WebSocketTimeoutException) as exc:
+                if poll_interval and time.time() - last_frame_at < recv_timeout:
+                    yield None, ""
+                    continue
+                raise TimeoutError(timeout_message) from exc
+            last_frame_at = time.time()
             if SPARK_DEBUG_RESPONSE:
-                print("[spark_raw]", raw)
+                LOG.debug("spark.raw_frame", useCase=use_case, raw=raw)
             data = json.loads(raw)
             header = data.get("header", {})
             if header.get("code", 0) != 0:
-                raise RuntimeError(header.get("message", "spark error"))
+                raise SparkAPIError(header.get("message", "spark error"))
 
             choices = data.get("payload", {}).get("choices", {})
             status = choices.get("status", 0)
             text_items = choices.get("text", [])
-            if text_items:
-                content = text_items[0].get("content", "")
-                if content:
-                    response_text += content
+            content = text_items[0].get("content", "") if text_items else ""
+            if content and first_token:
+                first_token = False
+                span.add_event("first_token")
+                metric_observe(
+                    "spark_ttft_seconds", time.time() - start_ts, use_case=use_case, pooled="1" if pooled else "0"
+                )
+            if first_frame:
+                # 收到合法帧即说明上游可用；调用方提前结束（如 JSON 已完整）也不影响熔断判断。
+                first_frame = False
+                SPARK_BREAKER.record_success()
+            if status == 2:
+                outcome = "ok"
+            yield status, content
 
             if status == 2:
                 break
-        return response_text
+    except SparkAPIError:
+        outcome = "api_error"
+        SPARK_BREAKER.record_success()
+        raise
+    except (OSError, websocket.WebSocketException) as exc:
+        timed_out = isinstance(exc, (TimeoutError, socket.timeout, websocket.WebSocketTimeoutException))
+        outcome = "timeout" if timed_out else "connection_error"
+        SPARK_BREAKER.record_failure(exc)
+        raise
     finally:
-        ws.close()
+        metric_observe("spark_request_seconds", time.time() - start_ts, use_case=use_case, outcome=outcome)
+        span.set("outcome", outcome)
+        if outcome not in ("ok", "cancelled"):
+            span.fail(outcome)
+        span.end()
+        if outcome not in ("ok", "cancelled"):
+            metric_inc("spark_errors_total", use_case=use_case, kind=outcome)
+        if is_trial:
+            SPARK_BREAKER.record_abandoned()
+        if ws is not None:
+            ws.close()
+
+
+def spark_chat(
+    messages,
+    recv_timeout=15,
+    max_duration=120,
+    use_case="chat",
+    cancel_event=None,
+    generation=None,
+    stop_on_json=False,
+    on_partial=None,
+):
+    """generation 为 SPARK_GENERATION_PROFILES 中的档位名，缺省按 use_case 选择。
+
+    stop_on_json=True 时边收边解析，顶层 JSON 对象一旦完整即关闭连接并只返回该对象文本；
+    on_partial(fields) 在新的顶层字段完成时回调（fields 为目前已完成的全部顶层字段）。
+    """
+    if not create_signed_url():
+        return "服务端未配置 Spark 凭证，请联系管理员。"
+
+    SPARK_BREAKER.check()
+    generation = generation or SPARK_USE_CASE_GENERATION.get(use_case, "chat")
+    scanner = JsonObjectScanner() if stop_on_json or on_partial else None
+    partial_count = 0
+    response_text = ""
+    with SPARK_SCHEDULER.acquire(use_case):
+        frames = iter_spark_frames(
+            messages,
+            recv_timeout,
+            max_duration,
+            cancel_event=cancel_event,
+            generation=generation,
+            use_case=use_case,
+        )
+        try:
+            for status, content in frames:
+                if not content:
+                    continue
+                response_text += content
+                if scanner is None:
+                    continue
+                done = scanner.feed(content) is not None
+                if on_partial is not None:
+                    fields = scanner.partial()
+                    if len(fields) > partial_count:
+                        partial_count = len(fields)
+                        on_partial(fields)
+                if done and stop_on_json and status != 2:
+                    metric_inc("spark_json_early_stop_total", use_case=use_case)
+                    return scanner.text
+        finally:
+            frames.close()
+    return response_text
+
+
+def spark_chat_hedged(messages, use_case, hedge_delay=None, **kwargs):
+    """幂等短调用的对冲请求：首发超过 hedge_delay 未返回（或非限流类失败）时再发一路，取先成功者。"""
+    delay = SPARK_HEDGE_DELAY if hedge_delay is None else hedge_delay
+    if delay <= 0:
+        return spark_chat(messages, use_case=use_case, **kwargs)
+
+    results = queue.Queue()
+    cancel_event = threading.Event()
+
+    def attempt(tag):
+        try:
+            results.put((tag, True, spark_chat(messages, use_case=use_case, cancel_event=cancel_event, **kwargs)))
+        except Exception as exc:  # noqa: BLE001
+            results.put((tag, False, exc))
+
+    def launch(tag):
+        threading.Thread(target=attempt, args=(tag,), name=f"spark-hedge-{tag}", daemon=True).start()
+
+    launch("primary")
+    pending = 1
+    hedged = False
+    last_exc = None
+    while pending:
+        try:
+            tag, ok, value = results.get(timeout=None if hedged else delay)
+        except queue.Empty:
+            metric_inc("spark_hedge_total", use_case=use_case, reason="slow")
+            launch("hedge")
+            hedged = True
+            pending += 1
+            continue
+        pending -= 1
+        if ok:
+            cancel_event.set()
+            metric_inc("spark_hedge_winner_total", use_case=use_case, winner=tag)
+            return value
+        last_exc = value
+        if not hedged and not isinstance(value, SparkBusy):
+            metric_inc("spark_hedge_total", use_case=use_case, reason="error")
+            launch("hedge")
+            hedged = True
+            pending += 1
+    raise last_exc
+
+
+def normalize_title_key(text):
+    """标题缓存键：NFKC 归一化、忽略大小写，去掉空白、标点与控制字符。"""
+    normalized = unicodedata.normalize("NFKC", text or "").casefold()
+    return "".join(ch for ch in normalized if unicodedata.category(ch)[0] not in ("P", "Z", "C"))
+
+
+class TitleCache:
+    """首条消息 -> 聊天标题：内存 LRU 为第一层，title_cache 表为可选的持久层。
+
+    键为归一化文本的 sha256，问候语、推荐话题等高频开场白可直接命中。持久层出错时只记日志，不影响生成标题。
+    """
+
+    def __init__(self, capacity, persistent, max_chars):
+        self.capacity = max(1, capacity)
+        self.persistent = persistent
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def key_for(self, text):
+        normalized = normalize_title_key(text)
+        if not normalized or len(normalized) > self.max_chars:
+            return None
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, title):
+        with self._lock:
+            self._entries[key] = title
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            title = self._entries.get(key)
+            if title is not None:
+                self._entries.move_to_end(key)
+        if title is not None:
+            metric_inc("title_cache_total", result="hit")
+            return title
+        if self.persistent:
+            try:
+                with get_db_conn() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            """
+                            UPDATE title_cache
+                            SET hits = hits + 1, last_used_at = now()
+                            WHERE key_hash = %s
+                            RETURNING title
+                            """,
+                            (key,),
+                        )
+                        row = cur.fetchone()
+            except psycopg2.Error as exc:
+                LOG.warning("title_cache.read_failed", error=str(exc))
+                row = None
+            if row:
+                self._remember(key, row[0])
+                metric_inc("title_cache_total", result="db_hit")
+                return row[0]
+        metric_inc("title_cache_total", result="miss")
+        return None
+
+    def put(self, key, title):
+        self._remember(key, title)
+        if not self.persistent:
+            return
+        try:
+            with get_db_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        INSERT INTO title_cache (key_hash, title)
+                        VALUES (%s, %s)
+                        ON CONFLICT (key_hash) DO UPDATE
+                        SET title = EXCLUDED.title, last_used_at = now()
+                        """,
+                        (key, title),
+                    )
+        except psycopg2.Error as exc:
+            LOG.warning("title_cache.write_failed", error=str(exc))
+
+
+TITLE_CACHE = TitleCache(SPARK_TITLE_CACHE_SIZE, SPARK_TITLE_CACHE_PERSIST, SPARK_TITLE_CACHE_MAX_CHARS)
 
 
 def spark_title(text):
+    key = TITLE_CACHE.key_for(text)
+    if key is not None:
+        cached = TITLE_CACHE.get(key)
+        if cached is not None:
+            return cached
     prompt_messages = [
         {"role": "system", "content": SPARK_TITLE_PROMPT},
         {"role": "user", "content": text},
     ]
-    title = spark_chat(prompt_messages)
+    title = spark_chat_hedged(prompt_messages, use_case="title")
     if "未配置 Spark 凭证" in title:
         return "新建聊天"
-    return title.strip().strip("“”\"")
-
-
-def spark_chat_stream(messages, recv_timeout=45, max_duration=180):
-    ws_url = create_signed_url()
-    if not ws_url:
+    title = title.strip().strip("“”\"")
+    if key is not None and title:
+        TITLE_CACHE.put(key, title)
+    return title
+
+
+def spark_chat_stream(
+    messages,
+    recv_timeout=45,
+    max_duration=180,
+    slot=None,
+    generation="chat",
+    poll_interval=None,
+    cancel_event=None,
+):
+    """流式调用 Spark；slot 为调用方预先取得的调度名额（用于在返回 SSE 之前完成限流判断）。
+
+    产出文本片段；空帧与 poll_interval 到期时产出 None。cancel_event 置位后关闭上游连接并结束。
+    """
+    if not create_signed_url():
+        if slot is not None:
+            slot.release()
         yield "服务端未配置 Spark 凭证，请联系管理员。"
         return
 
-    payload = build_spark_payload(messages)
-    ws = websocket.create_connection(
-        ws_url,
-        timeout=recv_timeout,
-        sslopt={"cert_reqs": ssl.CERT_NONE},
-    )
-    ws.settimeout(recv_timeout)
-    start_ts = time.time()
+    slot = slot or SPARK_SCHEDULER.acquire("stream")
     try:
-        ws.send(json.dumps(payload))
-        while True:
-            if max_duration and time.time() - start_ts > max_duration:
-                raise TimeoutError("spark stream timeout")
-            try:
-                raw = ws.recv()
-            except (socket.timeout, websocket.WebSocketTimeoutException) as exc:
-                raise TimeoutError("spark stream timeout") from exc
-            if SPARK_DEBUG_RESPONSE:
-                print("[spark_raw]", raw)
-            data = json.loads(raw)
-            header = data.get("header", {})
-            if header.get("code", 0) != 0:
-                raise RuntimeError(header.get("message", "spark error"))
+        frames = iter_spark_frames(
+            messages,
+            recv_timeout,
+            max_duration,
+            timeout_message="spark stream timeout",
+            generation=generation,
+            poll_interval=poll_interval,
+            cancel_event=cancel_event,
+            use_case="stream",
+        )
+        try:
+            for _, content in frames:
+                yield content or None
+        finally:
+            frames.close()
+    finally:
+        slot.release()
 
-            choices = data.get("payload", {}).get("choices", {})
-            status = choices.get("status", 0)
-            text_items = choices.get("text", [])
-            if text_items:
-                content = text_items[0].get("content", "")
-                if content:
-                    yield content
-                else:
-                    yield None
+
+def client_disconnected(environ):
+    """探测 SSE 客户端是否已断开：对端关闭后套接字可读且 peek 到 EOF。
+
+    只有 werkzeug 服务器在 environ 中暴露原始套接字；拿不到套接字（或 TLS 套接字不支持 peek）时
+    返回 False，退回到写失败时才发现断开。
+    """
+    sock = environ.get("werkzeug.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError:
+        return False
+    except OSError:
+        return True
+
+
+class StreamReplayGone(Exception):
+    """请求续传的事件已被挤出重放缓冲。"""
+
+
+class StreamSession:
+    """一次流式对话：后台线程拉取 Spark 并写入有界重放缓冲，SSE 连接只是缓冲的读者。
+
+    事件按递增 id 编号；断线重连时凭 Last-Event-ID 从缓冲续传。没有读者超过宽限期即取消上游。
+    owner 为发起方（见 request_owner），取消与续传只对同一发起方开放。
+    """
+
+    TERMINAL_KINDS = ("done", "error", "cancelled")
+
+    def __init__(self, stream_id, replay_events, started=None, owner=None):
+        self.stream_id = stream_id
+        self.owner = owner
+        self.cancel_event = threading.Event()
+        self.started = started or time.time()
+        self.headers = {}
+        self.finished_at = None
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=max(1, replay_events))
+        self._next_id = 1
+        self._readers = 0
+        self._detached_at = self.started
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def publish(self, kind, text):
+        with self._cond:
+            if self.finished_at is not None:
+                return
+            self._events.append((self._next_id, kind, text))
+            self._next_id += 1
+            if kind in self.TERMINAL_KINDS:
+                self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def check_resumable(self, last_event_id):
+        with self._cond:
+            oldest = self._events[0][0] if self._events else self._next_id
+            if last_event_id + 1 < oldest:
+                raise StreamReplayGone(f"events before {oldest} are no longer buffered")
+
+    def read_after(self, last_event_id, timeout):
+        """返回 (last_event_id 之后的事件, 是否已结束)；无新事件时最多等待 timeout 秒。"""
+        with self._cond:
+            if self._next_id <= last_event_id + 1 and self.finished_at is None:
+                self._cond.wait(timeout)
+            oldest = self._events[0][0] if self._events else self._next_id
+            if last_event_id + 1 < oldest:
+                raise StreamReplayGone(f"events before {oldest} are no longer buffered")
+            events = [event for event in self._events if event[0] > last_event_id]
+            return events, self.finished_at is not None
+
+    def attach(self):
+        with self._cond:
+            self._readers += 1
+
+    def detach(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._detached_at = time.time()
+
+    def abandoned(self, now, grace):
+        with self._cond:
+            return self._readers == 0 and now - self._detached_at >= grace
+
+
+class StreamRegistry:
+    """进行中及刚结束的流式对话：按 streamId 查找以便取消或续传，结束后保留 retention 秒。
+
+    同时用已完成流的平均时长估算取消节省的上游时间。
+    """
+
+    def __init__(self, replay_events, retention, ema_alpha=0.2):
+        self.replay_events = replay_events
+        self.retention = retention
+        self.ema_alpha = ema_alpha
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._typical_duration = None
+
+    def _purge_locked(self, now):
+        expired = [
+            stream_id
+            for stream_id, session in self._streams.items()
+            if session.finished and now - session.finished_at > self.retention
+        ]
+        for stream_id in expired:
+            del self._streams[stream_id]
+        metric_set("spark_streams_active", sum(1 for session in self._streams.values() if not session.finished))
+
+    def register(self, stream_id, started=None, owner=None):
+        with self._lock:
+            self._purge_locked(time.time())
+            if stream_id in self._streams:
+                return None
+            session = StreamSession(stream_id, self.replay_events, started, owner)
+            self._streams[stream_id] = session
+            metric_set("spark_streams_active", sum(1 for s in self._streams.values() if not s.finished))
+        return session
+
+    def get(self, stream_id):
+        with self._lock:
+            self._purge_locked(time.time())
+            return self._streams.get(stream_id)
+
+    def discard(self, stream_id):
+        with self._lock:
+            self._streams.pop(stream_id, None)
+
+    def cancel(self, stream_id):
+        """取消进行中的流；不存在、已结束或不属于当前请求方时返回 False。"""
+        session = self.get(stream_id)
+        if session is None or session.finished or not owner_matches(session.owner):
+            return False
+        session.cancel_event.set()
+        return True
+
+    def record_completed(self, duration):
+        metric_observe("spark_stream_duration_seconds", duration)
+        with self._lock:
+            if self._typical_duration is None:
+                self._typical_duration = duration
             else:
-                yield None
+                self._typical_duration += self.ema_alpha * (duration - self._typical_duration)
 
-            if status == 2:
-                break
-    finally:
-        ws.close()
+    def record_cancelled(self, reason, elapsed):
+        metric_inc("spark_stream_cancelled_total", reason=reason)
+        with self._lock:
+            typical = self._typical_duration
+        if typical is not None and typical > elapsed:
+            metric_inc("spark_stream_saved_seconds_total", typical - elapsed, reason=reason)
+
+
+ACTIVE_STREAMS = StreamRegistry(SPARK_STREAM_REPLAY_EVENTS, SPARK_STREAM_REPLAY_TTL)
+
+
+def sse_data(text, event_id=None, event=None):
+    safe = text.replace("\r", "").replace("\n", "\\n")
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}\n")
+    if event is not None:
+        lines.append(f"event: {event}\n")
+    lines.append(f"data: {safe}\n\n")
+    payload = "".join(lines)
+    metric_inc("sse_events_total")
+    metric_inc("sse_bytes_total", len(payload.encode("utf-8")))
+    return payload
 
 
 @app.post("/spark/chat")
 def chat():
     payload = request.get_json(silent=True) or {}
-    messages = payload.get("messages", [])
     profile_id = payload.get("profileId")
     tianshi_id = payload.get("tianshiId")
-    if not isinstance(messages, list) or not messages:
-        return jsonify({"error": "messages required"}), 400
+    owner = request_owner()
     try:
-        profile = fetch_profile(profile_id) if profile_id else {}
-        chat_messages = build_chat_messages(messages, profile, tianshi_id)
-        print(f"[chat] profileId={profile_id} tianshiId={tianshi_id} profile_found={bool(profile)}")
-        print(chat_messages)
+        conversation_id, messages, new_message = resolve_chat_input(payload)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    except PermissionError as exc:
+        return jsonify({"error": str(exc)}), 403
+    except Exception as exc:  # noqa: BLE001
+        LOG.error("chat.error", error=str(exc))
+        return jsonify({"error": str(exc)}), 500
+    try:
+        chat_messages, usage, timing, profile_found = assemble_chat_prompt(
+            messages, profile_id, tianshi_id, conversation_id
+        )
+        LOG.info(
+            "chat.request",
+            profileId=profile_id,
+            tianshiId=tianshi_id,
+            profileFound=profile_found,
+            tokensBefore=usage["promptTokensBefore"],
+            tokens=usage["promptTokens"],
+        )
+        LOG.debug("chat.prompt", messages=summarize_messages(chat_messages))
         answer = spark_chat(chat_messages)
-        return jsonify({"content": answer})
+        body = {"content": answer, "usage": usage}
+        if conversation_id is not None:
+            CONVERSATIONS.append(conversation_id, [new_message, {"role": "assistant", "content": answer}], owner)
+            body["conversationId"] = conversation_id
+        return jsonify(body), 200, usage_headers(usage, timing)
+    except SparkBusy as exc:
+        return spark_busy_response(exc)
     except Exception as exc:  # noqa: BLE001
-        print(f"[chat_error] {exc}")
+        LOG.error("chat.error", error=str(exc))
         return jsonify({"error": str(exc)}), 500
 
 
-@app.post("/spark/chat/stream")
-def chat_stream():
-    payload = request.get_json(silent=True) or {}
-    messages = payload.get("messages", [])
-    profile_id = payload.get("profileId")
-    tianshi_id = payload.get("tianshiId")
-    if not isinstance(messages, list) or not messages:
-        return jsonify({"error": "messages required"}), 400
-
-    def generate():
-        try:
-            profile = fetch_profile(profile_id) if profile_id else {}
-            chat_messages = build_chat_messages(messages, profile, tianshi_id)
-            print(f"[chat_stream] profileId={profile_id} tianshiId={tianshi_id} profile_found={bool(profile)}")
-            print(chat_messages)
-            last_keep_alive = 0.0
-            for chunk in spark_chat_stream(chat_messages):
-                if chunk is None:
-                    now = time.time()
-                    if now - last_keep_alive >= 5:
-                        yield ": keep-alive\n\n"
-                        last_keep_alive = now
+def run_chat_stream(session, chat_messages, slot, conversation_id, new_message, owner=None):
+    """后台生成：拉取 Spark、合并片段并写入 session 的重放缓冲；对话历史在此落库，与客户端是否在线无关。"""
+    cancel_reason = None
+    frames = None
+    try:
+        answer_parts = []
+        coalescer = SSECoalescer(SPARK_SSE_COALESCE_MS / 1000.0, SPARK_SSE_COALESCE_BYTES)
+        first_token = True
+        poll_interval = min(coalescer.window or SPARK_STREAM_POLL_INTERVAL, SPARK_STREAM_POLL_INTERVAL)
+        frames = spark_chat_stream(
+            chat_messages, slot=slot, poll_interval=poll_interval, cancel_event=session.cancel_event
+        )
+        for chunk in frames:
+            now = time.time()
+            if session.cancel_event.is_set():
+                cancel_reason = "client_cancel"
+                break
+            if session.abandoned(now, SPARK_STREAM_RESUME_GRACE):
+                cancel_reason = "disconnect"
+                break
+            if chunk is None:
+                text = coalescer.poll(now)
+                if text is None:
                     continue
-                safe = chunk.replace("\r", "").replace("\n", "\\n")
-                yield f"data: {safe}\n\n"
-            yield "event: done\ndata: [DONE]\n\n"
-        except Exception as exc:  # noqa: BLE001
-            print(f"[chat_stream_error] {exc}")
-            safe = str(exc).replace("\r", "").replace("\n", "\\n")
-            yield f"event: error\ndata: {safe}\n\n"
+            else:
+                answer_parts.append(chunk)
+                text = coalescer.push(chunk, now)
+                if text is None:
+                    continue
+            if first_token:
+                first_token = False
+                metric_observe("sse_first_token_seconds", now - session.started)
+            session.publish("data", text)
+        if cancel_reason is None and session.cancel_event.is_set():
+            cancel_reason = "client_cancel"
+        tail = coalescer.flush()
+        if tail:
+            session.publish("data", tail)
+        if cancel_reason is not None:
+            session.publish("cancelled", "[CANCELLED]")
+            return
+        ACTIVE_STREAMS.record_completed(time.time() - session.started)
+        if conversation_id is not None:
+            answer = "".join(answer_parts)
+            CONVERSATIONS.append(conversation_id, [new_message, {"role": "assistant", "content": answer}], owner)
+        session.publish("done", "[DONE]")
+    except Exception as exc:  # noqa: BLE001
+        LOG.error("chat_stream.error", stream=session.stream_id, error=str(exc))
+        session.publish("error", str(exc))
+    finally:
+        if frames is not None:
+            frames.close()
+        slot.release()
+        # 兜底：任何路径退出都要让读者看到终止事件。
+        session.publish("error", "stream aborted")
+        if cancel_reason is not None:
+            elapsed = time.time() - session.started
+            ACTIVE_STREAMS.record_cancelled(cancel_reason, elapsed)
+            LOG.info("chat_stream.cancelled", stream=session.stream_id, reason=cancel_reason, elapsed=round(elapsed, 1))
+
+
+def stream_session_events(session, last_event_id, environ):
+    """把 session 缓冲中 last_event_id 之后的事件写给一个 SSE 连接；连接断开只会解除读者登记。"""
+    session.attach()
+    last_activity = time.time()
+    try:
+        while True:
+            try:
+                events, finished = session.read_after(last_event_id, SPARK_STREAM_POLL_INTERVAL)
+            except StreamReplayGone as exc:
+                yield sse_data(str(exc), event="error")
+                return
+            for event_id, kind, text in events:
+                yield sse_data(text, event_id, None if kind == "data" else kind)
+                last_event_id = event_id
+            if finished:
+                return
+            now = time.time()
+            if events:
+                last_activity = now
+                continue
+            if client_disconnected(environ):
+                return
+            if now - last_activity >= 5:
+                yield ": keep-alive\n\n"
+                last_activity = now
+    finally:
+        session.detach()
+
 
+def parse_stream_id(raw):
+    """streamId 必须是 UUID（规范化为小写带连字符的形式），否则返回 None。"""
+    try:
+        return str(uuid.UUID(str(raw)))
+    except ValueError:
+        return None
+
+
+def last_event_id_from_request():
+    raw = request.headers.get("Last-Event-ID") or request.args.get("lastEventId") or "0"
+    try:
+        return max(0, int(raw))
+    except ValueError:
+        return 0
+
+
+def stream_session_response(session, last_event_id):
+    try:
+        session.check_resumable(last_event_id)
+    except StreamReplayGone as exc:
+        return jsonify({"error": str(exc)}), 410
     headers = {
         "Cache-Control": "no-cache",
         "X-Accel-Buffering": "no",
+        "X-Stream-Id": session.stream_id,
     }
-    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+    headers.update(session.headers)
+    if last_event_id:
+        metric_inc("spark_stream_resumed_total")
+    return Response(
+        stream_with_context(stream_session_events(session, last_event_id, request.environ)),
+        mimetype="text/event-stream",
+        headers=headers,
+    )
+
+
+@app.post("/spark/chat/stream")
+def chat_stream():
+    request_started = time.time()
+    payload = request.get_json(silent=True) or {}
+    profile_id = payload.get("profileId")
+    tianshi_id = payload.get("tianshiId")
+    owner = request_owner()
+    stream_id = parse_stream_id(payload.get("streamId")) if payload.get("streamId") else str(uuid.uuid4())
+    if stream_id is None:
+        return jsonify({"error": "invalid streamId"}), 400
+    existing = ACTIVE_STREAMS.get(stream_id)
+    if existing is not None:
+        # 同一发起方以同一 streamId 重发视为断线重连：从缓冲续传，不再重新生成。
+        if not owner_matches(existing.owner):
+            return jsonify({"error": "streamId already in use"}), 409
+        return stream_session_response(existing, last_event_id_from_request())
+    try:
+        conversation_id, messages, new_message = resolve_chat_input(payload)
+        chat_messages, usage, timing, profile_found = assemble_chat_prompt(
+            messages, profile_id, tianshi_id, conversation_id
+        )
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    except PermissionError as exc:
+        return jsonify({"error": str(exc)}), 403
+    except Exception as exc:  # noqa: BLE001
+        LOG.error("chat_stream.error", error=str(exc))
+        return jsonify({"error": str(exc)}), 500
+    session = ACTIVE_STREAMS.register(stream_id, started=request_started, owner=owner)
+    if session is None:
+        return jsonify({"error": "streamId already in use"}), 409
+    try:
+        SPARK_BREAKER.check()
+        slot = SPARK_SCHEDULER.acquire("stream")
+    except SparkBusy as exc:
+        ACTIVE_STREAMS.discard(stream_id)
+        return spark_busy_response(exc)
+
+    LOG.info(
+        "chat_stream.request",
+        stream=stream_id,
+        profileId=profile_id,
+        tianshiId=tianshi_id,
+        profileFound=profile_found,
+        tokensBefore=usage["promptTokensBefore"],
+        tokens=usage["promptTokens"],
+    )
+    LOG.debug("chat_stream.prompt", stream=stream_id, messages=summarize_messages(chat_messages))
+    session.headers = usage_headers(usage, timing)
+    if conversation_id is not None:
+        session.headers["X-Conversation-Id"] = conversation_id
+    threading.Thread(
+        target=run_with_span,
+        args=(current_span(), run_chat_stream, session, chat_messages, slot, conversation_id, new_message, owner),
+        name=f"spark-stream-{stream_id[:8]}",
+        daemon=True,
+    ).start()
+    return stream_session_response(session, 0)
+
+
+@app.get("/spark/chat/stream/<stream_id>")
+def resume_chat_stream(stream_id):
+    stream_id = parse_stream_id(stream_id)
+    session = ACTIVE_STREAMS.get(stream_id) if stream_id else None
+    if session is None or not owner_matches(session.owner):
+        return jsonify({"error": "stream not found"}), 404
+    return stream_session_response(session, last_event_id_from_request())
+
+
+@app.post("/spark/chat/stream/<stream_id>/cancel")
+def cancel_chat_stream(stream_id):
+    stream_id = parse_stream_id(stream_id)
+    # 不属于请求方的流与不存在的流一样返回 404，不泄露 streamId 是否有效。
+    if stream_id is None or not ACTIVE_STREAMS.cancel(stream_id):
+        return jsonify({"error": "stream not found"}), 404
+    return jsonify({"streamId": stream_id, "cancelled": True})
 
 
 @app.post("/spark/title")
@@ -2468,13 +4985,405 @@ def chat_title():
     text = (payload.get("text") or "").strip()
     if not text:
         return jsonify({"error": "text required"}), 400
+    if prefers_async():
+        key = TITLE_CACHE.key_for(text)
+        owner = request_owner()
+        # 去重键带上归属方：他人的同文本任务不会被复用（结果仍经 TITLE_CACHE 共享）。
+        job_id = enqueue_job("title", {"text": text}, dedupe_key=f"title:{owner}:{key}" if key else None, owner=owner)
+        return accepted_job_response(job_id)
     try:
         title = spark_title(text)
         return jsonify({"title": title})
+    except SparkBusy as exc:
+        return spark_busy_response(exc)
     except Exception as exc:  # noqa: BLE001
         return jsonify({"error": str(exc)}), 500
 
 
+JOB_TYPES = {}
+
+
+def job_type(name, concurrency=2, visibility_timeout=120, max_attempts=5):
+    """登记后台任务类型。concurrency 为所有 worker 合计的并发上限，可用 SPARK_JOB_<类型>_CONCURRENCY 覆盖；
+    visibility_timeout 秒内未完成的任务视为 worker 失联，可被其他 worker 重新领取。"""
+
+    def decorator(func):
+        env_prefix = f"SPARK_JOB_{name.upper()}"
+        JOB_TYPES[name] = {
+            "handler": func,
+            "concurrency": int(os.getenv(f"{env_prefix}_CONCURRENCY", str(concurrency))),
+            "visibility_timeout": float(os.getenv(f"{env_prefix}_TIMEOUT", str(visibility_timeout))),
+            "max_attempts": int(os.getenv(f"{env_prefix}_MAX_ATTEMPTS", str(max_attempts))),
+        }
+        return func
+
+    return decorator
+
+
+def prefers_async():
+    return "respond-async" in (request.headers.get("Prefer") or "").lower()
+
+
+def accepted_job_response(job_id, body=None):
+    payload = dict(body or {})
+    payload.update({"jobId": job_id, "status": "queued"})
+    headers = {"Location": f"/jobs/{job_id}", "Preference-Applied": "respond-async"}
+    return jsonify(payload), 202, headers
+
+
+def enqueue_job(job_type_name, payload, dedupe_key=None, owner=None):
+    """写入一条待执行任务并返回 id；dedupe_key 相同且尚未结束的任务只保留一条，返回已有任务的 id。
+
+    owner 为可查看任务结果的一方（user:/profile:），共用 dedupe_key 的请求应给出相同的 owner。
+    """
+    return submit_job(job_type_name, payload, dedupe_key, owner)[0]
+
+
+def submit_job(job_type_name, payload, dedupe_key=None, owner=None):
+    """同 enqueue_job，但返回 (任务 id, 是否新插入)；被去重合并到已有任务时第二项为 False。"""
+    spec = JOB_TYPES[job_type_name]
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            # 冲突的任务可能恰好在两条语句之间结束，此时重试一次插入。
+            for _ in range(2):
+                cur.execute(
+                    """
+                    INSERT INTO jobs (job_type, payload, max_attempts, dedupe_key, owner)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (dedupe_key) WHERE dedupe_key IS NOT NULL AND status IN ('queued', 'running')
+                    DO NOTHING
+                    RETURNING id::text
+                    """,
+                    (job_type_name, psycopg2.extras.Json(payload), spec["max_attempts"], dedupe_key, owner),
+                )
+                row = cur.fetchone()
+                if row is not None:
+                    metric_inc("jobs_enqueued_total", job_type=job_type_name, deduped="0")
+                    return row[0], True
+                cur.execute(
+                    """
+                    SELECT id::text FROM jobs
+                    WHERE dedupe_key = %s AND status IN ('queued', 'running')
+                    """,
+                    (dedupe_key,),
+                )
+                row = cur.fetchone()
+                if row is not None:
+                    metric_inc("jobs_enqueued_total", job_type=job_type_name, deduped="1")
+                    return row[0], False
+    raise RuntimeError(f"failed to enqueue {job_type_name} job")
+
+
+def claim_job(job_type_name, worker_id):
+    """领取一条到期任务：同类型的领取用事务级 advisory 锁串行化，以便在所有 worker 间执行并发上限。"""
+    spec = JOB_TYPES[job_type_name]
+    with get_db_conn() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s)) AS locked", (f"jobs:{job_type_name}",))
+            if not cur.fetchone()["locked"]:
+                return None
+            cur.execute(
+                """
+                SELECT count(*) AS running FROM jobs
+                WHERE job_type = %s AND status = 'running' AND locked_until > now()
+                """,
+                (job_type_name,),
+            )
+            if cur.fetchone()["running"] >= spec["concurrency"]:
+                return None
+            cur.execute(
+                """
+                UPDATE jobs
+                SET status = 'running',
+                    attempts = attempts + 1,
+                    locked_until = now() + make_interval(secs => %s),
+                    locked_by = %s,
+                    updated_at = now()
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE job_type = %s
+                      AND run_at <= now()
+                      AND attempts < max_attempts
+                      AND (status = 'queued' OR (status = 'running' AND locked_until < now()))
+                    ORDER BY run_at
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id::text, job_type, payload, attempts, max_attempts,
+                          extract(epoch FROM now() - run_at) AS queued_seconds
+                """,
+                (spec["visibility_timeout"], worker_id, job_type_name),
+            )
+            return cur.fetchone()
+
+
+def complete_job(job, worker_id, result):
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE jobs
+                SET status = 'succeeded', result = %s, last_error = NULL,
+                    locked_until = NULL, updated_at = now()
+                WHERE id = %s AND locked_by = %s AND status = 'running'
+                """,
+                (psycopg2.extras.Json(result), job["id"], worker_id),
+            )
+
+
+def fail_job(job, worker_id, exc):
+    """失败的任务按指数退避（带抖动）重新排队；SparkBusy 给出的 Retry-After 作为下限，次数用尽后标记 failed。"""
+    delay = min(SPARK_JOB_BACKOFF_MAX, SPARK_JOB_BACKOFF_BASE * 2 ** max(0, job["attempts"] - 1))
+    delay *= 0.5 + random.random() / 2
+    if isinstance(exc, SparkBusy):
+        delay = max(delay, exc.retry_after)
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE jobs
+                SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                    run_at = now() + make_interval(secs => %s),
+                    last_error = %s,
+                    locked_until = NULL,
+                    locked_by = NULL,
+                    updated_at = now()
+                WHERE id = %s AND locked_by = %s AND status = 'running'
+                RETURNING status
+                """,
+                (delay, str(exc)[:2000], job["id"], worker_id),
+            )
+            row = cur.fetchone()
+    return row[0] if row else None
+
+
+def sweep_jobs():
+    """把超时且次数用尽的任务标记为 failed，并清理保留期外的已结束任务。"""
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE jobs
+                SET status = 'failed', last_error = COALESCE(last_error, 'visibility timeout'),
+                    locked_until = NULL, updated_at = now()
+                WHERE status = 'running' AND locked_until < now() AND attempts >= max_attempts
+                """
+            )
+            expired = cur.rowcount
+            cur.execute(
+                """
+                DELETE FROM jobs
+                WHERE status IN ('succeeded', 'failed') AND updated_at < now() - %s * interval '1 day'
+                """,
+                (SPARK_JOB_RETENTION_DAYS,),
+            )
+    if expired:
+        metric_inc("jobs_finished_total", expired, job_type="*", result="timeout")
+
+
+def purge_expired_sms_codes(batch_size=None, max_batches=100):
+    """分批删除过期超过保留期的验证码；每批单独提交，避免长事务与大范围锁。返回删除行数。"""
+    batch_size = batch_size or SPARK_SMS_PURGE_BATCH
+    deleted = 0
+    for _ in range(max_batches):
+        with get_db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    DELETE FROM sms_codes
+                    WHERE id IN (
+                        SELECT id FROM sms_codes
+                        WHERE expires_at < now() - %s * interval '1 hour'
+                        LIMIT %s
+                    )
+                    """,
+                    (SPARK_SMS_RETENTION_HOURS, batch_size),
+                )
+                count = cur.rowcount
+        deleted += count
+        if count < batch_size:
+            break
+    if deleted:
+        metric_inc("sms_codes_purged_total", deleted)
+    return deleted
+
+
+class JobWorker:
+    """独立于 Web 进程运行的任务 worker（python spark_server.py worker），可按需横向扩展。"""
+
+    def __init__(self, threads, poll_interval):
+        self.threads = max(1, threads)
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def run(self):
+        LOG.info("jobs.worker_started", worker=self.worker_id, threads=self.threads, types=sorted(JOB_TYPES))
+        for index in range(self.threads):
+            threading.Thread(target=self._loop, name=f"job-worker-{index}", daemon=True).start()
+        while True:
+            try:
+                sweep_jobs()
+            except Exception as exc:  # noqa: BLE001
+                LOG.error("jobs.sweep_failed", worker=self.worker_id, error=str(exc))
+            try:
+                purge_expired_sms_codes()
+            except Exception as exc:  # noqa: BLE001
+                LOG.error("jobs.sms_purge_failed", worker=self.worker_id, error=str(exc))
+            time.sleep(60)
+
+    def _claim_next(self):
+        names = list(JOB_TYPES)
+        offset = random.randrange(len(names))
+        for name in names[offset:] + names[:offset]:
+            job = claim_job(name, self.worker_id)
+            if job is not None:
+                return job
+        return None
+
+    def _loop(self):
+        while True:
+            try:
+                job = self._claim_next()
+            except Exception as exc:  # noqa: BLE001
+                LOG.error("jobs.claim_failed", worker=self.worker_id, error=str(exc))
+                job = None
+            if job is None:
+                time.sleep(self.poll_interval * (0.5 + random.random()))
+                continue
+            self.execute(job)
+
+    def execute(self, job):
+        job_type_name = job["job_type"]
+        metric_observe("jobs_queue_seconds", max(0.0, float(job["queued_seconds"] or 0)), job_type=job_type_name)
+        started = time.time()
+        try:
+            result = JOB_TYPES[job_type_name]["handler"](job["payload"])
+        except Exception as exc:  # noqa: BLE001
+            status = fail_job(job, self.worker_id, exc)
+            metric_inc("jobs_finished_total", job_type=job_type_name, result="failed" if status == "failed" else "retry")
+            LOG.warning(
+                "jobs.attempt_failed",
+                jobType=job_type_name,
+                jobId=job["id"],
+                attempt=job["attempts"],
+                maxAttempts=job["max_attempts"],
+                status=status,
+                error=str(exc),
+            )
+            return
+        finally:
+            metric_observe("jobs_run_seconds", time.time() - started, job_type=job_type_name)
+        complete_job(job, self.worker_id, result)
+        metric_inc("jobs_finished_total", job_type=job_type_name, result="succeeded")
+
+
+@job_type("draw", concurrency=2, visibility_timeout=180)
+def run_draw_job(payload):
+    profile_id = payload["profileId"]
+    draw_date = datetime.strptime(payload["drawDate"], "%Y-%m-%d").date()
+    existing = fetch_draw(profile_id, draw_date)
+    if existing:
+        return existing
+    profile = fetch_profile(profile_id)
+    if payload.get("precompute"):
+        if not profile:
+            metric_inc("draw_precompute_total", result="skipped")
+            return None
+        result = generate_draw(
+            profile_id, profile, draw_date, f"{draw_date} 00:00:00", use_case="draw_precompute", hedge=False
+        )
+        metric_inc("draw_precompute_total", result="generated")
+        return result
+    now_str = datetime.now(_resolve_profile_zone(profile)).strftime("%Y-%m-%d %H:%M:%S")
+    return generate_draw(profile_id, profile, draw_date, now_str, hedge=False)
+
+
+@job_type("cast", concurrency=2, visibility_timeout=120)
+def run_cast_job(payload):
+    profile_id = payload["profileId"]
+    profile = fetch_profile(profile_id)
+    if not profile:
+        raise ValueError("profile not found")
+    return perform_one_thing_cast(
+        profile_id,
+        profile,
+        payload["question"],
+        payload["tosses"],
+        _parse_iso_datetime(payload.get("startedAt")),
+        recv_timeout=15,
+        max_duration=60,
+        request_key=payload.get("requestKey"),
+    )
+
+
+@job_type("title", concurrency=4, visibility_timeout=60, max_attempts=3)
+def run_title_job(payload):
+    return {"title": spark_title(payload["text"])}
+
+
+@job_type("enrich_location", concurrency=2, visibility_timeout=60)
+def run_enrich_location_job(payload):
+    profile_id = payload["profileId"]
+    with get_db_conn() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT id, location, solar, location_province, location_city, location_district,
+                       location_detail, latitude, longitude, timezone_id, utc_offset_minutes,
+                       place_source, location_adcode
+                FROM profiles
+                WHERE id = %s
+                """,
+                (str(profile_id),),
+            )
+            row = cur.fetchone()
+            if not row:
+                return {"updated": False}
+            enriched = enrich_location_payload(profile_location_payload(row))
+            update_profile_location(cur, profile_id, enriched)
+    return {"updated": True}
+
+
+@app.get("/jobs/<job_id>")
+def get_job(job_id):
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return jsonify({"error": "job not found"}), 404
+    with get_db_conn() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT id::text, job_type, status, attempts, max_attempts, result, last_error, owner,
+                       created_at, updated_at
+                FROM jobs
+                WHERE id = %s
+                """,
+                (job_id,),
+            )
+            row = cur.fetchone()
+    # 不属于请求方的任务与不存在的任务一样返回 404。
+    if not row or not owner_matches(row["owner"]):
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(
+        {
+            "id": row["id"],
+            "type": row["job_type"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "maxAttempts": row["max_attempts"],
+            "result": row["result"],
+            "error": row["last_error"],
+            "createdAt": row["created_at"].isoformat() if row["created_at"] else None,
+            "updatedAt": row["updated_at"].isoformat() if row["updated_at"] else None,
+        }
+    )
+
+
 if __name__ == "__main__":
-    backfill_profile_locations()
-    app.run(host="0.0.0.0", port=8000, debug=False)
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        DRAW_PRECOMPUTER.start()
+        JobWorker(SPARK_JOB_WORKER_THREADS, SPARK_JOB_POLL_INTERVAL).run()
+    else:
+        backfill_profile_locations()
+        app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8000")), debug=False)
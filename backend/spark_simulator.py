@@ -0,0 +1,268 @@
+"""本地 Spark 协议模拟器：讲讯飞 Spark WebSocket 帧协议，用于压测与延迟测试，不消耗真实配额。
+
+用法：
+
+    python spark_simulator.py --port 8765 --ttft-ms 300 --token-delay-ms 30 --error-rate 0.02
+
+然后让后端指向它（签名参数会被忽略，凭证随便填）：
+
+    SPARK_URL=ws://127.0.0.1:8765/v1/x1 SPARK_APP_ID=sim SPARK_API_KEY=sim SPARK_API_SECRET=sim python spark_server.py
+
+按 system 提示词识别用途：抽卡与六爻返回可解析的 JSON 样例，标题/摘要返回短文本，其余按 --chat-tokens 生成对话文本。
+帧格式与线上一致：header.code/status，payload.choices.status/text，结束帧 status=2 并附 usage。
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import socketserver
+import struct
+import threading
+import time
+
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+DRAW_FIXTURE = {
+    "cardName": "星辰",
+    "keywords": ["希望", "指引", "耐心"],
+    "interpretation": "星辰牌象征远方的光亮与内心的指引。今日气场平稳，适合整理思绪、确立方向。"
+    "过去积累的努力正在悄然发酵，外界的回应或许来得不快，但方向是对的。与人交往时多倾听，少急于表态。",
+    "advice": "把今天要做的事列成清单，先完成最重要的一件；傍晚留出半小时独处，记录当下的想法与感受。",
+}
+
+LIUYAO_FIXTURE = {
+    "conclusion": "平",
+    "summary": "卦象平稳，所问之事短期内难有大的变化，宜守不宜攻，静待时机。",
+    "fiveElements": "世爻得日辰生扶，用神不旺不衰，五行流通尚可。",
+    "advice": "先把手头事务理顺，重要决定可延后一周再议，期间多收集信息。",
+    "sixRelatives": [
+        {"line": 6, "role": "父母", "note": "文书消息偏慢，需耐心等待。"},
+        {"line": 5, "role": "兄弟", "note": "同辈意见分歧，宜求同存异。"},
+        {"line": 4, "role": "官鬼", "note": "压力来自外部规则，按章办事即可。"},
+        {"line": 3, "role": "妻财", "note": "财务平稳，不宜冒进。"},
+        {"line": 2, "role": "子孙", "note": "心态放松有助于化解阻滞。"},
+        {"line": 1, "role": "父母", "note": "根基尚稳，守成为上。"},
+    ],
+}
+
+CHAT_TEXT = "从你的命盘来看，今年整体运势平稳向上。事业上贵人运不错，遇到难题不妨多向前辈请教；感情上宜坦诚沟通。"
+
+
+def _recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("closed")
+        data += chunk
+    return data
+
+
+def read_ws_frame(sock):
+    head = _recv_exact(sock, 2)
+    opcode = head[0] & 0x0F
+    length = head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", _recv_exact(sock, 2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", _recv_exact(sock, 8))[0]
+    mask = _recv_exact(sock, 4) if head[1] & 0x80 else b""
+    payload = bytearray(_recv_exact(sock, length))
+    if mask:
+        for i in range(len(payload)):
+            payload[i] ^= mask[i % 4]
+    return opcode, bytes(payload)
+
+
+def send_ws_frame(sock, data, opcode=0x1):
+    if len(data) < 126:
+        header = struct.pack("!BB", 0x80 | opcode, len(data))
+    elif len(data) < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, len(data))
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, len(data))
+    sock.sendall(header + data)
+
+
+def classify_request(request):
+    """按 system 提示词判断用途：draw / liuyao / title / summary / chat。"""
+    messages = request.get("payload", {}).get("message", {}).get("text", [])
+    system = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+    if "抽卡占卜师" in system:
+        return "draw"
+    if "六爻占断师" in system:
+        return "liuyao"
+    if "聊天标题" in system:
+        return "title"
+    if "压缩命理咨询的对话历史" in system:
+        return "summary"
+    return "chat"
+
+
+def response_text(kind, chat_tokens):
+    if kind == "draw":
+        return json.dumps(DRAW_FIXTURE, ensure_ascii=False)
+    if kind == "liuyao":
+        return json.dumps(LIUYAO_FIXTURE, ensure_ascii=False)
+    if kind == "title":
+        return "今日运势咨询"
+    if kind == "summary":
+        return "用户询问了今年的事业与感情运势，大师建议多请教前辈、坦诚沟通。"
+    repeats = chat_tokens // len(CHAT_TEXT) + 1
+    return (CHAT_TEXT * repeats)[:chat_tokens]
+
+
+class SparkSimulatorHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        config = self.server.config
+        sock = self.request
+        raw = b""
+        while b"\r\n\r\n" not in raw:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return
+            raw += chunk
+        match = re.search(rb"sec-websocket-key:\s*(\S+)", raw, re.I)
+        if not match:
+            sock.sendall(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+            return
+        accept = base64.b64encode(hashlib.sha1(match.group(1) + WS_GUID).digest())
+        sock.sendall(
+            b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+        )
+        try:
+            # 连接池预握手的连接可能空闲一段时间后才发请求，也可能直接被关闭。
+            while True:
+                opcode, data = read_ws_frame(sock)
+                if opcode == 0x8:
+                    return
+                if opcode == 0x9:
+                    send_ws_frame(sock, data, opcode=0xA)
+                    continue
+                if opcode == 0x1:
+                    break
+            self.server.count("requests")
+            self.respond(sock, json.loads(data.decode("utf-8")), config)
+        except (ConnectionError, OSError):
+            self.server.count("client_disconnects")
+
+    def respond(self, sock, request, config):
+        rng = random.Random()
+        sid = f"sim{rng.getrandbits(48):012x}"
+        time.sleep(max(0.0, rng.gauss(config.ttft, config.ttft * config.jitter)))
+        if rng.random() < config.error_rate:
+            self.server.count("errors")
+            frame = {"header": {"code": config.error_code, "message": "simulated error", "sid": sid, "status": 2}}
+            send_ws_frame(sock, json.dumps(frame).encode("utf-8"))
+            return
+        text = response_text(classify_request(request), config.chat_tokens)
+        chunks = [text[i:i + config.chars_per_frame] for i in range(0, len(text), config.chars_per_frame)] or [""]
+        drop_at = rng.randrange(len(chunks)) if rng.random() < config.drop_rate else None
+        for index, chunk in enumerate(chunks):
+            if index == drop_at:
+                self.server.count("drops")
+                return
+            last = index == len(chunks) - 1
+            frame = {
+                "header": {"code": 0, "message": "Success", "sid": sid, "status": 2 if last else 1},
+                "payload": {
+                    "choices": {
+                        "status": 2 if last else 1,
+                        "seq": index,
+                        "text": [{"content": chunk, "role": "assistant", "index": 0}],
+                    }
+                },
+            }
+            if last:
+                frame["payload"]["usage"] = {
+                    "text": {"prompt_tokens": 0, "completion_tokens": len(text), "total_tokens": len(text)}
+                }
+            send_ws_frame(sock, json.dumps(frame, ensure_ascii=False).encode("utf-8"))
+            if not last and config.token_delay > 0:
+                time.sleep(max(0.0, rng.gauss(config.token_delay, config.token_delay * config.jitter)))
+
+
+class SimulatorConfig:
+    def __init__(
+        self,
+        ttft=0.3,
+        token_delay=0.03,
+        chars_per_frame=4,
+        chat_tokens=200,
+        error_rate=0.0,
+        error_code=10013,
+        drop_rate=0.0,
+        jitter=0.1,
+    ):
+        self.ttft = ttft
+        self.token_delay = token_delay
+        self.chars_per_frame = max(1, chars_per_frame)
+        self.chat_tokens = chat_tokens
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.drop_rate = drop_rate
+        self.jitter = jitter
+
+
+class SparkSimulator(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, config=None):
+        super().__init__((host, port), SparkSimulatorHandler)
+        self.config = config or SimulatorConfig()
+        self._counter_lock = threading.Lock()
+        self.counters = {"requests": 0, "errors": 0, "drops": 0, "client_disconnects": 0}
+
+    def count(self, name):
+        with self._counter_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"ws://{host}:{port}/v1/x1"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="spark-simulator", daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft-ms", type=float, default=300, help="收到请求到首帧的延迟")
+    parser.add_argument("--token-delay-ms", type=float, default=30, help="相邻帧之间的间隔")
+    parser.add_argument("--chars-per-frame", type=int, default=4)
+    parser.add_argument("--chat-tokens", type=int, default=200, help="对话回复的字数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 header.code 非 0 的比例")
+    parser.add_argument("--error-code", type=int, default=10013)
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="中途断开连接的比例")
+    parser.add_argument("--jitter", type=float, default=0.1, help="延迟的相对标准差")
+    args = parser.parse_args()
+    config = SimulatorConfig(
+        ttft=args.ttft_ms / 1000.0,
+        token_delay=args.token_delay_ms / 1000.0,
+        chars_per_frame=args.chars_per_frame,
+        chat_tokens=args.chat_tokens,
+        error_rate=args.error_rate,
+        error_code=args.error_code,
+        drop_rate=args.drop_rate,
+        jitter=args.jitter,
+    )
+    server = SparkSimulator(args.host, args.port, config)
+    print(f"[spark_simulator] listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"[spark_simulator] {server.counters}")
+
+
+if __name__ == "__main__":
+    main()
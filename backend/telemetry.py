@@ -0,0 +1,485 @@
+"""指标、结构化日志与请求追踪的基础设施：只依赖标准库，供 spark_server 使用，也可单独导入测试。
+
+这里只有实现，不读取配置；LOG、TRACER 等实例由 spark_server 按环境变量创建。
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+
+# 直方图的桶上界（秒）；+Inf 桶即总次数
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_metric_types = {}
+_metric_gauges = {}
+_metric_shards_lock = threading.Lock()
+_metric_shards = []
+_metric_retired = {}
+# 分片数达到该值时在登记新分片前回收已退出线程的分片，不依赖 /metrics 是否被抓取
+_metric_prune_at = 64
+_metric_local = threading.local()
+
+
+def _metric_key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _metric_shard():
+    """当前线程独占的计数分片：热路径上只写本线程的字典，不加锁；导出时再合并所有分片。"""
+    shard = getattr(_metric_local, "shard", None)
+    if shard is None:
+        shard = _metric_local.shard = {}
+        with _metric_shards_lock:
+            if len(_metric_shards) >= _metric_prune_at:
+                _retire_dead_shards_locked()
+            _metric_shards.append((threading.current_thread(), shard))
+    return shard
+
+
+def metric_inc(name, amount=1, **labels):
+    _metric_types.setdefault(name, "counter")
+    shard = _metric_shard()
+    key = _metric_key(name, labels)
+    shard[key] = shard.get(key, 0) + amount
+
+
+def metric_set(name, value, **labels):
+    _metric_types.setdefault(name, "gauge")
+    _metric_gauges[_metric_key(name, labels)] = value
+
+
+def metric_observe(name, value, **labels):
+    """记录一次观测值：[各桶计数..., sum, count, max]。"""
+    _metric_types.setdefault(name, "histogram")
+    shard = _metric_shard()
+    key = _metric_key(name, labels)
+    stats = shard.get(key)
+    if stats is None:
+        stats = shard[key] = [0] * len(METRIC_BUCKETS) + [0.0, 0, 0.0]
+    for index, bound in enumerate(METRIC_BUCKETS):
+        if value <= bound:
+            stats[index] += 1
+            break
+    stats[-3] += value
+    stats[-2] += 1
+    if value > stats[-1]:
+        stats[-1] = value
+
+
+def _merge_metric(target, key, value):
+    current = target.get(key)
+    if current is None:
+        target[key] = list(value) if isinstance(value, list) else value
+    elif isinstance(value, list):
+        for index in range(len(value) - 1):
+            current[index] += value[index]
+        current[-1] = max(current[-1], value[-1])
+    else:
+        target[key] = current + value
+
+
+def _retire_dead_shards_locked():
+    """把已退出线程的分片并入 _metric_retired 后释放，避免线程轮换导致分片无限增长；调用方持有 _metric_shards_lock。"""
+    global _metric_prune_at
+    alive = []
+    for thread, shard in _metric_shards:
+        if thread.is_alive():
+            alive.append((thread, shard))
+        else:
+            for key, value in shard.copy().items():
+                _merge_metric(_metric_retired, key, value)
+    _metric_shards[:] = alive
+    # 存活线程本身很多时放宽阈值，使登记时的回收保持均摊 O(1)。
+    _metric_prune_at = max(64, 2 * len(alive))
+    return alive
+
+
+def _metric_totals():
+    """合并所有线程分片（顺带回收已退出线程的分片）。"""
+    with _metric_shards_lock:
+        alive = _retire_dead_shards_locked()
+        totals = {}
+        for key, value in _metric_retired.items():
+            _merge_metric(totals, key, value)
+    for _, shard in alive:
+        # dict.copy / list() 在 GIL 下一次完成，不会读到写了一半的分片。
+        for key, value in shard.copy().items():
+            _merge_metric(totals, key, list(value) if isinstance(value, list) else value)
+    totals.update(_metric_gauges.copy())
+    return totals
+
+
+def metrics_snapshot():
+    out = {}
+    for (name, labels), value in sorted(_metric_totals().items(), key=lambda item: item[0]):
+        entry = {"labels": dict(labels)}
+        if isinstance(value, list):
+            count = value[-2]
+            entry.update({"count": count, "sum": value[-3], "max": value[-1]})
+            entry["avg"] = value[-3] / count if count else 0.0
+        else:
+            entry["value"] = value
+        out.setdefault(name, []).append(entry)
+    return out
+
+
+def _prometheus_labels(labels, extra=None):
+    pairs = list(labels) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = []
+    for key, value in pairs:
+        text = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{key}="{text}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def metrics_prometheus():
+    """按 Prometheus 文本格式导出全部指标。"""
+    grouped = {}
+    for (name, labels), value in _metric_totals().items():
+        grouped.setdefault(name, []).append((labels, value))
+    lines = []
+    for name in sorted(grouped):
+        kind = _metric_types.get(name, "untyped")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(grouped[name], key=lambda item: item[0]):
+            if isinstance(value, list):
+                cumulative = 0
+                for index, bound in enumerate(METRIC_BUCKETS):
+                    cumulative += value[index]
+                    lines.append(f"{name}_bucket{_prometheus_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{_prometheus_labels(labels, [('le', '+Inf')])} {value[-2]}")
+                lines.append(f"{name}_sum{_prometheus_labels(labels)} {value[-3]}")
+                lines.append(f"{name}_count{_prometheus_labels(labels)} {value[-2]}")
+            else:
+                lines.append(f"{name}{_prometheus_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+LOG_REDACT_KEYS = {"password", "code", "token", "passwordHash", "password_hash"}
+
+
+class BackgroundWriter:
+    """有界队列 + 后台写线程：调用方只入队，格式化与写出在写线程中批量完成。
+
+    队列满了直接丢弃并计入 dropped_metric，写出永远不会阻塞请求线程。
+    给出 path 时由写线程以追加方式打开文件，否则写 stream（缺省 stdout）。
+    """
+
+    def __init__(self, queue_size, stream=None, path=None, name="log-writer", dropped_metric="log_dropped_total"):
+        self.stream = stream
+        self.path = path
+        self.name = name
+        self.dropped_metric = dropped_metric
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, record, **labels):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            metric_inc(self.dropped_metric, **labels)
+
+    def _format(self, record):
+        return record
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 256:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self.stream is None:
+                    self.stream = open(self.path, "a", encoding="utf-8") if self.path else sys.stdout
+                self.stream.write("".join(self._format(record) + "\n" for record in batch))
+                self.stream.flush()
+            except Exception:  # noqa: BLE001
+                pass
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self, timeout=2.0):
+        """进程退出前尽量写完队列中的记录。"""
+        if self._thread is None:
+            return
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+
+class AsyncLogger(BackgroundWriter):
+    """结构化日志：调用方只做过滤与入队，格式化与写 stdout 在后台线程完成。
+
+    队列满时丢弃并计入 log_dropped_total；debug 级别按 sample 比例采样；
+    字段中的敏感键打码，超长字符串截断。
+    """
+
+    def __init__(self, level, queue_size, sample, max_chars, stream=None):
+        super().__init__(queue_size, stream=stream)
+        self.level = LOG_LEVELS.get(level, LOG_LEVELS["info"])
+        self.sample = sample
+        self.max_chars = max_chars
+
+    def enabled(self, level):
+        return LOG_LEVELS[level] >= self.level
+
+    def log(self, level, event, **fields):
+        if LOG_LEVELS[level] < self.level:
+            return
+        if level == "debug" and self.sample < 1 and random.random() >= self.sample:
+            return
+        self.submit((time.time(), level, event, fields), level=level)
+
+    def debug(self, event, **fields):
+        self.log("debug", event, **fields)
+
+    def info(self, event, **fields):
+        self.log("info", event, **fields)
+
+    def warning(self, event, **fields):
+        self.log("warning", event, **fields)
+
+    def error(self, event, **fields):
+        self.log("error", event, **fields)
+
+    def _clean(self, key, value):
+        if key in LOG_REDACT_KEYS:
+            return "***"
+        if isinstance(value, (int, float, bool)) or value is None:
+            return value
+        if isinstance(value, dict):
+            return {k: self._clean(k, v) for k, v in value.items()}
+        if not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False, default=str)
+        if len(value) > self.max_chars:
+            return f"{value[:self.max_chars]}…(+{len(value) - self.max_chars})"
+        return value
+
+    def _format(self, record):
+        ts, level, event, fields = record
+        line = {
+            "ts": datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": level,
+            "event": event,
+        }
+        for key, value in fields.items():
+            line[key] = self._clean(key, value)
+        return json.dumps(line, ensure_ascii=False)
+
+
+class Span:
+    """一个追踪区间；结束时以 OTLP JSON 的 span 结构写入追踪文件。"""
+
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "start_ns", "attributes", "events", "error")
+
+    def __init__(self, tracer, trace_id, parent_id, name, attributes):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.attributes = dict(attributes)
+        self.events = []
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def add_event(self, name, **attributes):
+        self.events.append((name, time.time_ns(), attributes))
+
+    def fail(self, message):
+        self.error = message
+
+    def end(self):
+        self.tracer.export(self, time.time_ns())
+
+
+class _NoopSpan:
+    """未采样时使用的空 span，保证关闭追踪时埋点几乎零开销。"""
+
+    trace_id = None
+
+    def set(self, key, value):
+        pass
+
+    def add_event(self, name, **attributes):
+        pass
+
+    def fail(self, message):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+_current_span = contextvars.ContextVar("current_span", default=NOOP_SPAN)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+class Tracer(BackgroundWriter):
+    """轻量请求追踪：采样的请求在 SPARK_TRACE_FILE 中按行写出 OTLP JSON（resourceSpans），可直接导入 Jaeger/Tempo 等。
+
+    span 结束时只在请求线程里拍下字段并入队，序列化与写文件由后台写线程完成；队列满时丢弃并计入 trace_dropped_total。
+    """
+
+    def __init__(self, path, sample_rate, queue_size, service_name="deepfate-backend"):
+        super().__init__(queue_size, path=path, name="trace-writer", dropped_metric="trace_dropped_total")
+        self.sample_rate = sample_rate
+        self.service_name = service_name
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def start_root(self, name, traceparent=None, force=False, **attributes):
+        """开始一条请求的根 span；支持 W3C traceparent 透传，未采样时返回 NOOP_SPAN。"""
+        if not self.enabled:
+            return NOOP_SPAN
+        trace_id = None
+        parent_id = None
+        sampled = force or random.random() < self.sample_rate
+        parts = (traceparent or "").split("-")
+        if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+            trace_id, parent_id = parts[1], parts[2]
+            sampled = sampled or (parts[3] in ("01", "03"))
+        if not sampled:
+            return NOOP_SPAN
+        return Span(self, trace_id or os.urandom(16).hex(), parent_id, name, attributes)
+
+    def export(self, span, end_ns):
+        self.submit(
+            (
+                span.trace_id,
+                span.span_id,
+                span.parent_id,
+                span.name,
+                span.start_ns,
+                end_ns,
+                dict(span.attributes),
+                list(span.events),
+                span.error,
+            )
+        )
+
+    def _format(self, record):
+        trace_id, span_id, parent_id, name, start_ns, end_ns, attributes, events, error = record
+        span = {
+            "traceId": trace_id,
+            "spanId": span_id,
+            "name": name,
+            "kind": 1,
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(end_ns),
+            "attributes": _otlp_attributes(attributes),
+            "events": [
+                {"name": event_name, "timeUnixNano": str(ts), "attributes": _otlp_attributes(attrs)}
+                for event_name, ts, attrs in events
+            ],
+            "status": {"code": 2, "message": error} if error else {"code": 1},
+        }
+        if parent_id:
+            span["parentSpanId"] = parent_id
+        return json.dumps(
+            {
+                "resourceSpans": [
+                    {
+                        "resource": {"attributes": _otlp_attributes({"service.name": self.service_name})},
+                        "scopeSpans": [{"scope": {"name": "spark_server"}, "spans": [span]}],
+                    }
+                ]
+            },
+            ensure_ascii=False,
+        )
+
+
+def current_span():
+    return _current_span.get()
+
+
+def start_span(name, parent=None, **attributes):
+    """创建一个子 span 但不设为当前 span，供生成器等跨 yield 的代码手动 end()。"""
+    parent = parent or _current_span.get()
+    if parent is NOOP_SPAN:
+        return NOOP_SPAN
+    return Span(parent.tracer, parent.trace_id, parent.span_id, name, attributes)
+
+
+@contextlib.contextmanager
+def trace_span(name, **attributes):
+    """在当前追踪下开一个子 span；当前请求未被采样时什么也不做。"""
+    parent = _current_span.get()
+    if parent is NOOP_SPAN:
+        yield NOOP_SPAN
+        return
+    span = Span(parent.tracer, parent.trace_id, parent.span_id, name, attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as exc:
+        if not isinstance(exc, GeneratorExit):
+            span.fail(f"{type(exc).__name__}: {exc}")
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+
+
+def traced(name):
+    """把整个函数包进一个 span。"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def run_with_span(parent, func, *args, **kwargs):
+    """在新线程中沿用调用方的追踪上下文（如流式对话的后台生成线程）。"""
+    token = _current_span.set(parent)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _current_span.reset(token)
@@ -0,0 +1,35 @@
+import os
+import sys
+import types
+
+import pytest
+
+# 测试直接导入 backend 下的模块（spark_server 以外、只依赖标准库的部分）。
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock:
+    """可控时钟：time() 与 monotonic() 返回同一个值，只在 advance() 时前进。"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    monotonic = time
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    """返回 install(module)：把 module.time 换成 FakeClock 并返回该时钟。"""
+
+    def install(module):
+        clock = FakeClock()
+        monkeypatch.setattr(module, "time", types.SimpleNamespace(time=clock.time, monotonic=clock.monotonic))
+        return clock
+
+    return install
@@ -0,0 +1,105 @@
+"""CircuitBreaker：closed -> open -> half_open 的状态切换与单个试探请求。"""
+import pytest
+
+import spark_flow
+from spark_flow import CircuitBreaker, SparkUnavailable
+
+
+class RecordingLog:
+    def __init__(self):
+        self.records = []
+
+    def log(self, level, event, **fields):
+        self.records.append((level, event, fields))
+
+
+@pytest.fixture
+def clock(fake_time):
+    return fake_time(spark_flow)
+
+
+@pytest.fixture
+def log():
+    return RecordingLog()
+
+
+@pytest.fixture
+def breaker(clock, log):
+    return CircuitBreaker("spark", failure_threshold=3, reset_timeout=30, log=log)
+
+
+def trip(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.before_call() is False
+        breaker.record_failure(RuntimeError("boom"))
+
+
+def test_opens_after_consecutive_failures(breaker, log):
+    breaker.record_failure(RuntimeError("boom"))
+    breaker.record_failure(RuntimeError("boom"))
+    # 成功会清零连续失败计数。
+    breaker.record_success()
+    breaker.record_failure(RuntimeError("boom"))
+    breaker.record_failure(RuntimeError("boom"))
+    assert breaker.snapshot()["state"] == "closed"
+    breaker.record_failure(RuntimeError("boom"))
+    snapshot = breaker.snapshot()
+    assert snapshot["state"] == "open"
+    assert snapshot["lastError"] == "boom"
+    assert log.records[-1] == ("warning", "breaker.transition", {"breaker": "spark", "state": "open"})
+
+
+def test_open_rejects_until_reset_timeout(breaker, clock):
+    trip(breaker)
+    clock.advance(10)
+    with pytest.raises(SparkUnavailable) as excinfo:
+        breaker.check()
+    assert excinfo.value.retry_after == 20
+    with pytest.raises(SparkUnavailable):
+        breaker.before_call()
+    assert breaker.snapshot()["openRemaining"] == 20
+
+
+def test_half_open_allows_a_single_probe(breaker, clock):
+    trip(breaker)
+    clock.advance(30)
+    # check() 只做快速失败判断，不占用试探名额。
+    breaker.check()
+    assert breaker.before_call() is True
+    assert breaker.snapshot()["state"] == "half_open"
+    with pytest.raises(SparkUnavailable):
+        breaker.before_call()
+
+
+def test_successful_probe_closes(breaker, clock, log):
+    trip(breaker)
+    clock.advance(30)
+    assert breaker.before_call() is True
+    breaker.record_success()
+    assert breaker.snapshot()["state"] == "closed"
+    assert breaker.before_call() is False
+    states = [fields["state"] for _, _, fields in log.records]
+    assert states == ["open", "half_open", "closed"]
+
+
+def test_failed_probe_reopens(breaker, clock):
+    trip(breaker)
+    clock.advance(30)
+    assert breaker.before_call() is True
+    breaker.record_failure(RuntimeError("still down"))
+    assert breaker.snapshot()["state"] == "open"
+    # 重新打开后冷却期从试探失败时重新计算。
+    clock.advance(29)
+    with pytest.raises(SparkUnavailable):
+        breaker.check()
+    clock.advance(1)
+    assert breaker.before_call() is True
+
+
+def test_abandoned_probe_frees_the_slot(breaker, clock):
+    trip(breaker)
+    clock.advance(30)
+    assert breaker.before_call() is True
+    breaker.record_abandoned()
+    assert breaker.snapshot()["state"] == "half_open"
+    assert breaker.before_call() is True
@@ -0,0 +1,263 @@
+"""验证码存储：MemoryCodeStore 与 RedisCodeStore 的行为一致性。
+
+RedisCodeStore 连到进程内的 RESP 假服务端；假服务端没有 Lua 解释器，
+按脚本原文把 EVAL/EVALSHA 分派给等价的 Python 实现，并像真实 Redis 一样在 EVAL 后缓存脚本。
+假服务端还可以在执行命令后不应答就断开，或应答后关闭连接，用来检查 RedisClient 的重试边界。
+"""
+import hashlib
+import socketserver
+import threading
+import types
+
+import pytest
+
+import redis_store
+from redis_store import MemoryCodeStore, RedisClient, RedisCodeStore
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeRedis:
+    """只实现验证码脚本用到的数据操作；键的过期时间按注入的时钟计算。"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.data = {}
+        self.commands = []
+        self.cached = set()
+        self.lock = threading.Lock()
+        # 执行后不应答、直接断开连接的命令；以及是否在每次应答后关闭连接（模拟服务端回收空闲连接）。
+        self.drop_after = set()
+        self.close_after_reply = False
+        self.disconnected = threading.Event()
+        self.scripts = {
+            RedisCodeStore.ISSUE_SCRIPT: self._issue,
+            RedisCodeStore.VERIFY_SCRIPT: self._verify,
+        }
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= self.clock():
+            del self.data[key]
+            return None
+        return value
+
+    def ttl(self, key):
+        if self.get(key) is None:
+            return -2
+        expires_at = self.data[key][1]
+        return -1 if expires_at is None else int(expires_at - self.clock())
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def _issue(self, keys, args):
+        self.data[keys[0]] = (args[0], self.clock() + int(args[1]))
+        self.delete(keys[1])
+        return 1
+
+    def _verify(self, keys, args):
+        stored = self.get(keys[0])
+        if stored is None:
+            return 0
+        if stored == args[0]:
+            self.delete(*keys)
+            return 1
+        attempts = int(self.get(keys[1]) or 0) + 1
+        expires_at = self.data[keys[1]][1] if keys[1] in self.data else None
+        if attempts == 1 and self.ttl(keys[0]) > 0:
+            expires_at = self.clock() + self.ttl(keys[0])
+        self.data[keys[1]] = (str(attempts), expires_at)
+        if attempts >= int(args[1]):
+            self.delete(*keys)
+            return -1
+        return 0
+
+    def handle(self, args):
+        name = args[0].upper()
+        self.commands.append(name)
+        if name in ("AUTH", "SELECT"):
+            return "+OK"
+        if name in ("EVAL", "EVALSHA"):
+            numkeys = int(args[2])
+            keys, argv = args[3:3 + numkeys], args[3 + numkeys:]
+            if name == "EVAL":
+                script = args[1]
+                self.cached.add(script)
+            else:
+                script = next(
+                    (text for text in self.cached if hashlib.sha1(text.encode()).hexdigest() == args[1]),
+                    None,
+                )
+                if script is None:
+                    return "-NOSCRIPT No matching script. Please use EVAL."
+            with self.lock:
+                return self.scripts[script](keys, argv)
+        return f"-ERR unknown command '{name}'"
+
+
+class _RESPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:-2])):
+                size = int(self.rfile.readline()[1:-2])
+                args.append(self.rfile.read(size + 2)[:-2].decode("utf-8"))
+            fake = self.server.fake
+            reply = fake.handle(args)
+            if args[0].upper() in fake.drop_after:
+                return
+            if isinstance(reply, int):
+                self.wfile.write(b":%d\r\n" % reply)
+            else:
+                self.wfile.write(reply.encode("utf-8") + b"\r\n")
+            if fake.close_after_reply:
+                return
+
+    def finish(self):
+        super().finish()
+        self.server.fake.disconnected.set()
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(redis_store, "time", types.SimpleNamespace(time=clock))
+    return clock
+
+
+@pytest.fixture
+def fake_redis(clock):
+    fake = FakeRedis(clock)
+    server = _Server(("127.0.0.1", 0), _RESPHandler)
+    server.fake = fake
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    fake.url = "redis://127.0.0.1:%d/0" % server.server_address[1]
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["memory", "redis"])
+def store(request, clock):
+    if request.param == "memory":
+        return MemoryCodeStore()
+    fake = request.getfixturevalue("fake_redis")
+    return RedisCodeStore(RedisClient(fake.url, timeout=5.0))
+
+
+def test_issue_then_verify_ok(store):
+    store.issue("13800000000", "123456", 300)
+    assert store.verify("13800000000", "123456", 5) == "ok"
+    # 验证码校验成功即被消费。
+    assert store.verify("13800000000", "123456", 5) == "invalid"
+
+
+def test_wrong_code_increments_attempts(store):
+    store.issue("13800000000", "123456", 300)
+    assert store.verify("13800000000", "000000", 3) == "invalid"
+    assert store.verify("13800000000", "111111", 3) == "invalid"
+    # 两次错误后仍未达上限，正确的验证码依然可用。
+    assert store.verify("13800000000", "123456", 3) == "ok"
+
+
+def test_attempt_counter_is_stored(fake_redis):
+    store = RedisCodeStore(RedisClient(fake_redis.url, timeout=5.0))
+    store.issue("13800000000", "123456", 300)
+    store.verify("13800000000", "000000", 5)
+    store.verify("13800000000", "000000", 5)
+    assert fake_redis.get("sms:attempts:13800000000") == "2"
+    # 计数与验证码同时过期。
+    assert 0 < fake_redis.ttl("sms:attempts:13800000000") <= 300
+
+
+def test_locks_at_max_attempts(store):
+    store.issue("13800000000", "123456", 300)
+    assert store.verify("13800000000", "000000", 3) == "invalid"
+    assert store.verify("13800000000", "000000", 3) == "invalid"
+    assert store.verify("13800000000", "000000", 3) == "locked"
+    # 锁定后验证码作废，正确的验证码也不再通过。
+    assert store.verify("13800000000", "123456", 3) == "invalid"
+
+
+def test_reissue_resets_attempts(store):
+    store.issue("13800000000", "123456", 300)
+    assert store.verify("13800000000", "000000", 2) == "invalid"
+    store.issue("13800000000", "654321", 300)
+    assert store.verify("13800000000", "000000", 2) == "invalid"
+    assert store.verify("13800000000", "654321", 2) == "ok"
+
+
+def test_code_expires_after_ttl(store, clock):
+    store.issue("13800000000", "123456", 60)
+    clock.advance(59)
+    store.issue("13900000000", "222222", 60)
+    assert store.verify("13900000000", "222222", 5) == "ok"
+    clock.advance(2)
+    assert store.verify("13800000000", "123456", 5) == "invalid"
+
+
+def test_noscript_falls_back_to_eval(fake_redis):
+    store = RedisCodeStore(RedisClient(fake_redis.url, timeout=5.0))
+    store.issue("13800000000", "123456", 300)
+    # 服务端还没有缓存脚本：EVALSHA 返回 NOSCRIPT 后改用 EVAL。
+    assert fake_redis.commands == ["EVALSHA", "EVAL"]
+    assert store.verify("13800000000", "123456", 5) == "ok"
+    assert fake_redis.commands == ["EVALSHA", "EVAL", "EVALSHA", "EVAL"]
+    # EVAL 之后脚本已缓存，后续调用只需 EVALSHA。
+    store.issue("13800000000", "654321", 300)
+    assert fake_redis.commands[-1] == "EVALSHA"
+    assert fake_redis.commands.count("EVAL") == 2
+
+
+def test_no_retry_once_command_is_sent(fake_redis):
+    store = RedisCodeStore(RedisClient(fake_redis.url, timeout=5.0))
+    store.issue("13800000000", "123456", 300)
+    store.verify("13800000000", "000000", 5)
+    fake_redis.commands.clear()
+    # 服务端执行了 EVALSHA 但没来得及应答就断开：客户端不能重发，否则错误次数会记两次。
+    fake_redis.drop_after.add("EVALSHA")
+    with pytest.raises(OSError):
+        store.verify("13800000000", "000000", 5)
+    assert fake_redis.commands == ["EVALSHA"]
+    assert fake_redis.get("sms:attempts:13800000000") == "2"
+    # 连接已关闭，下一次调用重新建连。
+    fake_redis.drop_after.clear()
+    assert store.verify("13800000000", "123456", 5) == "ok"
+
+
+def test_reconnects_when_idle_connection_was_closed(fake_redis):
+    store = RedisCodeStore(RedisClient(fake_redis.url, timeout=5.0))
+    store.issue("13800000000", "123456", 300)
+    fake_redis.close_after_reply = True
+    fake_redis.disconnected.clear()
+    store.verify("13800000000", "000000", 5)
+    assert fake_redis.disconnected.wait(5)
+    fake_redis.close_after_reply = False
+    fake_redis.commands.clear()
+    # 空闲连接已被服务端关闭：发送前发现并换新连接，命令只执行一次。
+    assert store.verify("13800000000", "000000", 5) == "invalid"
+    assert fake_redis.commands == ["EVALSHA"]
+    assert fake_redis.get("sms:attempts:13800000000") == "2"
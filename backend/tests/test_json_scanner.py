@@ -0,0 +1,72 @@
+"""JsonObjectScanner：字符串内的括号、逗号与转义，分片输入以及已完成字段。"""
+import json
+
+import pytest
+
+from spark_flow import JsonObjectScanner
+
+TRICKY = {
+    "summary": "运势{平稳}，注意[细节]",
+    "quote": "他说：\"别急, 慢慢来}\"",
+    "path": "C:\\temp\\{x}\\",
+    "items": [{"a": 1}, {"b": "}]"}],
+}
+
+
+def test_braces_and_escapes_inside_strings():
+    text = json.dumps(TRICKY, ensure_ascii=False)
+    scanner = JsonObjectScanner()
+    assert scanner.feed(text) == TRICKY
+    assert not scanner.failed
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7])
+def test_chunked_feed(size):
+    text = json.dumps(TRICKY, ensure_ascii=False)
+    scanner = JsonObjectScanner()
+    results = [scanner.feed(text[i:i + size]) for i in range(0, len(text), size)]
+    # 只有最后一片才让对象闭合，之前不会因字符串里的 '}' 提前结束。
+    assert results[:-1] == [None] * (len(results) - 1)
+    assert results[-1] == TRICKY
+
+
+def test_leading_prose_and_trailing_text():
+    scanner = JsonObjectScanner()
+    assert scanner.feed("好的，以下是结果：") is None
+    assert scanner.feed('```json\n{"a": "x}"') is None
+    assert scanner.feed(', "b": 2}\n``` 以上。') == {"a": "x}", "b": 2}
+    assert scanner.text == '{"a": "x}", "b": 2}'
+    # 闭合之后继续喂入不会改变结果。
+    assert scanner.feed('{"c": 3}') == {"a": "x}", "b": 2}
+
+
+def test_escaped_backslash_before_quote_ends_string():
+    scanner = JsonObjectScanner()
+    # "a\\" 是以反斜杠结尾的完整字符串，其后的 '}' 真正闭合对象。
+    assert scanner.feed('{"k": "a\\\\"') is None
+    assert scanner.feed("}") == {"k": "a\\"}
+
+
+def test_partial_progression():
+    scanner = JsonObjectScanner()
+    assert scanner.partial() == {}
+    scanner.feed('{"summary": "今天{不错}, 加油", "score"')
+    assert scanner.partial() == {"summary": "今天{不错}, 加油"}
+    scanner.feed(': 8, "tips": ["早睡", "多喝水"')
+    assert scanner.partial() == {"summary": "今天{不错}, 加油", "score": 8}
+    scanner.feed("]}")
+    assert scanner.partial() == {"summary": "今天{不错}, 加油", "score": 8, "tips": ["早睡", "多喝水"]}
+
+
+def test_nested_commas_do_not_advance_partial():
+    scanner = JsonObjectScanner()
+    scanner.feed('{"a": {"x": 1, "y": 2')
+    assert scanner.partial() == {}
+
+
+def test_invalid_json_sets_failed():
+    scanner = JsonObjectScanner()
+    assert scanner.feed("{'a': 1}") is None
+    assert scanner.failed
+    assert scanner.result is None
+    assert scanner.feed('{"a": 1}') is None
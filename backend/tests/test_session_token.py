@@ -0,0 +1,74 @@
+"""会话令牌：签名、有效期与密钥轮换。"""
+import json
+
+import pytest
+
+from session_token import SessionError, SessionSigner, _b64url, _b64url_decode
+
+NOW = 1_700_000_000
+
+
+@pytest.fixture
+def signer():
+    return SessionSigner({"k1": b"secret-one"}, ttl=3600)
+
+
+def test_round_trip(signer):
+    token, expires_at = signer.issue("42", ["p2", "p1"], now=NOW)
+    claims = signer.verify(token, now=NOW + 10)
+    assert claims["uid"] == "42"
+    assert claims["pids"] == ["p1", "p2"]
+    assert expires_at == NOW + 3600
+
+
+def test_tampered_signature(signer):
+    token, _ = signer.issue("42", [], now=NOW)
+    head, _, signature = token.rpartition(".")
+    forged = _b64url(bytes(b ^ 1 for b in _b64url_decode(signature)))
+    with pytest.raises(SessionError, match="invalid token"):
+        signer.verify(f"{head}.{forged}", now=NOW)
+
+
+def test_tampered_payload(signer):
+    token, _ = signer.issue("42", ["p1"], now=NOW)
+    version, kid, body, signature = token.split(".")
+    claims = json.loads(_b64url_decode(body))
+    claims["pids"].append("someone-else")
+    body = _b64url(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    with pytest.raises(SessionError, match="invalid token"):
+        signer.verify(f"{version}.{kid}.{body}.{signature}", now=NOW)
+
+
+def test_expired(signer):
+    token, expires_at = signer.issue("42", [], now=NOW)
+    assert signer.verify(token, now=expires_at)["uid"] == "42"
+    with pytest.raises(SessionError, match="token expired"):
+        signer.verify(token, now=expires_at + 1)
+
+
+def test_unknown_kid(signer):
+    other = SessionSigner({"k9": b"secret-one"}, ttl=3600)
+    token, _ = other.issue("42", [], now=NOW)
+    with pytest.raises(SessionError, match="invalid token"):
+        signer.verify(token, now=NOW)
+
+
+@pytest.mark.parametrize("token", ["", "garbage", "v1.k1.!!.!!", "v2.k1.e30.AAAA", "v1.k1.e30"])
+def test_malformed(signer, token):
+    with pytest.raises(SessionError):
+        signer.verify(token, now=NOW)
+
+
+def test_rotated_key(signer):
+    old_token, _ = signer.issue("42", [], now=NOW)
+    rotated = SessionSigner({"k2": b"secret-two", "k1": b"secret-one"}, ttl=3600)
+    new_token, _ = rotated.issue("42", [], now=NOW)
+    assert new_token.split(".")[1] == "k2"
+    # 旧密钥签发的令牌在轮换后仍可校验，新令牌用新密钥签发。
+    assert rotated.verify(old_token, now=NOW)["uid"] == "42"
+    assert rotated.verify(new_token, now=NOW)["uid"] == "42"
+    # 旧密钥下线后，用它签发的令牌失效。
+    retired = SessionSigner({"k2": b"secret-two"}, ttl=3600)
+    with pytest.raises(SessionError, match="invalid token"):
+        retired.verify(old_token, now=NOW)
+    assert retired.verify(new_token, now=NOW)["uid"] == "42"
@@ -0,0 +1,101 @@
+"""SparkScheduler：并发上限内直接放行，超出后按优先级排队，队列满或等待超时即拒绝。"""
+import threading
+import time
+
+import pytest
+
+import spark_flow
+from spark_flow import SparkOverloaded, SparkScheduler
+
+PRIORITIES = {"chat": 0, "title": 1, "draw": 2, "summary": 2}
+
+
+@pytest.fixture
+def clock(fake_time):
+    return fake_time(spark_flow)
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def test_admits_up_to_capacity(clock):
+    scheduler = SparkScheduler(2, 0, 10, PRIORITIES)
+    first = scheduler.acquire("chat")
+    second = scheduler.acquire("draw")
+    # 没有排队名额：第三个请求立即被拒绝。
+    with pytest.raises(SparkOverloaded):
+        scheduler.acquire("chat")
+    first.release()
+    with scheduler.acquire("chat"):
+        pass
+    second.release()
+
+
+def test_waiters_are_served_by_priority_then_arrival(clock):
+    scheduler = SparkScheduler(1, 10, 60, PRIORITIES)
+    held = scheduler.acquire("chat")
+    order = []
+
+    def run(use_case):
+        with scheduler.acquire(use_case):
+            order.append(use_case)
+
+    threads = []
+    for use_case in ("draw", "summary", "title", "chat"):
+        thread = threading.Thread(target=run, args=(use_case,))
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: len(scheduler._waiting) == len(threads))
+    held.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == ["chat", "title", "draw", "summary"]
+
+
+def test_sheds_when_queue_is_full(clock):
+    scheduler = SparkScheduler(1, 1, 60, PRIORITIES)
+    held = scheduler.acquire("chat")
+    acquired = threading.Event()
+
+    def run():
+        with scheduler.acquire("draw"):
+            acquired.set()
+
+    waiter = threading.Thread(target=run)
+    waiter.start()
+    wait_until(lambda: len(scheduler._waiting) == 1)
+    # 队列已满时即使优先级更高也直接拒绝，并给出 Retry-After。
+    with pytest.raises(SparkOverloaded) as excinfo:
+        scheduler.acquire("chat")
+    assert excinfo.value.status_code == 429
+    assert excinfo.value.retry_after >= 1
+    held.release()
+    waiter.join(5)
+    assert acquired.is_set()
+
+
+def test_sheds_after_max_wait(clock):
+    scheduler = SparkScheduler(1, 5, 0, PRIORITIES)
+    held = scheduler.acquire("chat")
+    with pytest.raises(SparkOverloaded):
+        scheduler.acquire("draw")
+    # 超时的请求离开队列，不影响之后的请求。
+    assert scheduler._waiting == []
+    held.release()
+    with scheduler.acquire("draw"):
+        pass
+
+
+def test_release_is_idempotent(clock):
+    scheduler = SparkScheduler(1, 0, 10, PRIORITIES)
+    slot = scheduler.acquire("chat")
+    clock.advance(2)
+    slot.release()
+    slot.release()
+    assert scheduler._active == 0
+    with scheduler.acquire("chat"):
+        pass
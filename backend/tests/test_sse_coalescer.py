@@ -0,0 +1,58 @@
+"""SSECoalescer：首帧直发、时间窗合并、句末与字节阈值刷新以及收尾刷新。"""
+from spark_flow import SSECoalescer
+
+
+def test_first_chunk_is_sent_immediately():
+    coalescer = SSECoalescer(window_seconds=0.1, max_bytes=1024)
+    assert coalescer.push("你", now=0.0) == "你"
+    assert coalescer.flush() is None
+
+
+def test_window_flush():
+    coalescer = SSECoalescer(window_seconds=0.1, max_bytes=1024)
+    coalescer.push("今", now=0.0)
+    assert coalescer.push("天", now=0.01) is None
+    assert coalescer.push("运", now=0.05) is None
+    assert coalescer.poll(now=0.10) is None
+    # 时间窗从缓冲的第一个片段开始计算。
+    assert coalescer.poll(now=0.11) == "天运"
+    assert coalescer.poll(now=0.50) is None
+    assert coalescer.push("势", now=0.50) is None
+    assert coalescer.push("不", now=0.61) == "势不"
+
+
+def test_sentence_end_flushes():
+    coalescer = SSECoalescer(window_seconds=1.0, max_bytes=1024)
+    coalescer.push("今", now=0.0)
+    assert coalescer.push("天不错", now=0.01) is None
+    assert coalescer.push("。", now=0.02) == "天不错。"
+    assert coalescer.push("注意休息! ", now=0.03) == "注意休息! "
+    assert coalescer.push("换行\n", now=0.04) == "换行\n"
+
+
+def test_max_bytes_flushes():
+    # 中文在 UTF-8 下每字 3 字节，按字节而不是字符计数。
+    coalescer = SSECoalescer(window_seconds=1.0, max_bytes=9)
+    coalescer.push("x", now=0.0)
+    assert coalescer.push("今天", now=0.01) is None
+    assert coalescer.push("运", now=0.02) == "今天运"
+    assert coalescer.push("ab", now=0.03) is None
+
+
+def test_final_flush_returns_tail():
+    coalescer = SSECoalescer(window_seconds=1.0, max_bytes=1024)
+    coalescer.push("今", now=0.0)
+    coalescer.push("天", now=0.01)
+    coalescer.push("运势", now=0.02)
+    assert coalescer.flush() == "天运势"
+    assert coalescer.flush() is None
+    # 刷新后重新开始计时，旧的起点不会让下一个片段立刻刷新。
+    assert coalescer.push("好", now=5.0) is None
+    assert coalescer.poll(now=5.5) is None
+    assert coalescer.poll(now=6.0) == "好"
+
+
+def test_zero_window_passes_through():
+    coalescer = SSECoalescer(window_seconds=0, max_bytes=1024)
+    assert [coalescer.push(chunk, now=0.0) for chunk in ("今", "天", "好")] == ["今", "天", "好"]
+    assert coalescer.flush() is None
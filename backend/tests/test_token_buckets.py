@@ -0,0 +1,57 @@
+"""LocalTokenBuckets：突发额度、按速率回填与 LRU 淘汰。"""
+import pytest
+
+import redis_store
+from redis_store import LocalTokenBuckets
+
+
+@pytest.fixture
+def clock(fake_time):
+    return fake_time(redis_store)
+
+
+def test_burst_then_deny(clock):
+    buckets = LocalTokenBuckets()
+    assert [buckets.take("ip:1", burst=3, rate=0.5)[0] for _ in range(3)] == [True, True, True]
+    allowed, wait = buckets.take("ip:1", burst=3, rate=0.5)
+    assert not allowed
+    assert wait == pytest.approx(2.0)
+    # 被拒绝的请求不消耗令牌，等待时间随已回填的部分缩短。
+    clock.advance(1.5)
+    allowed, wait = buckets.take("ip:1", burst=3, rate=0.5)
+    assert not allowed
+    assert wait == pytest.approx(0.5)
+
+
+def test_refill_is_capped_at_burst(clock):
+    buckets = LocalTokenBuckets()
+    for _ in range(2):
+        buckets.take("user:1", burst=2, rate=1)
+    assert not buckets.take("user:1", burst=2, rate=1)[0]
+    clock.advance(1)
+    assert buckets.take("user:1", burst=2, rate=1) == (True, 0.0)
+    assert not buckets.take("user:1", burst=2, rate=1)[0]
+    # 空闲再久也只回填到 burst。
+    clock.advance(3600)
+    assert [buckets.take("user:1", burst=2, rate=1)[0] for _ in range(3)] == [True, True, False]
+
+
+def test_keys_are_independent(clock):
+    buckets = LocalTokenBuckets()
+    assert buckets.take("ip:1", burst=1, rate=1)[0]
+    assert not buckets.take("ip:1", burst=1, rate=1)[0]
+    assert buckets.take("ip:2", burst=1, rate=1)[0]
+
+
+def test_lru_eviction(clock):
+    buckets = LocalTokenBuckets(max_keys=2)
+    assert buckets.take("a", burst=1, rate=0.01)[0]
+    assert buckets.take("b", burst=1, rate=0.01)[0]
+    # 再次访问 a（即使被拒绝）会把它移到最近使用的位置，于是插入 c 时淘汰的是 b。
+    assert not buckets.take("a", burst=1, rate=0.01)[0]
+    assert buckets.take("c", burst=1, rate=0.01)[0]
+    assert list(buckets._buckets) == ["a", "c"]
+    assert not buckets.take("a", burst=1, rate=0.01)[0]
+    # 被淘汰的桶丢失了状态，重新出现时拿到完整的突发额度。
+    assert buckets.take("b", burst=1, rate=0.01)[0]
+    assert list(buckets._buckets) == ["a", "b"]